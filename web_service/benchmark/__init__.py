@@ -0,0 +1,15 @@
+"""
+(C) Copyright 2020
+
+Benchmark-uri pentru serviciul web. Se rulează din directorul web_service, de
+exemplu: python -m benchmark.serialize
+"""
+
+import os
+import sys
+
+# Modulele serverului (server.py, serialization.py etc.) nu formează un pachet.
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, "server")
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
@@ -0,0 +1,906 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+
+Benchmark de încărcare pentru toate rutele din server.py: populează baza de
+date cu un set sintetic (țări -> orașe -> temperaturi), pornește serverul
+într-un proces separat și trimite cereri fiecărei rute, cu mai mulți clienți
+simultan. Pentru fiecare rută se raportează latența (p50 / p95 / p99),
+numărul de cereri pe secundă și codurile de răspuns, iar pentru server,
+memoria folosită. Raportul este scris ca JSON, ca să poată fi comparat cu
+cel al unei versiuni anterioare (--baseline).
+
+Baza de date este fie una existentă (--dsn), fie una de unică folosință,
+creată cu initdb într-un director temporar și ștearsă la final (--initdb;
+initdb și pg_ctl trebuie să fie în PATH sau în --pg-bin), fie un fișier
+SQLite temporar, populat prin Storage API (--sqlite; serverul rulează cu
+WEB_SERVICE_STORAGE=sqlite, într-un singur proces).
+
+Utilizare: python -m benchmark.load (--dsn DSN | --initdb | --sqlite)
+    [--countries N]
+    [--cities-per-country N] [--temperatures N] [--concurrency N]
+    [--duration S] [--routes R1,R2] [--server debug|gevent] [--workers N]
+    [--output FILE] [--baseline FILE]
+"""
+
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter, sleep
+
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+
+from sqlite_storage import SqliteStorage
+
+import migrations
+import partitions
+import rollups
+
+from . import SERVER_DIR
+
+def free_port():
+    """
+    Returns:
+        int: un port TCP liber pe mașina locală
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class ThrowawayPostgres:
+    """
+    Un server PostgreSQL de unică folosință, într-un director temporar.
+    """
+    def __init__(self, pg_bin=None):
+        self.pg_bin = pg_bin
+        self.directory = tempfile.mkdtemp(prefix="benchmark-pg-")
+        self.port = free_port()
+
+    def _tool(self, name):
+        """
+        Returns:
+            str: calea programului PostgreSQL dat
+        """
+        if self.pg_bin:
+            return os.path.join(self.pg_bin, name)
+        path = shutil.which(name)
+        if path is None:
+            raise SystemExit("%s nu a fost găsit; folosiți --pg-bin." % name)
+        return path
+
+    def start(self):
+        """
+        Creează și pornește serverul.
+
+        Returns:
+            str: DSN-ul serverului
+        """
+        data = os.path.join(self.directory, "data")
+        subprocess.run([self._tool("initdb"), "-D", data, "-U", "admin",
+                        "-A", "trust", "-E", "UTF8", "--locale=C"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self._tool("pg_ctl"), "-D", data, "-w", "-l",
+                        os.path.join(self.directory, "log"), "-o",
+                        "-k %s -p %d -c listen_addresses=127.0.0.1" % (
+                            self.directory, self.port), "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        return "host=127.0.0.1 port=%d user=admin dbname=postgres" % self.port
+
+    def stop(self):
+        """
+        Oprește serverul și șterge directorul.
+        """
+        subprocess.run([self._tool("pg_ctl"), "-D",
+                        os.path.join(self.directory, "data"), "-m", "fast",
+                        "stop"], check=False, stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def seed(conn, countries, cities_per_country, temperatures):
+    """
+    Aduce schema la zi și o populează cu un set sintetic, determinist:
+    countries țări, câte cities_per_country orașe în fiecare și
+    temperaturi orare, terminate în ora curentă, împărțite egal între
+    orașe.
+
+    Returns:
+        dict: dimensiunile setului și durata populării
+    """
+    start = perf_counter()
+    migrations.migrate(conn)
+    cursor = conn.cursor()
+
+    cursor.execute(""" TRUNCATE countries CASCADE; """)
+    cursor.execute(""" SELECT setseed(0.42); """)
+    cursor.execute(""" INSERT INTO countries(country_name, country_lat,      \
+                                             country_lon)                    \
+                       SELECT 'Country ' || i,                               \
+                              ROUND((random() * 140 - 70)::NUMERIC, 4),      \
+                              ROUND((random() * 360 - 180)::NUMERIC, 4)      \
+                       FROM generate_series(1, %s) AS i; """, (countries,))
+    cursor.execute(""" INSERT INTO cities(country_id, city_name, city_lat,   \
+                                          city_lon)                          \
+                       SELECT country_id, 'City ' || j,                      \
+                              LEAST(GREATEST(country_lat + ROUND(            \
+                                  (random() * 10 - 5)::NUMERIC, 4), -90), 90),\
+                              LEAST(GREATEST(country_lon + ROUND(            \
+                                  (random() * 10 - 5)::NUMERIC, 4), -180),   \
+                                  180)                                       \
+                       FROM countries, generate_series(1, %s) AS j; """,
+                   (cities_per_country,))
+
+    per_city = max(temperatures // max(countries * cities_per_country, 1), 1)
+    cursor.execute(""" SELECT DATE_TRUNC('hour', LOCALTIMESTAMP); """)
+    last = cursor.fetchone()[0]
+    first = last - timedelta(hours=per_city - 1)
+
+    month = partitions.month_start(first)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = partitions.add_months(month, 1)
+    partitions.create_partitions(cursor, months)
+
+    cursor.execute(""" INSERT INTO temperatures(city_id, temp_value,         \
+                                                temp_timestamp)              \
+                       SELECT city_id,                                       \
+                              ROUND((random() * 60 - 20)::NUMERIC, 4),       \
+                              %s::timestamp - k * INTERVAL '1 hour'          \
+                       FROM cities, generate_series(0, %s) AS k; """,
+                   (last, per_city - 1))
+    cursor.execute(""" SELECT COUNT(*) FROM temperatures; """)
+    total = cursor.fetchone()[0]
+    cursor.close()
+    conn.commit()
+
+    rollups.rebuild(conn)
+
+    cursor = conn.cursor()
+    cursor.execute(""" ANALYZE; """)
+    cursor.close()
+    conn.commit()
+
+    return {"countries": countries,
+            "cities": countries * cities_per_country,
+            "temperatures": total,
+            "first_reading": first.isoformat(sep=" "),
+            "last_reading": last.isoformat(sep=" "),
+            "seed_seconds": round(perf_counter() - start, 3)}
+
+# Câte temperaturi sunt adăugate într-o tranzacție de seed_sqlite().
+SQLITE_SEED_BATCH = 10000
+
+def seed_sqlite(path, countries, cities_per_country, temperatures):
+    """
+    Creează o bază de date SQLite cu același fel de set sintetic ca seed(),
+    prin Storage API (vezi sqlite_storage.py).
+
+    Returns:
+        (dimensiunile setului și durata populării, id-urile țărilor, orașele
+        ca tupluri (id, lat, lon))
+    """
+    start = perf_counter()
+    rng = random.Random(0.42)
+    storage = SqliteStorage(path)
+    storage.open()
+
+    try:
+        country_rows = [("Country %d" % i, round(rng.uniform(-70, 70), 4),
+                         round(rng.uniform(-180, 180), 4))
+                        for i in range(1, countries + 1)]
+        with storage.transaction() as tx:
+            country_ids = [ident for _, ident
+                           in tx.add_countries(country_rows)]
+            city_rows = [
+                (country_id, "City %d" % j,
+                 min(max(round(lat + rng.uniform(-5, 5), 4), -90), 90),
+                 min(max(round(lon + rng.uniform(-5, 5), 4), -180), 180))
+                for country_id, (_, lat, lon) in zip(country_ids, country_rows)
+                for j in range(1, cities_per_country + 1)
+            ]
+            cities = [(ident, lat, lon) for (_, ident), (_, _, lat, lon)
+                      in zip(tx.add_cities(city_rows), city_rows)]
+            tx.commit()
+
+        per_city = max(temperatures // max(len(cities), 1), 1)
+        last = datetime.now().replace(minute=0, second=0, microsecond=0)
+        first = last - timedelta(hours=per_city - 1)
+
+        total = 0
+        readings = []
+        for index, (city_id, _, _) in enumerate(cities):
+            readings.extend((city_id, round(rng.uniform(-20, 40), 4),
+                             last - timedelta(hours=k))
+                            for k in range(per_city))
+            if len(readings) >= SQLITE_SEED_BATCH or \
+               index == len(cities) - 1:
+                with storage.transaction() as tx:
+                    total += sum(status == 201 for status, _
+                                 in tx.add_temperatures(readings))
+                    tx.commit()
+                readings = []
+    finally:
+        storage.close()
+
+    return ({"countries": countries,
+             "cities": len(cities),
+             "temperatures": total,
+             "first_reading": first.isoformat(sep=" "),
+             "last_reading": last.isoformat(sep=" "),
+             "seed_seconds": round(perf_counter() - start, 3)},
+            country_ids, cities)
+
+def postgres_ids(conn):
+    """
+    Returns:
+        (id-urile țărilor, orașele ca tupluri (id, lat, lon)) din baza de
+        date PostgreSQL
+    """
+    cursor = conn.cursor()
+    cursor.execute(""" SELECT country_id FROM countries; """)
+    countries = [row[0] for row in cursor.fetchall()]
+    cursor.execute(""" SELECT city_id, city_lat, city_lon FROM cities; """)
+    cities = cursor.fetchall()
+    cursor.close()
+    conn.rollback()
+    return countries, cities
+
+class Dataset:
+    """
+    Id-urile și coordonatele din baza de date, din care sunt construite
+    cererile, plus id-urile create de rutele POST, folosite apoi de PUT și
+    DELETE.
+    """
+    def __init__(self, countries, cities, first_reading, last_reading):
+        self.countries = countries
+        self.cities = cities
+
+        self.first_day = datetime.fromisoformat(first_reading).date()
+        self.last_day = datetime.fromisoformat(last_reading).date()
+        self.created = {"countries": [], "cities": [], "temperatures": [],
+                        "countries_batch": [], "cities_batch": []}
+        self._lock = threading.Lock()
+
+    def country(self):
+        """
+        Returns:
+            int: id-ul unei țări oarecare
+        """
+        return random.choice(self.countries)
+
+    def city(self):
+        """
+        Returns:
+            tuple: (id, lat, lon) al unui oraș oarecare
+        """
+        return random.choice(self.cities)
+
+    def day(self):
+        """
+        Returns:
+            str: o zi oarecare din intervalul temperaturilor
+        """
+        span = (self.last_day - self.first_day).days
+        return (self.first_day +
+                timedelta(days=random.randint(0, span))).isoformat()
+
+    def add(self, kind, ident):
+        """
+        Reține un id creat de o rută POST.
+        """
+        with self._lock:
+            self.created[kind].append(ident)
+
+    def pick(self, kind, remove=False):
+        """
+        Returns:
+            int: un id creat de o rută POST (scos din listă, dacă remove)
+            None: dacă nu mai există
+        """
+        with self._lock:
+            ids = self.created[kind]
+            if not ids:
+                return None
+            if remove:
+                return ids.pop()
+            return random.choice(ids)
+
+    def pick_many(self, kind, count, remove=False):
+        """
+        Returns:
+            list: cel mult count id-uri distincte create de o rută POST
+            (scoase din listă, dacă remove)
+            None: dacă nu mai există
+        """
+        with self._lock:
+            ids = self.created[kind]
+            if not ids:
+                return None
+            if remove:
+                taken = ids[-count:]
+                del ids[-count:]
+                return taken
+            return random.sample(ids, min(count, len(ids)))
+
+def _json(value):
+    """
+    Returns:
+        bytes: corpul JSON al unei cereri, cu cheile în ordinea dată
+    """
+    return json.dumps(value).encode()
+
+def _reading(data):
+    """
+    Returns:
+        dict: o temperatură pentru ruta de loturi, din ultima oră
+    """
+    moment = datetime.now() - timedelta(seconds=random.uniform(0, 3600))
+    return {"idOras": data.city()[0],
+            "valoare": round(random.uniform(-20, 40), 4),
+            "timestamp": moment.isoformat()}
+
+def _created(kind):
+    """
+    Returns:
+        funcția care reține id-ul întors de o rută POST
+    """
+    def record(data, status, body):
+        if status == 201:
+            data.add(kind, json.loads(body)["id"])
+    return record
+
+def _created_batch(kind):
+    """
+    Returns:
+        funcția care reține id-urile întoarse de o rută POST de tip lot
+    """
+    def record(data, status, body):
+        if status == 200:
+            for item in json.loads(body):
+                if item["status"] == 201:
+                    data.add(kind, item["id"])
+    return record
+
+def _place(country=None):
+    """
+    Returns:
+        dict: o țară sau, cu id-ul unei țări, un oraș, cu nume unic
+    """
+    place = {"nume": "Bench %s" % uuid.uuid4().hex,
+             "lat": round(random.uniform(-70, 70), 4),
+             "lon": round(random.uniform(-180, 180), 4)}
+    if country is not None:
+        place["idTara"] = country
+    return place
+
+def _ids(ids):
+    """
+    Returns:
+        str: id-urile, pentru parametrul „ids”
+    """
+    return ",".join(str(ident) for ident in ids)
+
+# Rutele, în ordinea rulării: (nume, funcție care întoarce (metodă, cale,
+# corp) sau None dacă nu mai sunt cereri de trimis, funcție apelată cu
+# răspunsul sau None). Rutele de scriere rulează după cele de citire, iar
+# PUT și DELETE folosesc ce au creat rutele POST. Din fluxul de evenimente
+# (temp_stream_get) se citește doar primul mesaj (vezi run_route()).
+ROUTES = [
+    ("countries_get", lambda d: ("GET", "/api/countries", None), None),
+    ("countries_ids_get", lambda d: (
+        "GET", "/api/countries?ids=%s" % _ids(
+            random.sample(d.countries, min(10, len(d.countries)))), None),
+     None),
+    ("cities_get", lambda d: ("GET", "/api/cities?limit=100", None), None),
+    ("cities_ids_get", lambda d: (
+        "GET", "/api/cities?ids=%s" % _ids(
+            city[0] for city in random.sample(d.cities,
+                                              min(10, len(d.cities)))),
+        None), None),
+    ("cities_by_country_get", lambda d: (
+        "GET", "/api/cities/country/%d" % d.country(), None), None),
+    ("cities_nearest_get", lambda d: (
+        "GET", "/api/cities/nearest?lat=%.4f&lon=%.4f&k=10" %
+        d.city()[1:], None), None),
+    ("temp_get", lambda d: ("GET", "/api/temperatures?limit=100", None),
+     None),
+    ("temp_get_day", lambda d: (
+        "GET", "/api/temperatures?from=%s&until=%s&limit=1000" %
+        ((d.day(),) * 2), None), None),
+    ("temp_by_city_get", lambda d: (
+        "GET", "/api/temperatures/cities/%d?limit=1000" % d.city()[0], None),
+     None),
+    ("temp_by_country_get", lambda d: (
+        "GET", "/api/temperatures/countries/%d?limit=1000" % d.country(),
+        None), None),
+    ("temp_near_get", lambda d: (
+        "GET", "/api/temperatures/near?lat=%.4f&lon=%.4f&radius_km=50&"
+        "limit=1000" % d.city()[1:], None), None),
+    ("temp_stats_get", lambda d: (
+        "GET", "/api/temperatures/stats?bucket=day&city=%d" % d.city()[0],
+        None), None),
+    ("temp_stats_raw_get", lambda d: (
+        "GET", "/api/temperatures/stats?bucket=hour&city=%d&"
+        "from=%sT00:00:00" % (d.city()[0], d.day()), None), None),
+    ("temp_latest_get", lambda d: ("GET", "/api/temperatures/latest", None),
+     None),
+    ("temp_latest_by_country_get", lambda d: (
+        "GET", "/api/temperatures/latest?country=%d" % d.country(), None),
+     None),
+    ("temp_stream_get", lambda d: ("GET", "/api/temperatures/stream", None),
+     None),
+    ("pool_stats_get", lambda d: ("GET", "/api/pool/stats", None), None),
+    ("cache_stats_get", lambda d: ("GET", "/api/cache/stats", None), None),
+    ("stream_stats_get", lambda d: ("GET", "/api/stream/stats", None), None),
+    ("admission_stats_get", lambda d: ("GET", "/api/admission/stats", None),
+     None),
+    ("metrics_get", lambda d: ("GET", "/metrics", None), None),
+
+    ("countries_post", lambda d: (
+        "POST", "/api/countries", _json({
+            "nume": "Bench %s" % uuid.uuid4().hex,
+            "lat": round(random.uniform(-70, 70), 4),
+            "lon": round(random.uniform(-180, 180), 4)})),
+     _created("countries")),
+    ("cities_post", lambda d: (
+        "POST", "/api/cities", _json({
+            "idTara": d.country(), "nume": "Bench %s" % uuid.uuid4().hex,
+            "lat": round(random.uniform(-70, 70), 4),
+            "lon": round(random.uniform(-180, 180), 4)})),
+     _created("cities")),
+    ("temp_post", lambda d: (
+        "POST", "/api/temperatures", _json({
+            "idOras": d.city()[0],
+            "valoare": round(random.uniform(-20, 40), 4)})),
+     _created("temperatures")),
+    ("temp_batch_post", lambda d: (
+        "POST", "/api/temperatures/batch",
+        _json([_reading(d) for _ in range(100)])), None),
+    ("countries_batch_post", lambda d: (
+        "POST", "/api/countries/batch", _json([_place() for _ in range(100)])),
+     _created_batch("countries_batch")),
+    ("cities_batch_post", lambda d: (
+        "POST", "/api/cities/batch",
+        _json([_place(d.country()) for _ in range(100)])),
+     _created_batch("cities_batch")),
+
+    ("countries_put", lambda d: (lambda ident: ident and (
+        "PUT", "/api/countries/%d" % ident, _json({
+            "id": ident, "nume": "Bench %s" % uuid.uuid4().hex,
+            "lat": round(random.uniform(-70, 70), 4),
+            "lon": round(random.uniform(-180, 180), 4)})))(
+                d.pick("countries")), None),
+    ("cities_put", lambda d: (lambda ident: ident and (
+        "PUT", "/api/cities/%d" % ident, _json({
+            "id": ident, "idTara": d.country(),
+            "nume": "Bench %s" % uuid.uuid4().hex,
+            "lat": round(random.uniform(-70, 70), 4),
+            "lon": round(random.uniform(-180, 180), 4)})))(
+                d.pick("cities")), None),
+    ("temp_put", lambda d: (lambda ident: ident and (
+        "PUT", "/api/temperatures/%d" % ident, _json({
+            "id": ident, "idOras": d.city()[0],
+            "valoare": round(random.uniform(-20, 40), 4)})))(
+                d.pick("temperatures")), None),
+    ("countries_batch_put", lambda d: (lambda ids: ids and (
+        "PUT", "/api/countries/batch", _json([
+            dict(_place(), id=ident) for ident in ids])))(
+                d.pick_many("countries_batch", 100)), None),
+    ("cities_batch_put", lambda d: (lambda ids: ids and (
+        "PUT", "/api/cities/batch", _json([
+            dict(_place(d.country()), id=ident) for ident in ids])))(
+                d.pick_many("cities_batch", 100)), None),
+
+    ("temp_del", lambda d: (lambda ident: ident and (
+        "DELETE", "/api/temperatures/%d" % ident, None))(
+            d.pick("temperatures", remove=True)), None),
+    ("cities_del", lambda d: (lambda ident: ident and (
+        "DELETE", "/api/cities/%d" % ident, None))(
+            d.pick("cities", remove=True)), None),
+    ("countries_del", lambda d: (lambda ident: ident and (
+        "DELETE", "/api/countries/%d" % ident, None))(
+            d.pick("countries", remove=True)), None),
+    ("cities_batch_del", lambda d: (lambda ids: ids and (
+        "DELETE", "/api/cities/batch", _json(ids)))(
+            d.pick_many("cities_batch", 100, remove=True)), None),
+    ("countries_batch_del", lambda d: (lambda ids: ids and (
+        "DELETE", "/api/countries/batch", _json(ids)))(
+            d.pick_many("countries_batch", 100, remove=True)), None),
+]
+
+def percentile(sorted_values, fraction):
+    """
+    Returns:
+        float: percentila dată a unei liste sortate (cel mai apropiat rang)
+    """
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * len(sorted_values) + 0.5)) - 1,
+                len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+def run_route(port, data, make_request, on_response, concurrency, duration):
+    """
+    Trimite cereri unei rute, din concurrency fire de execuție cu conexiuni
+    keep-alive, timp de duration secunde sau până nu mai sunt cereri. Un
+    flux de evenimente (text/event-stream) nu se termină: se citește doar
+    primul mesaj, apoi conexiunea este închisă.
+
+    Returns:
+        dict: latențele (ms), throughput-ul și codurile de răspuns
+    """
+    latencies = []
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    deadline = monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        own = []
+        own_statuses = {}
+        while monotonic() < deadline:
+            request = make_request(data)
+            if request is None:
+                break
+            method, path, body = request
+            headers = {"Content-Type": "application/json"} if body else {}
+            start = perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                stream = response.getheader("Content-Type", "").startswith(
+                    "text/event-stream")
+                if stream:
+                    payload = b""
+                    while not payload.endswith(b"\n\n"):
+                        line = response.readline()
+                        if not line:
+                            break
+                        payload += line
+                else:
+                    payload = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                with lock:
+                    errors.append(repr(err))
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port,
+                                                  timeout=60)
+                continue
+            own.append((perf_counter() - start) * 1000)
+            own_statuses[response.status] = \
+                own_statuses.get(response.status, 0) + 1
+            if on_response is not None:
+                on_response(data, response.status, payload)
+            if stream:
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port,
+                                                  timeout=60)
+        conn.close()
+        with lock:
+            latencies.extend(own)
+            for status, count in own_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1)
+                          if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) or 0, 3),
+            "p95": round(percentile(latencies, 0.95) or 0, 3),
+            "p99": round(percentile(latencies, 0.99) or 0, 3),
+            "mean": round(sum(latencies) / len(latencies), 3)
+                    if latencies else 0.0,
+            "max": round(latencies[-1], 3) if latencies else 0.0,
+        },
+        "status_codes": {str(status): count for status, count
+                         in sorted(statuses.items())},
+        "client_errors": len(errors),
+    }
+
+def process_tree_rss_kb(pid):
+    """
+    Returns:
+        int: memoria rezidentă (KiB) a procesului dat și a descendenților lui
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open("/proc/%d/status" % current) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            for task in os.listdir("/proc/%d/task" % current):
+                with open("/proc/%d/task/%s/children" % (current, task)) \
+                     as children:
+                    pending.extend(int(child) for child
+                                   in children.read().split())
+        except OSError:
+            continue
+    return total
+
+class MemorySampler:
+    """
+    Măsoară periodic memoria serverului, într-un fir de execuție separat.
+    """
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss_kb(self.pid))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Pornește măsurarea.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Oprește măsurarea.
+        """
+        self._stop.set()
+        self._thread.join()
+
+def postgres_settings(dsn_params):
+    """
+    Returns:
+        dict: variabilele de mediu cu care serverul folosește baza de date
+        PostgreSQL dată
+    """
+    settings = {"POSTGRES_HOST": "localhost"}
+    for key, name in (("host", "POSTGRES_HOST"), ("port", "POSTGRES_PORT"),
+                      ("dbname", "POSTGRES_DB"), ("user", "POSTGRES_USER"),
+                      ("password", "POSTGRES_PASSWORD")):
+        if key in dsn_params:
+            settings[name] = dsn_params[key]
+    return settings
+
+def start_server(settings, port, mode, workers):
+    """
+    Pornește server.py într-un proces separat și așteaptă să răspundă.
+
+    Args:
+        settings - variabilele de mediu ale stocării (vezi
+            postgres_settings()).
+    Returns:
+        subprocess.Popen: procesul serverului
+    """
+    env = dict(os.environ, **settings)
+    # Fluxurile de evenimente ale clienților plecați sunt închise la
+    # următorul mesaj; altfel, ar rămâne deschise până la 15 secunde.
+    env.setdefault("TEMP_STREAM_HEARTBEAT", "1")
+    env.update(WEB_SERVICE_ADDR="127.0.0.1", WEB_SERVICE_PORT=str(port),
+               WEB_SERVICE_SERVER=mode, WEB_SERVICE_WORKERS=str(workers),
+               FLASK_ENV="production")
+    process = subprocess.Popen([sys.executable, "server.py"], cwd=SERVER_DIR,
+                               env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+
+    deadline = monotonic() + 60
+    while monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("Serverul s-a oprit la pornire.")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/api/pool/stats")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process
+        except OSError:
+            pass
+        sleep(0.2)
+
+    stop_server(process)
+    raise SystemExit("Serverul nu a pornit în 60 de secunde.")
+
+def stop_server(process):
+    """
+    Oprește serverul, împreună cu procesele pornite de el (workerii sau
+    procesul de reîncărcare din modul debug).
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(60)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+def git_revision():
+    """
+    Returns:
+        str: commit-ul curent al depozitului, dacă se poate afla
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=SERVER_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline):
+    """
+    Adaugă în raport raportul dintre latențele p50 / p99 și throughput-ul
+    actuale și cele din raportul de referință (peste 1 înseamnă mai lent).
+    """
+    for name, result in report["routes"].items():
+        old = baseline.get("routes", {}).get(name)
+        if not old or not old["latency_ms"]["p50"] or \
+           not old["throughput_rps"]:
+            continue
+        result["vs_baseline"] = {
+            "p50": round(result["latency_ms"]["p50"] /
+                         old["latency_ms"]["p50"], 2),
+            "p99": round(result["latency_ms"]["p99"] /
+                         max(old["latency_ms"]["p99"], 1e-9), 2),
+            "throughput": round(result["throughput_rps"] /
+                                old["throughput_rps"], 2),
+        }
+
+def main():
+    """
+    Populează baza de date, pornește serverul, rulează rutele și scrie
+    raportul.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dsn", help="baza de date PostgreSQL folosită; "
+                                      "tabelele ei sunt golite")
+    source.add_argument("--initdb", action="store_true",
+                        help="creează o bază de date de unică folosință")
+    source.add_argument("--sqlite", action="store_true",
+                        help="folosește stocarea SQLite, într-un fișier "
+                             "temporar")
+    parser.add_argument("--pg-bin", help="directorul cu initdb și pg_ctl")
+    parser.add_argument("--countries", type=int, default=50)
+    parser.add_argument("--cities-per-country", type=int, default=20)
+    parser.add_argument("--temperatures", type=int, default=1000000)
+    parser.add_argument("--no-seed", action="store_true",
+                        help="folosește datele deja existente")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="secunde pentru fiecare rută")
+    parser.add_argument("--routes", help="rutele rulate, separate prin "
+                                         "virgulă (implicit, toate)")
+    parser.add_argument("--server", choices=("debug", "gevent"),
+                        default="gevent")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--output", help="fișierul raportului (implicit, "
+                                         "stdout)")
+    parser.add_argument("--baseline", help="raportul unei versiuni "
+                                           "anterioare, de comparat")
+    args = parser.parse_args()
+    if args.sqlite and args.no_seed:
+        parser.error("--no-seed nu se poate folosi cu --sqlite")
+
+    selected = set(args.routes.split(",")) if args.routes else None
+    random.seed(42)
+
+    postgres = ThrowawayPostgres(args.pg_bin) if args.initdb else None
+    directory = tempfile.mkdtemp(prefix="benchmark-sqlite-") \
+                if args.sqlite else None
+    process = None
+    # Cu SQLite, serverul rulează într-un singur proces.
+    workers = 1 if args.sqlite else args.workers
+
+    try:
+        if args.sqlite:
+            path = os.path.join(directory, "web_service.db")
+            dataset, countries, cities = seed_sqlite(
+                path, args.countries, args.cities_per_country,
+                args.temperatures)
+            settings = {"WEB_SERVICE_STORAGE": "sqlite", "SQLITE_PATH": path}
+        else:
+            dsn = postgres.start() if postgres else args.dsn
+            conn = psycopg2.connect(dsn)
+            if args.no_seed:
+                cursor = conn.cursor()
+                cursor.execute(""" SELECT COUNT(*), MIN(temp_timestamp),     \
+                                   MAX(temp_timestamp)                       \
+                                   FROM temperatures; """)
+                total, first, last = cursor.fetchone()
+                cursor.close()
+                conn.rollback()
+                dataset = {"temperatures": total,
+                           "first_reading": first.isoformat(sep=" "),
+                           "last_reading": last.isoformat(sep=" ")}
+            else:
+                dataset = seed(conn, args.countries, args.cities_per_country,
+                               args.temperatures)
+            countries, cities = postgres_ids(conn)
+            conn.close()
+            settings = postgres_settings(psycopg2.extensions.parse_dsn(dsn))
+        data = Dataset(countries, cities, dataset["first_reading"],
+                       dataset["last_reading"])
+
+        port = free_port()
+        process = start_server(settings, port, args.server, workers)
+        memory_start = process_tree_rss_kb(process.pid)
+        sampler = MemorySampler(process.pid)
+        sampler.start()
+
+        routes = {}
+        for name, make_request, on_response in ROUTES:
+            if selected is not None and name not in selected:
+                continue
+            routes[name] = run_route(port, data, make_request, on_response,
+                                     args.concurrency, args.duration)
+            print("%-24s %8.1f req/s  p50 %8.3f ms  p99 %8.3f ms" % (
+                name, routes[name]["throughput_rps"],
+                routes[name]["latency_ms"]["p50"],
+                routes[name]["latency_ms"]["p99"]), file=sys.stderr)
+
+        sampler.stop()
+        report = {
+            "revision": git_revision(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "config": {"server": args.server, "workers": workers,
+                       "concurrency": args.concurrency,
+                       "duration": args.duration,
+                       "database": "initdb" if postgres else
+                                   "sqlite" if args.sqlite else "dsn"},
+            "dataset": dataset,
+            "routes": routes,
+            "server_memory_kb": {
+                "start": memory_start,
+                "peak": max(sampler.peak, memory_start),
+                "end": process_tree_rss_kb(process.pid),
+            },
+        }
+    finally:
+        if process is not None:
+            stop_server(process)
+        if postgres is not None:
+            postgres.stop()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(report, json.load(baseline))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=4)
+            output.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
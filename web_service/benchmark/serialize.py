@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+
+Compară vechea cale de serializare a temperaturilor (RealDictCursor, Decimal,
+DecimalEncoder) cu cea nouă (tupluri, NUMERIC citit direct ca float,
+RowEncoder) pe un răspuns de ROWS rânduri.
+
+Fără --dsn, rândurile sunt generate în memorie ca text, așa cum le primește
+psycopg2 de la server, și se măsoară conversia și serializarea. Cu --dsn,
+rândurile sunt citite dintr-un generate_series pe serverul PostgreSQL dat.
+
+Utilizare: python -m benchmark.serialize [--rows N] [--dsn DSN]
+"""
+
+from decimal import Decimal
+from time import perf_counter
+
+import argparse
+import json
+import sys
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor
+
+import serialization
+
+COLUMNS = ("city_id", "temp_id", "temp_value", "temp_timestamp")
+
+QUERY = """ SELECT i %% 1000 AS city_id, i AS temp_id,                        \
+            ((i %% 10000) / 100.0)::NUMERIC(6, 4) AS temp_value,             \
+            TO_CHAR(TIMESTAMP '2020-01-01' + i * INTERVAL '1 minute',        \
+                    'YYYY-MM-DD HH:MI:SS') AS temp_timestamp                 \
+            FROM generate_series(1, %s) AS i; """
+
+class DecimalEncoder(json.JSONEncoder):
+    """
+    Encoderul folosit înainte de serialization.RowEncoder.
+    """
+    def default(self, obj):
+        """
+        Convertește Decimal în float.
+        """
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return json.JSONEncoder.default(self, obj)
+
+# Echivalentul lui cursor.description: (nume, OID tip).
+DESCRIPTION = [("city_id", 23), ("temp_id", 23), ("temp_value", 1700),
+               ("temp_timestamp", 25)]
+
+def synthetic_rows(count):
+    """
+    Returns:
+        list: rândurile, cu valorile în formatul text primit de la server
+    """
+    return [(str(i % 1000), str(i), "%.4f" % ((i % 10000) / 100.0),
+             "2020-01-01 10:%02d:00" % (i % 60)) for i in range(count)]
+
+def old_path_memory(rows):
+    """
+    Vechea cale: un dicționar pe rând, Decimal, json.dumps cu DecimalEncoder.
+    """
+    results = [dict(zip(COLUMNS, (int(city), int(temp), Decimal(value), ts)))
+               for city, temp, value, ts in rows]
+    return json.dumps(results, cls=DecimalEncoder).encode()
+
+def new_path_memory(rows):
+    """
+    Noua cale: tupluri cu float, serializate de RowEncoder.
+    """
+    results = [(int(city), int(temp), float(value), ts)
+               for city, temp, value, ts in rows]
+    return serialization.RowEncoder(DESCRIPTION).encode_list(results)
+
+def old_path_db(conn, count):
+    """
+    Vechea cale, pe o conexiune la care NUMERIC este citit ca Decimal.
+    """
+    psycopg2.extensions.register_type(psycopg2.extensions.DECIMAL, conn)
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(QUERY, (count,))
+    body = json.dumps(cursor.fetchall(), cls=DecimalEncoder).encode()
+    cursor.close()
+    return body
+
+def new_path_db(conn, count):
+    """
+    Noua cale, pe o conexiune la care NUMERIC este citit ca float.
+    """
+    cursor = conn.cursor()
+    cursor.execute(QUERY, (count,))
+    body = serialization.RowEncoder(cursor.description).encode_list(
+        cursor.fetchall())
+    cursor.close()
+    return body
+
+def measure(func, *args):
+    """
+    Returns:
+        (secunde, octeți) - durata unui apel și dimensiunea răspunsului
+    """
+    start = perf_counter()
+    body = func(*args)
+    return perf_counter() - start, len(body)
+
+def main():
+    """
+    Rulează cele două căi și scrie rezultatele ca JSON pe stdout.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--dsn", help="conexiunea PostgreSQL, opțională")
+    args = parser.parse_args()
+
+    serialization.register_numeric_as_float()
+
+    if args.dsn:
+        old_conn = psycopg2.connect(args.dsn)
+        new_conn = psycopg2.connect(args.dsn)
+        old = measure(old_path_db, old_conn, args.rows)
+        new = measure(new_path_db, new_conn, args.rows)
+        old_conn.close()
+        new_conn.close()
+    else:
+        rows = synthetic_rows(args.rows)
+        old = measure(old_path_memory, rows)
+        new = measure(new_path_memory, rows)
+
+    report = {
+        "rows": args.rows,
+        "source": "postgres" if args.dsn else "memory",
+        "encoder": "orjson" if serialization.orjson else "template",
+        "old": {"seconds": round(old[0], 3), "bytes": old[1],
+                "rows_per_second": round(args.rows / old[0])},
+        "new": {"seconds": round(new[0], 3), "bytes": new[1],
+                "rows_per_second": round(args.rows / new[0])},
+        "speedup": round(old[0] / new[0], 2),
+    }
+    json.dump(report, sys.stdout, indent=4)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
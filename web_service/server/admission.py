@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from collections import OrderedDict
+from math import ceil
+from time import monotonic
+
+import threading
+
+from metrics import METRICS
+
+def parse_limits(text):
+    """
+    Returns:
+        dict: clasă -> (limită, coadă), din textul „clasă=limită:coadă”,
+        cu mai multe clase separate prin „;” (de exemplu,
+        „/api/temperatures/batch=4:16;heavy=2:8”)
+    Raises:
+        ValueError, dacă textul nu are acest format
+    """
+    limits = {}
+    for item in text.split(";"):
+        if not item.strip():
+            continue
+        klass, _, spec = item.rpartition("=")
+        limit, _, queue = spec.partition(":")
+        limits[klass.strip()] = (int(limit), int(queue or "0"))
+    return limits
+
+class TokenBuckets:
+    """
+    Limita de rată a fiecărui client, ca găleată de jetoane: un client
+    primește rate jetoane pe secundă, cel mult burst adunate, iar fiecare
+    cerere consumă un jeton.
+
+    Sunt ținute cel mult max_clients găleți; cele folosite cel mai demult
+    sunt uitate (un client uitat o ia de la capăt, cu găleata plină).
+    """
+    def __init__(self, rate, burst, max_clients=100000):
+        """
+        Args:
+            rate - jetoane pe secundă.
+            burst - numărul maxim de jetoane adunate.
+            max_clients - numărul maxim de clienți ținuți minte.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        # Clientul -> [jetoane, momentul ultimei actualizări].
+        self._buckets = OrderedDict()
+
+    def take(self, client):
+        """
+        Consumă un jeton al clientului.
+
+        Returns:
+            0, dacă cererea poate continua, altfel numărul de secunde până la
+            următorul jeton
+        """
+        now = monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = [self.burst, now]
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+                bucket[0] = min(self.burst,
+                                bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+    def stats(self):
+        """
+        Returns:
+            dict cu limita și numărul de clienți ținuți minte
+        """
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst,
+                    "clients": len(self._buckets)}
+
+class ConcurrencyLimit:
+    """
+    Numărul maxim de cereri rulate simultan dintr-o clasă, cu o coadă
+    limitată pentru cele care așteaptă: o cerere care găsește coada plină
+    sau care așteaptă mai mult de timeout secunde este refuzată imediat, în
+    loc să aștepte în baza de date.
+    """
+    def __init__(self, name, limit, queue, timeout):
+        """
+        Args:
+            name - numele clasei, pentru metrici.
+            limit - numărul maxim de cereri rulate simultan.
+            queue - numărul maxim de cereri care așteaptă.
+            timeout - cât așteaptă o cerere, în secunde.
+        """
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waiting = 0
+
+        self._admitted = 0
+        self._queued = 0
+        self._rejected = 0
+        self._timeouts = 0
+
+    def acquire(self):
+        """
+        Returns:
+            None, dacă cererea poate rula (și trebuie apelată release() la
+            final), altfel motivul refuzului: „queue_full” sau „timeout”
+        """
+        with self._cond:
+            if self._running < self.limit and not self._waiting:
+                self._running += 1
+                self._admitted += 1
+                return None
+
+            if self._waiting >= self.queue:
+                self._rejected += 1
+                return "queue_full"
+
+            start = monotonic()
+            deadline = start + self.timeout
+            self._waiting += 1
+            self._queued += 1
+            try:
+                while self._running >= self.limit:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        return "timeout"
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+            self._running += 1
+            self._admitted += 1
+
+        METRICS.observe("http_admission_wait_seconds",
+                        (("class", self.name),), monotonic() - start)
+        return None
+
+    def release(self):
+        """
+        Eliberează locul unei cereri admise.
+        """
+        with self._cond:
+            self._running -= 1
+            # Toți cei care așteaptă verifică locul, pentru că unii dintre
+            # ei pot să fi renunțat deja.
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+            dict cu starea limitei
+        """
+        with self._cond:
+            return {"limit": self.limit, "queue": self.queue,
+                    "running": self._running, "waiting": self._waiting,
+                    "admitted": self._admitted, "queued": self._queued,
+                    "rejected": self._rejected, "timeouts": self._timeouts}
+
+class AdmissionMiddleware:
+    """
+    Middleware WSGI care admite sau refuză cererile înainte de a ajunge la
+    aplicație:
+
+    * fiecare client (adresa lui sau antetul client_header) are o limită de
+      rată; peste ea, cererea primește 429;
+    * fiecare clasă de cereri (o rută sau un grup de interogări scumpe) are
+      o limită de concurență, cu coada ei; peste ea, cererea primește 503.
+
+    Ambele răspunsuri au antetul Retry-After. Limitele sunt ale fiecărui
+    proces. Locul unei cereri admise este eliberat după ultimul octet al
+    răspunsului, deci și fluxurile lungi sunt numărate.
+    """
+    def __init__(self, app, classify, rate_limit=None, limits=None,
+                 default_limit=None, queue_timeout=1.0, client_header=None):
+        """
+        Args:
+            app - aplicația WSGI.
+            classify - funcție care primește environ și întoarce clasa
+                cererii (șir), None pentru cererile fără limită de
+                concurență sau False pentru cererile exceptate de la orice
+                limită.
+            rate_limit - TokenBuckets sau None.
+            limits - dicționar clasă -> (limită, coadă) pentru clasele cu
+                limite proprii.
+            default_limit - (limită, coadă) pentru celelalte clase sau
+                None, pentru a nu le limita.
+            queue_timeout - cât așteaptă o cerere în coada clasei, în
+                secunde.
+            client_header - antetul care identifică clientul (de exemplu,
+                X-Forwarded-For, în spatele unui proxy); None folosește
+                adresa conexiunii.
+        """
+        self.app = app
+        self.classify = classify
+        self.rate_limit = rate_limit
+        self._specs = dict(limits or {})
+        self.default_limit = default_limit
+        self.client_header = client_header
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._limits = {}
+
+    def _limit(self, klass):
+        """
+        Returns:
+            ConcurrencyLimit: limita clasei, creată la prima folosire
+            None: dacă clasa nu este limitată
+        """
+        limit = self._limits.get(klass)
+        if limit is None:
+            spec = self._specs.get(klass, self.default_limit)
+            if spec is None or spec[0] <= 0:
+                return None
+            with self._lock:
+                limit = self._limits.setdefault(
+                    klass, ConcurrencyLimit(klass, spec[0], spec[1],
+                                            self.queue_timeout))
+        return limit
+
+    def _client(self, environ):
+        """
+        Returns:
+            str: identitatea clientului cererii
+        """
+        if self.client_header:
+            value = environ.get("HTTP_" + self.client_header.upper()
+                                .replace("-", "_"))
+            if value:
+                return value.split(",", 1)[0].strip()
+        return environ.get("REMOTE_ADDR", "")
+
+    @staticmethod
+    def _reject(start_response, status, retry_after, klass, reason):
+        """
+        Refuză cererea, fără a o trimite aplicației.
+        """
+        METRICS.inc("http_admission_rejected_total",
+                    (("class", klass or ""), ("reason", reason)))
+        start_response(status, [("Retry-After", str(retry_after)),
+                                ("Content-Length", "0")])
+        return []
+
+    def __call__(self, environ, start_response):
+        klass = self.classify(environ)
+        if klass is False:
+            return self.app(environ, start_response)
+
+        if self.rate_limit is not None:
+            wait = self.rate_limit.take(self._client(environ))
+            if wait:
+                return self._reject(start_response, "429 Too Many Requests",
+                                    max(int(ceil(wait)), 1), klass,
+                                    "rate_limit")
+
+        limit = self._limit(klass) if klass is not None else None
+        if limit is None:
+            return self.app(environ, start_response)
+
+        reason = limit.acquire()
+        if reason is not None:
+            return self._reject(start_response, "503 Service Unavailable",
+                                1, klass, reason)
+
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            limit.release()
+            raise
+        return _AdmittedBody(body, limit.release)
+
+    def stats(self):
+        """
+        Returns:
+            dict cu limita de rată și starea limitei fiecărei clase folosite
+        """
+        with self._lock:
+            limits = dict(self._limits)
+        return {
+            "rate_limit": self.rate_limit.stats()
+                          if self.rate_limit is not None else None,
+            "classes": {klass: limit.stats()
+                        for klass, limit in sorted(limits.items())},
+        }
+
+class _AdmittedBody:
+    """
+    Corpul răspunsului unei cereri admise; locul cererii este eliberat o
+    singură dată, după ultimul octet sau la închidere, dacă aceasta vine
+    mai devreme.
+    """
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+
+    def __iter__(self):
+        for chunk in self._body:
+            yield chunk
+        self._release()
+
+    def _release(self):
+        """
+        Eliberează locul cererii, dacă nu a fost deja eliberat.
+        """
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+    def close(self):
+        """
+        Închide corpul și eliberează locul cererii.
+        """
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            self._release()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from collections import OrderedDict, namedtuple
+
+import hashlib
+import threading
+
+# Un răspuns serializat, împreună cu ETag-ul lui (fără ghilimele) și
+# token-ul paginii următoare (sau None). Antetul Link nu este păstrat, fiind
+# construit pentru fiecare cerere, cu adresa și parametrii ei.
+CachedResponse = namedtuple("CachedResponse", ["body", "etag", "next_cursor"])
+
+class ResponseCache:
+    """
+    Cache în memorie pentru răspunsurile serializate ale rutelor de citire.
+
+    Intrările sunt grupate pe spații de nume (de exemplu „countries” sau
+    „cities/country/3”), iar o scriere invalidează exact spațiile afectate.
+    Fiecare spațiu are un număr de generație, mărit la invalidare: un răspuns
+    calculat din date citite înaintea unei invalidări nu mai este păstrat.
+    Numărul total de intrări este limitat, cele mai vechi folosite fiind
+    eliminate primele.
+    """
+    def __init__(self, max_entries):
+        """
+        Args:
+            max_entries - numărul maxim de răspunsuri păstrate; 0 dezactivează
+                cache-ul.
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        # Mărită de clear(), care invalidează toate spațiile de nume.
+        self._epoch = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def generation(self, namespace):
+        """
+        Returns:
+            generația curentă a spațiului de nume, de dat lui put()
+        """
+        with self._lock:
+            return self._epoch, self._generations.get(namespace, 0)
+
+    def get(self, namespace, key):
+        """
+        Returns:
+            CachedResponse: răspunsul păstrat
+            None: dacă nu există
+        """
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end((namespace, key))
+            self._hits += 1
+            return entry
+
+    def put(self, namespace, key, generation, body, next_cursor=None):
+        """
+        Păstrează un răspuns, dacă spațiul de nume nu a fost invalidat între
+        timp.
+
+        Args:
+            namespace - spațiul de nume.
+            key - cheia răspunsului în spațiul de nume.
+            generation - generația citită cu generation() înainte de a
+                interoga baza de date.
+            body - corpul răspunsului (bytes).
+            next_cursor - token-ul paginii următoare, dacă există.
+        Returns:
+            CachedResponse: răspunsul, cu ETag-ul calculat
+        """
+        entry = CachedResponse(body, hashlib.sha1(body).hexdigest(),
+                               next_cursor)
+
+        with self._lock:
+            if self.max_entries <= 0 or generation != \
+               (self._epoch, self._generations.get(namespace, 0)):
+                return entry
+
+            self._entries[(namespace, key)] = entry
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def invalidate(self, *namespaces):
+        """
+        Șterge răspunsurile din spațiile de nume date.
+        """
+        namespaces = set(namespaces)
+
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] = \
+                    self._generations.get(namespace, 0) + 1
+            for entry_key in [entry_key for entry_key in self._entries
+                              if entry_key[0] in namespaces]:
+                del self._entries[entry_key]
+            self._invalidations += 1
+
+    def clear(self):
+        """
+        Șterge toate răspunsurile (de exemplu, după ce unele invalidări ar fi
+        putut fi pierdute).
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._invalidations += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict cu starea curentă a cache-ului
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+            }
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic
+
+import os
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+def connection_params():
+    """
+    Returns:
+        dict: argumentele pentru psycopg2.connect(), luate din variabilele de
+        mediu ale containerului
+    """
+    return {
+        "host": os.getenv("POSTGRES_HOST", "db"),
+        "port": int(os.getenv("POSTGRES_PORT", "5432")),
+        "database": os.getenv("POSTGRES_DB", "postgres"),
+        "user": os.getenv("POSTGRES_USER", "admin"),
+        "password": os.getenv("POSTGRES_PASSWORD", "adminpass"),
+    }
+
+class PoolTimeout(Exception):
+    """
+    Nu s-a putut obține o conexiune din pool în timpul de așteptare permis.
+    """
+
+class ConnectionPool:
+    """
+    Pool de conexiuni PostgreSQL sigur pentru thread-uri și greenlet-uri.
+
+    Conexiunile sunt create leneș, până la maxconn. O conexiune care a stat
+    nefolosită mai mult de check_interval secunde (sau care a fost deschisă
+    înainte ca o altă conexiune să fie găsită stricată) este verificată cu un
+    „SELECT 1” la predare și înlocuită dacă baza de date a fost repornită.
+    """
+    def __init__(self, minconn, maxconn, timeout=5.0, check_interval=30.0,
+                 **conn_kwargs):
+        """
+        Args:
+            minconn - numărul de conexiuni deschise la pornire.
+            maxconn - numărul maxim de conexiuni deschise simultan.
+            timeout - câte secunde așteaptă getconn() o conexiune liberă.
+            check_interval - după câte secunde de inactivitate se verifică o
+                conexiune înainte de a fi predată.
+            conn_kwargs - argumentele pentru psycopg2.connect().
+        """
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Dimensiuni invalide pentru pool.")
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._conn_kwargs = conn_kwargs
+
+        self._cond = threading.Condition()
+        # Stivă de (conexiune, momentul ultimei folosiri); LIFO, pentru ca
+        # aceleași conexiuni „calde” să fie refolosite.
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._broken_at = 0.0
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        """
+        Deschide o conexiune nouă.
+        """
+        return psycopg2.connect(**self._conn_kwargs)
+
+    @staticmethod
+    def _ping(conn):
+        """
+        Verifică dacă o conexiune mai este utilizabilă.
+
+        Returns:
+            True, dacă serverul a răspuns
+            False, altfel
+        """
+        if conn.closed:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def fill(self):
+        """
+        Deschide conexiuni până se atinge minconn.
+        """
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+            with self._cond:
+                self._idle.append((conn, monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        """
+        Scoate o conexiune din pool, așteptând cel mult self.timeout secunde.
+
+        Returns:
+            conexiunea psycopg2, fără tranzacție în desfășurare
+        Raises:
+            PoolTimeout, dacă nu s-a eliberat nicio conexiune la timp
+            psycopg2.OperationalError, dacă baza de date nu este disponibilă
+        """
+        start = monotonic()
+        deadline = start + self.timeout
+        conn = None
+        last_used = 0.0
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout()
+
+                self._waiting += 1
+                self._cond.wait(remaining)
+                self._waiting -= 1
+
+            waited = monotonic() - start
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            broken_at = self._broken_at
+
+        try:
+            if conn is not None:
+                idle_for = monotonic() - last_used
+                if conn.closed or ((idle_for >= self.check_interval or
+                                    last_used <= broken_at) and
+                                   not self._ping(conn)):
+                    # Conexiunea a murit (de exemplu, serverul a fost repornit)
+                    # și este înlocuită.
+                    conn.close()
+                    conn = None
+                    with self._cond:
+                        self._reconnects += 1
+
+            if conn is None:
+                conn = self._connect()
+        except psycopg2.Error:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._in_use += 1
+
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        Întoarce o conexiune în pool. O tranzacție rămasă deschisă este
+        anulată, iar o conexiune stricată este închisă.
+
+        Args:
+            conn - conexiunea obținută prin getconn().
+            discard - dacă este True, conexiunea este închisă.
+        """
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        if conn.closed:
+            discard = True
+            with self._cond:
+                # Probabil și celelalte conexiuni inactive sunt moarte.
+                self._broken_at = monotonic()
+
+        if discard and not conn.closed:
+            conn.close()
+
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((conn, monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager care scoate o conexiune și o întoarce la final.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """
+        Închide conexiunile inactive.
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._size -= 1
+
+    def load(self):
+        """
+        Returns:
+            float: conexiunile folosite și cererile care așteaptă, raportate
+            la maxconn
+        """
+        with self._cond:
+            return (self._in_use + self._waiting) / self.maxconn
+
+    def stats(self):
+        """
+        Returns:
+            dict cu starea curentă a pool-ului
+        """
+        with self._cond:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "wait_time_total": round(self._wait_total, 6),
+                "wait_time_avg": round(self._wait_total / self._checkouts, 6)
+                                 if self._checkouts else 0.0,
+                "wait_time_max": round(self._wait_max, 6),
+            }
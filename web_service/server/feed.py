@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from collections import deque
+from datetime import datetime
+
+import json
+import threading
+
+from storage import display_timestamp
+
+import statements
+
+# Canalul pe care rutele de scriere anunță temperaturile adăugate,
+# modificate sau șterse.
+CHANNEL = "temperature_changes"
+# Conținutul unei notificări este limitat la 8000 de octeți.
+MAX_PAYLOAD = 7900
+
+# Tipurile evenimentelor trimise abonaților.
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+
+def publish(cursor, event, readings):
+    """
+    Anunță, prin NOTIFY pe CHANNEL, temperaturile scrise în tranzacția
+    cursorului. Notificările sunt livrate abia la commit, deci doar dacă
+    scrierea reușește.
+
+    Args:
+        cursor - cursorul tranzacției de scriere.
+        event - CREATED, UPDATED sau DELETED.
+        readings - vezi payloads().
+    """
+    for payload in payloads(event, readings):
+        statements.execute(cursor, """ SELECT pg_notify(%s, %s); """,
+                           (CHANNEL, payload))
+
+def payloads(event, readings):
+    """
+    Împarte temperaturile în notificări de pe CHANNEL, fiecare de cel mult
+    MAX_PAYLOAD octeți.
+
+    Args:
+        event - CREATED, UPDATED sau DELETED.
+        readings - tupluri (temp_id, city_id, temp_value, temp_timestamp)
+            sau, pentru UPDATED, (temp_id, city_id, temp_value,
+            temp_timestamp, id-ul vechiului oraș); temp_value poate fi None.
+    Returns:
+        list: conținutul notificărilor
+    """
+    chunks = []
+    chunk = []
+    size = 2
+    for reading in readings:
+        item = [event, reading[0], reading[1], reading[2],
+                reading[3].isoformat(" ")]
+        if len(reading) > 4 and reading[4] != reading[1]:
+            item.append(reading[4])
+        encoded = json.dumps(item, separators=(",", ":"))
+
+        if chunk and size + len(encoded) + 1 > MAX_PAYLOAD:
+            chunks.append("[%s]" % ",".join(chunk))
+            chunk = []
+            size = 2
+        chunk.append(encoded)
+        size += len(encoded) + 1
+
+    if chunk:
+        chunks.append("[%s]" % ",".join(chunk))
+    return chunks
+
+def parse(payload):
+    """
+    Returns:
+        list: evenimentele unei notificări de pe CHANNEL, ca tupluri (tip,
+        temp_id, city_id, temp_value, temp_timestamp, id-ul vechiului oraș
+        sau None); temp_timestamp este un datetime
+    """
+    events = []
+    for item in json.loads(payload):
+        events.append((item[0], item[1], item[2], item[3],
+                       datetime.fromisoformat(item[4]),
+                       item[5] if len(item) > 5 else None))
+    return events
+
+class Subscription:
+    """
+    Abonarea unui client la flux: mesajele SSE care îl privesc, în ordinea
+    sosirii. Se citește dintr-un singur thread (greenlet), cu next_messages().
+    """
+    def __init__(self, city_id, country_id, max_queued):
+        self.city_id = city_id
+        self.country_id = country_id
+        self.max_queued = max_queued
+        self._messages = deque()
+        self._wakeup = threading.Event()
+        # Setat când abonatul trebuie deconectat: coada s-a umplut
+        # (overflowed) sau fluxul se închide.
+        self.closed = False
+        self.overflowed = False
+
+    def matches(self, city_ids, country_ids):
+        """
+        Returns:
+            True, dacă un eveniment din orașele și țările date îl privește
+        """
+        return (self.city_id is None or self.city_id in city_ids) and \
+               (self.country_id is None or self.country_id in country_ids)
+
+    def put(self, message):
+        """
+        Adaugă un mesaj; un abonat prea lent este deconectat.
+        """
+        if len(self._messages) >= self.max_queued:
+            self.overflowed = True
+            self.closed = True
+        else:
+            self._messages.append(message)
+        self._wakeup.set()
+
+    def close(self):
+        """
+        Cere deconectarea abonatului.
+        """
+        self.closed = True
+        self._wakeup.set()
+
+    def next_messages(self, timeout):
+        """
+        Așteaptă cel mult timeout secunde mesaje noi.
+
+        Returns:
+            list: mesajele sosite (poate fi goală)
+        """
+        if not self._messages and not self.closed:
+            self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+        messages = []
+        while self._messages:
+            messages.append(self._messages.popleft())
+        return messages
+
+class TemperatureFeed:
+    """
+    Fluxul temperaturilor adăugate, modificate și șterse, trimis clienților
+    ca Server-Sent Events.
+
+    Fiecare proces primește notificările de pe CHANNEL o singură dată, prin
+    Listener-ul lui, și le împarte abonaților după oraș și țară: fiecare
+    eveniment este codificat o singură dată, oricâți abonați l-ar primi, iar
+    baza de date nu este interogată deloc. Țara unui oraș este luată din
+    indexul spațial al orașelor.
+    """
+    def __init__(self, country_of, max_subscribers=10000, max_queued=1000):
+        """
+        Args:
+            country_of - funcție care întoarce id-ul țării unui oraș (sau
+                None, dacă orașul nu este cunoscut).
+            max_subscribers - numărul maxim de abonați ai procesului.
+            max_queued - câte mesaje poate avea în așteptare un abonat
+                înainte de a fi deconectat.
+        """
+        self.country_of = country_of
+        self.max_subscribers = max_subscribers
+        self.max_queued = max_queued
+
+        self._lock = threading.Lock()
+        # Abonații după oraș, după țară (cei fără oraș) și cei fără filtre.
+        self._by_city = {}
+        self._by_country = {}
+        self._everything = set()
+        self._count = 0
+        self._closed = False
+
+        self._events = 0
+        self._messages = 0
+        self._dropped = 0
+
+    def subscribe(self, city_id=None, country_id=None):
+        """
+        Returns:
+            Subscription: abonarea nouă
+            None: dacă procesul are deja max_subscribers abonați sau se
+            oprește
+        """
+        subscription = Subscription(city_id, country_id, self.max_queued)
+        with self._lock:
+            if self._closed or self._count >= self.max_subscribers:
+                return None
+            self._group(subscription, True).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Anulează o abonare făcută cu subscribe().
+        """
+        with self._lock:
+            group = self._group(subscription, False)
+            if group is not None and subscription in group:
+                group.discard(subscription)
+                self._count -= 1
+                if not group and group is not self._everything:
+                    self._forget(subscription)
+            if subscription.overflowed:
+                self._dropped += 1
+
+    def _group(self, subscription, create):
+        """
+        Returns:
+            set: mulțimea în care este ținut abonatul (se apelează cu
+            self._lock luat)
+        """
+        if subscription.city_id is not None:
+            groups, key = self._by_city, subscription.city_id
+        elif subscription.country_id is not None:
+            groups, key = self._by_country, subscription.country_id
+        else:
+            return self._everything
+        if create:
+            return groups.setdefault(key, set())
+        return groups.get(key)
+
+    def _forget(self, subscription):
+        """
+        Șterge mulțimea goală a abonatului (se apelează cu self._lock luat).
+        """
+        if subscription.city_id is not None:
+            del self._by_city[subscription.city_id]
+        else:
+            del self._by_country[subscription.country_id]
+
+    def notified(self, payload):
+        """
+        Împarte abonaților evenimentele unei notificări de pe CHANNEL.
+        """
+        for event, temp_id, city_id, value, timestamp, previous \
+                in parse(payload):
+            city_ids = {city_id}
+            if previous is not None:
+                # Temperatura a fost mutată din alt oraș.
+                city_ids.add(previous)
+            country_ids = {self.country_of(ident) for ident in city_ids}
+
+            data = {"temp_id": temp_id, "city_id": city_id,
+                    "temp_timestamp": display_timestamp(timestamp)}
+            if value is not None:
+                data["temp_value"] = value
+            if previous is not None:
+                data["previous_city_id"] = previous
+            message = ("event: %s\ndata: %s\n\n" % (
+                event, json.dumps(data, separators=(",", ":")))).encode()
+
+            with self._lock:
+                candidates = list(self._everything)
+                for ident in city_ids:
+                    candidates.extend(self._by_city.get(ident, ()))
+                for ident in country_ids:
+                    candidates.extend(self._by_country.get(ident, ()))
+                self._events += 1
+
+            sent = 0
+            for subscription in candidates:
+                if subscription.matches(city_ids, country_ids):
+                    subscription.put(message)
+                    sent += 1
+
+            with self._lock:
+                self._messages += sent
+
+    def reset(self):
+        """
+        Anunță toți abonații că unele evenimente ar fi putut fi pierdute (de
+        exemplu, după căderea conexiunii de ascultare), ca să-și citească
+        din nou temperaturile.
+        """
+        message = b"event: reset\ndata: {}\n\n"
+        for subscription in self._all():
+            subscription.put(message)
+
+    def close(self):
+        """
+        Deconectează toți abonații și refuză abonările noi, la oprirea
+        procesului.
+        """
+        with self._lock:
+            self._closed = True
+        for subscription in self._all():
+            subscription.close()
+
+    def _all(self):
+        """
+        Returns:
+            list: toți abonații
+        """
+        with self._lock:
+            subscriptions = list(self._everything)
+            for groups in (self._by_city, self._by_country):
+                for group in groups.values():
+                    subscriptions.extend(group)
+        return subscriptions
+
+    def stats(self):
+        """
+        Returns:
+            dict cu numărul de abonați și de evenimente
+        """
+        with self._lock:
+            return {"subscribers": self._count,
+                    "max_subscribers": self.max_subscribers,
+                    "events": self._events, "messages": self._messages,
+                    "dropped": self._dropped}
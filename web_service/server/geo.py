@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from math import asin, cos, degrees, floor, radians, sin, sqrt
+
+import threading
+
+# Raza medie a Pământului, în kilometri.
+EARTH_RADIUS_KM = 6371.0088
+# Jumătate din circumferința Pământului: nicio distanță nu este mai mare.
+MAX_DISTANCE_KM = EARTH_RADIUS_KM * 3.141592653589793
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Returns:
+        float: distanța pe suprafața Pământului dintre două puncte, în km
+    """
+    phi1, phi2 = radians(lat1), radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = radians(lon2 - lon1)
+    hav = sin(dphi / 2) ** 2 + cos(phi1) * cos(phi2) * sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(hav)))
+
+class CityIndex:
+    """
+    Index spațial în memorie al orașelor, pentru căutarea orașelor dintr-o
+    rază și a celor mai apropiate orașe de un punct.
+
+    Orașele sunt împărțite într-o grilă de celule de cell_deg x cell_deg
+    grade (latitudine x longitudine). O căutare în rază verifică doar
+    celulele din dreptunghiul care încadrează cercul, iar căutarea celor mai
+    apropiate k orașe repetă căutarea în rază, dublând raza până găsește k
+    orașe.
+
+    Indexul este încărcat din baza de date cu load() și ținut la zi cu
+    refresh(), apelată după fiecare scriere care poate schimba orașe. Ambele
+    primesc funcția care citește orașele (Storage.find_cities()).
+    """
+    def __init__(self, cell_deg=1.0):
+        """
+        Args:
+            cell_deg - latura unei celule a grilei, în grade.
+        """
+        self.cell_deg = cell_deg
+        self._columns = int(round(360 / cell_deg))
+        self._rows = int(round(180 / cell_deg))
+        self._lock = threading.Lock()
+        # Celula -> {id oraș: oraș}; orașul este un dicționar cu aceleași
+        # chei ca la GET /api/cities.
+        self._cells = {}
+        self._cities = {}
+        # Țara -> id-urile orașelor ei.
+        self._by_country = {}
+        # Serializează citirile din baza de date împreună cu aplicarea lor.
+        self._refresh_lock = threading.Lock()
+
+    def _cell(self, lat, lon):
+        """
+        Returns:
+            tuple: celula grilei în care se află punctul
+        """
+        row = min(max(int(floor((lat + 90) / self.cell_deg)), 0),
+                  self._rows - 1)
+        column = int(floor((lon + 180) / self.cell_deg)) % self._columns
+        return row, column
+
+    def _remove(self, city_id):
+        """
+        Scoate un oraș din index. Se apelează cu self._lock luat.
+        """
+        city = self._cities.pop(city_id, None)
+        if city is None:
+            return
+
+        cell = self._cell(city["city_lat"], city["city_lon"])
+        members = self._cells[cell]
+        del members[city_id]
+        if not members:
+            del self._cells[cell]
+
+        members = self._by_country[city["country_id"]]
+        members.discard(city_id)
+        if not members:
+            del self._by_country[city["country_id"]]
+
+    def _add(self, city):
+        """
+        Adaugă sau înlocuiește un oraș în index. Se apelează cu self._lock
+        luat.
+        """
+        self._remove(city["city_id"])
+        self._cities[city["city_id"]] = city
+        cell = self._cell(city["city_lat"], city["city_lon"])
+        self._cells.setdefault(cell, {})[city["city_id"]] = city
+        self._by_country.setdefault(city["country_id"], set()).add(
+            city["city_id"])
+
+    def load(self, find_cities):
+        """
+        Încarcă din nou toate orașele.
+
+        Args:
+            find_cities - funcția care citește orașele (vezi
+                Storage.find_cities()).
+        """
+        with self._refresh_lock:
+            cities = find_cities()
+
+            with self._lock:
+                self._cells = {}
+                self._cities = {}
+                self._by_country = {}
+                for city in cities:
+                    self._add(city)
+
+    def refresh(self, find_cities, city_ids=(), country_ids=()):
+        """
+        Citește din nou orașele date și orașele țărilor date. Orașele care
+        nu mai există sunt scoase din index.
+
+        Args:
+            find_cities - funcția care citește orașele (vezi
+                Storage.find_cities()).
+            city_ids - id-urile orașelor modificate.
+            country_ids - id-urile țărilor ale căror orașe s-au modificat.
+        """
+        city_ids = list(city_ids)
+        country_ids = list(country_ids)
+        if not city_ids and not country_ids:
+            return
+
+        with self._refresh_lock:
+            cities = find_cities(city_ids, country_ids)
+
+            with self._lock:
+                stale = set(city_ids)
+                if country_ids:
+                    countries = set(country_ids)
+                    stale.update(city_id for city_id, city
+                                 in self._cities.items()
+                                 if city["country_id"] in countries)
+                for city_id in stale:
+                    self._remove(city_id)
+                for city in cities:
+                    self._add(city)
+
+    def country_of(self, city_id):
+        """
+        Returns:
+            int: id-ul țării orașului dat
+            None: dacă orașul nu este în index
+        """
+        with self._lock:
+            city = self._cities.get(city_id)
+        return city["country_id"] if city is not None else None
+
+    def city_ids(self, country_id=None):
+        """
+        Returns:
+            list: id-urile orașelor țării date sau, fără țară, ale tuturor
+            orașelor
+        """
+        with self._lock:
+            if country_id is None:
+                return list(self._cities)
+            return list(self._by_country.get(country_id, ()))
+
+    def _cells_within(self, lat, lon, radius_km):
+        """
+        Returns:
+            list: celulele (nevide) care pot conține puncte aflate la cel
+            mult radius_km de punctul dat
+        """
+        angle = radius_km / EARTH_RADIUS_KM
+        dlat = degrees(angle)
+
+        if lat + dlat >= 90 or lat - dlat <= -90 or \
+           sin(angle) >= cos(radians(lat)):
+            # Cercul conține un pol: se verifică toate longitudinile.
+            dlon = 180.0
+        else:
+            dlon = degrees(asin(sin(angle) / cos(radians(lat))))
+
+        first_row, first_column = self._cell(lat - dlat, lon - dlon)
+        last_row, last_column = self._cell(lat + dlat, lon + dlon)
+        rows = last_row - first_row + 1
+        if dlon >= 180:
+            columns = self._columns
+            first_column = 0
+        else:
+            columns = (last_column - first_column) % self._columns + 1
+
+        if rows * columns >= len(self._cells):
+            # Dreptunghiul are mai multe celule decât cele ocupate.
+            return list(self._cells.values())
+
+        cells = []
+        for row in range(first_row, last_row + 1):
+            for offset in range(columns):
+                members = self._cells.get(
+                    (row, (first_column + offset) % self._columns))
+                if members:
+                    cells.append(members)
+        return cells
+
+    def within(self, lat, lon, radius_km):
+        """
+        Returns:
+            list: tupluri (distanța în km, oraș) pentru orașele aflate la
+            cel mult radius_km de punctul dat, în ordinea distanței
+        """
+        found = []
+        with self._lock:
+            for members in self._cells_within(lat, lon, radius_km):
+                for city in members.values():
+                    distance = haversine_km(lat, lon, city["city_lat"],
+                                            city["city_lon"])
+                    if distance <= radius_km:
+                        found.append((distance, city["city_id"], city))
+
+        found.sort(key=lambda item: item[:2])
+        return [(distance, city) for distance, _, city in found]
+
+    def nearest(self, lat, lon, count):
+        """
+        Returns:
+            list: tupluri (distanța în km, oraș) pentru cele mai apropiate
+            count orașe de punctul dat, în ordinea distanței
+        """
+        radius_km = self.cell_deg * EARTH_RADIUS_KM * radians(1) / 2
+
+        while True:
+            found = self.within(lat, lon, radius_km)
+            if len(found) >= count or radius_km >= MAX_DISTANCE_KM:
+                return found[:count]
+            radius_km *= 2
+
+    def stats(self):
+        """
+        Returns:
+            dict cu dimensiunea indexului
+        """
+        with self._lock:
+            return {"cities": len(self._cities), "cells": len(self._cells),
+                    "cell_deg": self.cell_deg}
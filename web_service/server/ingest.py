@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from collections import deque
+from time import monotonic
+
+import logging
+import threading
+
+from rollups import add_readings
+import feed
+import statements
+
+LOGGER = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    """
+    Coada de temperaturi este plină (sau închisă) și nu s-a eliberat loc în
+    timpul de așteptare permis.
+    """
+
+class _Pending:
+    """
+    O temperatură care așteaptă să fie scrisă, împreună cu rezultatul ei.
+    """
+    __slots__ = ("city_id", "value", "queued_at", "done", "status", "temp_id")
+
+    def __init__(self, city_id, value):
+        self.city_id = city_id
+        self.value = value
+        self.queued_at = monotonic()
+        self.done = threading.Event()
+        self.status = None
+        self.temp_id = None
+
+class WriteBehindWriter:
+    """
+    Scrie temperaturile primite de POST /api/temperatures în loturi: cererile
+    sunt puse într-o coadă, iar un thread separat le inserează cu o singură
+    instrucțiune și un singur commit (group commit), cel târziu la
+    flush_interval secunde după prima temperatură din lot sau când lotul are
+    flush_rows temperaturi. Fiecare cerere primește răspunsul abia după
+    commit-ul lotului ei.
+
+    Fiecare temperatură primește momentul exact al inserării, deci două
+    temperaturi din același oraș, din același lot, nu se ciocnesc.
+    """
+    def __init__(self, pool, flush_interval=0.005, flush_rows=500,
+                 max_queued=10000, queue_timeout=1.0):
+        """
+        Args:
+            pool - pool-ul din care se iau conexiunile.
+            flush_interval - cât așteaptă, în secunde, prima temperatură
+                dintr-un lot înainte de a fi scrisă.
+            flush_rows - numărul maxim de temperaturi dintr-un lot.
+            max_queued - câte temperaturi pot aștepta în coadă; peste atât,
+                cererile așteaptă să se elibereze loc.
+            queue_timeout - cât așteaptă o cerere loc în coadă, în secunde.
+        """
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._closed = False
+        self._thread = None
+
+        self._flushes = 0
+        self._rows = 0
+        self._rejected = 0
+        self._errors = 0
+
+    def start(self):
+        """
+        Pornește thread-ul care scrie loturile, dacă nu a fost deja pornit.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="temp-writer")
+            self._thread.start()
+
+    def submit(self, city_id, value):
+        """
+        Pune o temperatură în coadă și așteaptă commit-ul lotului ei.
+
+        Returns:
+            tuple: (201, id-ul temperaturii), (404, None) dacă orașul nu
+            există, (409, None) dacă există deja o temperatură în oraș cu
+            același timestamp sau (503, None) dacă lotul nu a putut fi scris
+        Raises:
+            QueueFull, dacă nu s-a eliberat loc în coadă la timp
+        """
+        pending = _Pending(city_id, value)
+        deadline = monotonic() + self.queue_timeout
+
+        with self._cond:
+            while len(self._queue) >= self.max_queued and not self._closed:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if len(self._queue) >= self.max_queued or self._closed:
+                self._rejected += 1
+                raise QueueFull()
+
+            self._queue.append(pending)
+            self._cond.notify_all()
+
+        pending.done.wait()
+        return pending.status, pending.temp_id
+
+    def close(self, timeout=None):
+        """
+        Nu mai primește temperaturi noi și așteaptă scrierea celor din coadă.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _next_batch(self):
+        """
+        Așteaptă și scoate din coadă următorul lot.
+
+        Returns:
+            list: temperaturile lotului
+            None: dacă scrierea s-a încheiat
+        """
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+
+            deadline = self._queue[0].queued_at + self.flush_interval
+            while len(self._queue) < self.flush_rows and not self._closed:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            count = min(len(self._queue), self.flush_rows)
+            batch = [self._queue.popleft() for _ in range(count)]
+            # Cererile care așteaptă loc în coadă.
+            self._cond.notify_all()
+
+        return batch
+
+    def _write(self, conn, batch):
+        """
+        Scrie un lot într-o singură tranzacție și completează rezultatele.
+        """
+        cursor = conn.cursor()
+
+        try:
+            # Orașele sunt blocate până la commit, ca să nu poată fi șterse
+            # între verificare și inserare.
+            statements.execute(cursor, """ SELECT city_id FROM cities         \
+                                           WHERE city_id = ANY(%s)           \
+                                           FOR KEY SHARE; """,
+                               (list({pending.city_id for pending in batch}),))
+            known_cities = {row[0] for row in cursor.fetchall()}
+
+            rows = [pending for pending in batch
+                    if pending.city_id in known_cities]
+            for pending in batch:
+                if pending.city_id not in known_cities:
+                    pending.status = 404
+
+            # Id-urile sunt luate dinainte, ca fiecare rând întors să poată
+            # fi legat de cererea lui.
+            statements.execute(cursor, """ SELECT nextval(                  \
+                                               'temperatures_temp_id_seq')   \
+                                           FROM generate_series(1, %s); """,
+                               (len(rows),))
+            for pending, (temp_id,) in zip(rows, cursor.fetchall()):
+                pending.temp_id = temp_id
+
+            inserted = []
+            if rows:
+                # Lotul este trimis ca trei liste, deci instrucțiunea are
+                # același text pentru orice dimensiune a lotului.
+                statements.execute(
+                    cursor,
+                    """ INSERT INTO temperatures(temp_id, city_id,            \
+                                                 temp_value, temp_timestamp)  \
+                        SELECT temp_id, city_id, temp_value,                  \
+                               clock_timestamp()::timestamp                   \
+                        FROM UNNEST(%s::integer[], %s::integer[],             \
+                                    %s::numeric[])                            \
+                        AS new(temp_id, city_id, temp_value)                  \
+                        ON CONFLICT (temp_timestamp, city_id) DO NOTHING      \
+                        RETURNING temp_id, city_id, temp_value,               \
+                        temp_timestamp; """,
+                    ([pending.temp_id for pending in rows],
+                     [pending.city_id for pending in rows],
+                     [pending.value for pending in rows]))
+                inserted = cursor.fetchall()
+
+            add_readings(cursor, [row[1:] for row in inserted])
+            feed.publish(cursor, feed.CREATED, inserted)
+        finally:
+            cursor.close()
+
+        conn.commit()
+
+        inserted_ids = {row[0] for row in inserted}
+        for pending in rows:
+            if pending.temp_id in inserted_ids:
+                pending.status = 201
+            else:
+                pending.status = 409
+                pending.temp_id = None
+
+    def _run(self):
+        """
+        Bucla thread-ului care scrie loturile.
+        """
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                with self.pool.connection() as conn:
+                    self._write(conn, batch)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Lotul de %d temperaturi nu a fost scris.",
+                                 len(batch))
+                for pending in batch:
+                    pending.status = 503
+                    pending.temp_id = None
+                with self._cond:
+                    self._errors += 1
+
+            with self._cond:
+                self._flushes += 1
+                self._rows += len(batch)
+
+            for pending in batch:
+                pending.done.set()
+
+    def stats(self):
+        """
+        Returns:
+            dict cu starea curentă a cozii
+        """
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "max_queued": self.max_queued,
+                "flushes": self._flushes,
+                "rows": self._rows,
+                "rows_per_flush": round(self._rows / self._flushes, 2)
+                                  if self._flushes else 0.0,
+                "rejected": self._rejected,
+                "errors": self._errors,
+            }
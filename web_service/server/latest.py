@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+import threading
+
+from feed import DELETED
+from storage import display_timestamp
+
+class LatestReadings:
+    """
+    Ultima temperatură a fiecărui oraș, ținută în memorie, pentru
+    GET /api/temperatures/latest: o căutare costă un acces la dicționar și
+    nu folosește baza de date.
+
+    Indexul este încărcat cu load() și ținut la zi cu apply(), apelată cu
+    evenimentele fluxului de temperaturi (vezi feed.py), pe care fiecare
+    proces le primește pentru toate scrierile. O temperatură nouă înlocuiește
+    ultima temperatură a orașului doar dacă este mai recentă; dacă ultima
+    temperatură a unui oraș este ștearsă sau mutată în alt oraș, orașul este
+    citit din nou cu refresh().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Orașul -> ((temp_timestamp, temp_id), rândul întors de rută).
+        self._latest = {}
+        # Serializează citirile din baza de date împreună cu aplicarea
+        # evenimentelor, ca un eveniment să nu fie suprascris de o citire
+        # mai veche.
+        self._refresh_lock = threading.Lock()
+
+    @staticmethod
+    def _entry(temp_id, city_id, value, timestamp):
+        """
+        Returns:
+            tuple: cheia de ordonare și rândul unei temperaturi
+        """
+        return ((timestamp, temp_id),
+                {"city_id": city_id, "temp_id": temp_id, "temp_value": value,
+                 "temp_timestamp": display_timestamp(timestamp)})
+
+    def load(self, latest_readings):
+        """
+        Încarcă din nou ultima temperatură a tuturor orașelor.
+
+        Args:
+            latest_readings - funcția care citește ultimele temperaturi
+                (vezi Storage.latest_readings()).
+        """
+        with self._refresh_lock:
+            latest = {row[1]: self._entry(*row) for row in latest_readings()}
+            with self._lock:
+                self._latest = latest
+
+    def refresh(self, latest_readings, city_ids):
+        """
+        Citește din nou ultima temperatură a orașelor date.
+
+        Args:
+            latest_readings - funcția care citește ultimele temperaturi
+                (vezi Storage.latest_readings()).
+            city_ids - id-urile orașelor.
+        """
+        city_ids = set(city_ids)
+        if not city_ids:
+            return
+
+        with self._refresh_lock:
+            rows = latest_readings(city_ids)
+
+            with self._lock:
+                for city_id in city_ids:
+                    self._latest.pop(city_id, None)
+                for row in rows:
+                    self._latest[row[1]] = self._entry(*row)
+
+    def apply(self, events):
+        """
+        Aplică evenimentele fluxului de temperaturi (vezi feed.parse()).
+
+        Returns:
+            set: orașele care trebuie citite din nou cu refresh(), pentru
+            că ultima lor temperatură a fost ștearsă sau mutată
+        """
+        stale = set()
+        with self._refresh_lock, self._lock:
+            for event, temp_id, city_id, value, timestamp, previous in events:
+                if event == DELETED or previous is not None:
+                    # Temperatura a plecat din orașul ei.
+                    source = city_id if event == DELETED else previous
+                    current = self._latest.get(source)
+                    if current is not None and \
+                       current[1]["temp_id"] == temp_id:
+                        stale.add(source)
+                    if event == DELETED:
+                        continue
+
+                entry = self._entry(temp_id, city_id, value, timestamp)
+                current = self._latest.get(city_id)
+                # O temperatură modificată în același oraș are aceeași cheie
+                # și își înlocuiește valoarea.
+                if current is None or current[0] <= entry[0]:
+                    self._latest[city_id] = entry
+                    stale.discard(city_id)
+
+        return stale
+
+    def get(self, city_ids):
+        """
+        Returns:
+            list: ultima temperatură a fiecăruia dintre orașele date care
+            are temperaturi, ca dicționare, în ordinea id-urilor
+        """
+        with self._lock:
+            found = [self._latest.get(city_id) for city_id in city_ids]
+        return sorted((entry[1] for entry in found if entry is not None),
+                      key=lambda row: row["city_id"])
+
+    def stats(self):
+        """
+        Returns:
+            dict cu dimensiunea indexului
+        """
+        with self._lock:
+            return {"cities": len(self._latest)}
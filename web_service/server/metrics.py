@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from bisect import bisect_left
+from time import perf_counter, sleep
+
+import glob
+import logging
+import os
+import pickle
+import threading
+
+import psycopg2.extensions
+
+LOGGER = logging.getLogger(__name__)
+
+# Limitele (le) ale histogramelor: durate în secunde, dimensiuni în octeți și
+# numere de rânduri.
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Metricile exportate: nume -> (tip, descriere, limitele histogramei).
+SPECS = {
+    "http_requests_total": (
+        "counter", "Numărul de cereri HTTP terminate.", None),
+    "http_request_duration_seconds": (
+        "histogram", "Durata cererilor HTTP, până la ultimul octet trimis.",
+        SECONDS_BUCKETS),
+    "http_response_size_bytes": (
+        "histogram", "Dimensiunea corpului răspunsurilor HTTP.",
+        BYTES_BUCKETS),
+    "http_request_db_seconds": (
+        "histogram", "Timpul petrecut de o cerere HTTP în baza de date.",
+        SECONDS_BUCKETS),
+    "http_request_db_rows": (
+        "histogram", "Numărul de rânduri citite din baza de date de o cerere "
+        "HTTP.", ROWS_BUCKETS),
+    "db_query_duration_seconds": (
+        "histogram", "Durata fiecărui apel execute() / fetch*() către baza "
+        "de date.", SECONDS_BUCKETS),
+    "http_admission_rejected_total": (
+        "counter", "Numărul de cereri refuzate de controlul admiterii, pe "
+        "clasă și motiv.", None),
+    "http_admission_wait_seconds": (
+        "histogram", "Cât a așteptat o cerere admisă în coada clasei ei.",
+        SECONDS_BUCKETS),
+    "db_slow_queries_total": (
+        "counter", "Numărul de apeluri către baza de date mai lente decât "
+        "pragul SLOW_QUERY_MS.", None),
+}
+
+# Ruta folosită pentru interogările din afara cererilor (thread-urile de
+# întreținere, scrierea în loturi) și pentru cererile fără rută.
+BACKGROUND = "<background>"
+UNMATCHED = "<unmatched>"
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE",
+                     "OPTIONS"))
+
+# Cererea în curs a thread-ului (sau a greenlet-ului, sub gevent).
+_LOCAL = threading.local()
+
+class Metrics:
+    """
+    Contoare și histograme în memorie, exportate în formatul text Prometheus.
+
+    Fiecare proces își ține propriile valori. Cu share(), procesele (workerii
+    serverului de producție) își scriu periodic valorile într-un director
+    comun, iar render() le adună pe ale tuturor, deci orice worker poate
+    răspunde la /metrics. Fișierele workerilor opriți sunt păstrate, ca
+    contoarele să nu scadă.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (nume, etichete) -> valoare, respectiv [contoare pe limite, sumă].
+        self._counters = {}
+        self._histograms = {}
+        self._directory = None
+
+    def inc(self, name, labels, value=1):
+        """
+        Mărește un contor.
+
+        Args:
+            name - numele metricii, din SPECS.
+            labels - tuplu de perechi (etichetă, valoare).
+        """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """
+        Adaugă o valoare într-o histogramă.
+        """
+        buckets = SPECS[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [
+                    [0] * (len(buckets) + 1), 0.0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    def snapshot(self):
+        """
+        Returns:
+            tuple: (contoare, histograme), copii ale valorilor curente
+        """
+        with self._lock:
+            return (dict(self._counters),
+                    {key: (list(counts), total) for key, (counts, total)
+                     in self._histograms.items()})
+
+    def _path(self):
+        return os.path.join(self._directory, "%d.pickle" % os.getpid())
+
+    def dump(self):
+        """
+        Scrie valorile procesului curent în directorul comun.
+        """
+        path = self._path()
+        with open(path + ".tmp", "wb") as output:
+            pickle.dump(self.snapshot(), output)
+        os.replace(path + ".tmp", path)
+
+    def share(self, directory, interval):
+        """
+        Scrie valorile procesului curent în directorul dat acum și apoi la
+        fiecare interval secunde, dintr-un thread separat.
+        """
+        self._directory = directory
+        self.dump()
+
+        def run():
+            while True:
+                sleep(interval)
+                try:
+                    self.dump()
+                except OSError:
+                    LOGGER.exception("Metricile nu au fost scrise.")
+
+        threading.Thread(target=run, daemon=True, name="metrics").start()
+
+    def collect(self):
+        """
+        Returns:
+            tuple: (contoare, histograme), adunate din toate procesele
+        """
+        if self._directory is None:
+            return self.snapshot()
+
+        self.dump()
+        counters = {}
+        histograms = {}
+        for path in glob.glob(os.path.join(self._directory, "*.pickle")):
+            try:
+                with open(path, "rb") as source:
+                    other_counters, other_histograms = pickle.load(source)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+
+            for key, value in other_counters.items():
+                counters[key] = counters.get(key, 0) + value
+            for key, (counts, total) in other_histograms.items():
+                if key in histograms:
+                    merged = histograms[key]
+                    merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                    merged[1] += total
+                else:
+                    histograms[key] = [counts, total]
+
+        return counters, histograms
+
+    def render(self):
+        """
+        Returns:
+            str: toate metricile, în formatul text Prometheus (0.0.4)
+        """
+        counters, histograms = self.collect()
+        lines = []
+
+        for name, (kind, description, buckets) in SPECS.items():
+            values = counters if kind == "counter" else histograms
+            series = sorted(key for key in values if key[0] == name)
+            if not series:
+                continue
+
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for key in series:
+                labels = key[1]
+                if kind == "counter":
+                    lines.append("%s%s %s" % (name, _labels(labels),
+                                              _number(values[key])))
+                    continue
+
+                counts, total = values[key]
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (
+                        name, _labels(labels + (("le", _number(bound)),)),
+                        cumulative))
+                lines.append("%s_sum%s %s" % (name, _labels(labels),
+                                              _number(total)))
+                lines.append("%s_count%s %d" % (name, _labels(labels),
+                                                cumulative))
+
+        return "\n".join(lines) + "\n"
+
+def _number(value):
+    """
+    Returns:
+        str: valoarea, în formatul Prometheus
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return "%.1f" % value
+    return repr(value)
+
+def _labels(labels):
+    """
+    Returns:
+        str: etichetele, în formatul Prometheus ({a="1",b="2"})
+    """
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", r"\\")
+                     .replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels)
+
+METRICS = Metrics()
+
+class _RequestStats:
+    """
+    Ruta, timpul și rândurile din baza de date ale cererii în curs.
+    """
+    __slots__ = ("method", "labels", "db_seconds", "db_rows")
+
+    def __init__(self, method):
+        self.method = method if method in METHODS else "other"
+        # Până când este cunoscută ruta (sau dacă nu există).
+        self.labels = (("method", self.method), ("route", UNMATCHED))
+        self.db_seconds = 0.0
+        self.db_rows = 0
+
+def set_route(rule):
+    """
+    Stabilește ruta cererii în curs: șablonul Flask
+    („/api/cities/<int:city_id>”), nu calea, ca numărul de serii să rămână
+    mic. Se apelează înainte de rularea rutei.
+    """
+    stats = getattr(_LOCAL, "request", None)
+    if stats is not None:
+        stats.labels = (("method", stats.method), ("route", rule))
+
+def record_query(cursor, seconds, rows=0):
+    """
+    Înregistrează un apel către baza de date, pentru cererea în curs sau, în
+    afara cererilor, pentru BACKGROUND. Apelurile mai lente decât pragul
+    jurnalului de interogări lente (TimedCursor.slow_log) ajung și în el.
+    """
+    stats = getattr(_LOCAL, "request", None)
+    if stats is None:
+        labels = (("route", BACKGROUND),)
+    else:
+        stats.db_seconds += seconds
+        stats.db_rows += rows
+        labels = stats.labels[1:]
+    METRICS.observe("db_query_duration_seconds", labels, seconds)
+
+    slow_log = TimedCursor.slow_log
+    if slow_log is not None and seconds >= slow_log.threshold:
+        METRICS.inc("db_slow_queries_total", labels)
+        slow_log.record(cursor.sql, cursor.params, seconds, labels[0][1])
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor care măsoară durata fiecărei interogări și a fiecărei citiri
+    (la cursoarele de server, rândurile sunt calculate la citire) și
+    numărul de rânduri citite. Se folosește prin cursor_factory.
+    """
+    # Jurnalul interogărilor lente (profiling.SlowQueryLog), dacă există.
+    slow_log = None
+
+    # Ultima interogare, cu parametrii ei nelegați, pentru jurnal.
+    sql = None
+    params = None
+
+    # pylint: disable=redefined-builtin
+    def execute(self, query, vars=None):
+        self.sql, self.params = query, vars
+        start = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(self, perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        # Planul este cel al primului set de parametri.
+        self.sql, self.params = query, vars_list[0] if vars_list else None
+        start = perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(self, perf_counter() - start)
+
+    def fetchone(self):
+        start = perf_counter()
+        row = super().fetchone()
+        record_query(self, perf_counter() - start, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        start = perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_query(self, perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = perf_counter()
+        rows = super().fetchall()
+        record_query(self, perf_counter() - start, len(rows))
+        return rows
+
+class _MeasuredBody:
+    """
+    Corpul unui răspuns WSGI, care numără octeții trimiși și înregistrează
+    cererea la închidere, adică după ultimul octet (și pentru fluxuri).
+    """
+    def __init__(self, body, stats, status, start):
+        self._body = body
+        self._stats = stats
+        self._status = status
+        self._start = start
+        self._size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self):
+        """
+        Închide corpul și înregistrează cererea.
+        """
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            record_request(self._stats, self._status[0], self._size,
+                           perf_counter() - self._start)
+
+def record_request(stats, status, size, seconds):
+    """
+    Înregistrează o cerere terminată.
+    """
+    if getattr(_LOCAL, "request", None) is stats:
+        _LOCAL.request = None
+
+    labels = stats.labels
+    METRICS.inc("http_requests_total", labels + (("status", status),))
+    METRICS.observe("http_request_duration_seconds", labels, seconds)
+    METRICS.observe("http_response_size_bytes", labels, size)
+    METRICS.observe("http_request_db_seconds", labels, stats.db_seconds)
+    METRICS.observe("http_request_db_rows", labels, stats.db_rows)
+
+class MetricsMiddleware:
+    """
+    Middleware WSGI care măsoară fiecare cerere: număr (pe metodă, rută și
+    cod de răspuns), durată, dimensiunea răspunsului și timpul și rândurile
+    din baza de date (prin TimedCursor).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        start = perf_counter()
+        stats = _RequestStats(environ.get("REQUEST_METHOD"))
+        _LOCAL.request = stats
+        status = ["500"]
+
+        def measured_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(" ", 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.app(environ, measured_start_response)
+        except BaseException:
+            record_request(stats, status[0], 0, perf_counter() - start)
+            raise
+
+        return _MeasuredBody(body, stats, status, start)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+import psycopg2
+
+import partitions
+import rollups
+
+# Cheia lacătului consultativ care împiedică două procese să aplice simultan
+# aceleași migrări.
+MIGRATION_LOCK_ID = 20201125
+
+def _create_rollups(cursor):
+    """
+    Creează tabelele de agregate ale temperaturilor și le completează din
+    temperaturile existente.
+    """
+    # Temperaturile nu se pot modifica până la sfârșitul migrării.
+    cursor.execute(""" LOCK TABLE temperatures IN SHARE MODE; """)
+
+    for table, _ in rollups.ROLLUPS:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS %s (
+                city_id INTEGER NOT NULL,
+                bucket TIMESTAMP NOT NULL,
+                temp_min NUMERIC(6, 4) NOT NULL,
+                temp_max NUMERIC(6, 4) NOT NULL,
+                temp_sum NUMERIC NOT NULL,
+                temp_count BIGINT NOT NULL,
+                PRIMARY KEY (city_id, bucket),
+                CONSTRAINT fk_city_id
+                    FOREIGN KEY(city_id)
+                    REFERENCES cities(city_id)
+                    ON DELETE CASCADE
+                    ON UPDATE CASCADE
+            );
+
+            -- Agregatele tuturor orașelor dintr-un interval de timp.
+            CREATE INDEX IF NOT EXISTS %s_bucket_idx ON %s (bucket);
+
+            TRUNCATE %s;
+            """ % (table, table, table, table))
+
+    rollups.backfill(cursor)
+
+def _partition_temperatures(cursor):
+    """
+    Transformă tabelul temperatures într-un tabel partiționat pe luni după
+    temp_timestamp, mutând temperaturile existente în partițiile lor.
+    """
+    cursor.execute(""" SELECT relkind FROM pg_class                       \
+                       WHERE oid = 'temperatures'::regclass; """)
+    if cursor.fetchone()[0] == "p":
+        return
+
+    # Temperaturile nu se pot citi sau modifica până la sfârșitul migrării.
+    cursor.execute(
+        """
+        LOCK TABLE temperatures IN ACCESS EXCLUSIVE MODE;
+
+        -- Secvența id-urilor este păstrată pentru noul tabel.
+        ALTER SEQUENCE temperatures_temp_id_seq OWNED BY NONE;
+        ALTER TABLE temperatures RENAME TO temperatures_unpartitioned;
+
+        CREATE TABLE temperatures (
+            temp_id INTEGER NOT NULL
+                DEFAULT nextval('temperatures_temp_id_seq'),
+            temp_value NUMERIC(6, 4) NOT NULL,
+            temp_timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
+            city_id INTEGER NOT NULL
+        ) PARTITION BY RANGE (temp_timestamp);
+
+        SELECT DISTINCT DATE_TRUNC('month', temp_timestamp)
+        FROM temperatures_unpartitioned
+        UNION
+        SELECT DATE_TRUNC('month', LOCALTIMESTAMP);
+        """)
+    partitions.create_partitions(cursor,
+                                 [row[0] for row in cursor.fetchall()])
+
+    # Cheia primară a unui tabel partiționat trebuie să conțină coloana după
+    # care se face partiționarea. Rutele care caută doar după id folosesc tot
+    # indexul ei, în fiecare partiție.
+    cursor.execute(
+        """
+        INSERT INTO temperatures(temp_id, temp_value, temp_timestamp, city_id)
+        SELECT temp_id, temp_value, temp_timestamp, city_id
+        FROM temperatures_unpartitioned;
+
+        DROP TABLE temperatures_unpartitioned;
+        ALTER SEQUENCE temperatures_temp_id_seq OWNED BY temperatures.temp_id;
+
+        ALTER TABLE temperatures
+            ADD CONSTRAINT temperatures_pkey
+                PRIMARY KEY (temp_id, temp_timestamp),
+            ADD CONSTRAINT temperatures_temp_timestamp_city_id_key
+                UNIQUE (temp_timestamp, city_id),
+            ADD CONSTRAINT fk_city_id
+                FOREIGN KEY(city_id)
+                REFERENCES cities(city_id)
+                ON DELETE CASCADE
+                ON UPDATE CASCADE;
+
+        -- Indecșii din migrarea 2, creați acum pe fiecare partiție.
+        CREATE INDEX temperatures_city_ts_idx
+            ON temperatures (city_id, temp_timestamp, temp_id)
+            INCLUDE (temp_value);
+        CREATE INDEX temperatures_ts_id_idx
+            ON temperatures (temp_timestamp, temp_id);
+        """)
+
+# Migrările, în ordine. Fiecare este un tuplu (versiune, descriere, pas), unde
+# pasul este fie un șir SQL, fie o funcție care primește un cursor. Pașii
+# trebuie să fie idempotenți, pentru că bazele de date create înainte de
+# apariția tabelului „schema_version” pornesc de la versiunea 0.
+MIGRATIONS = [
+    (1, "Tabelele countries, cities și temperatures",
+     """
+     CREATE TABLE IF NOT EXISTS countries (
+         country_id SERIAL PRIMARY KEY,
+         country_name VARCHAR(255) NOT NULL UNIQUE,
+         country_lat NUMERIC(6, 4) NOT NULL,
+         country_lon NUMERIC(7, 4) NOT NULL
+     );
+
+     CREATE TABLE IF NOT EXISTS cities (
+         city_id SERIAL PRIMARY KEY,
+         country_id INTEGER NOT NULL,
+         city_name VARCHAR(255) NOT NULL,
+         city_lat NUMERIC(6, 4) NOT NULL,
+         city_lon NUMERIC(7, 4) NOT NULL,
+         unique (country_id, city_name),
+         CONSTRAINT fk_country_id
+             FOREIGN KEY(country_id)
+             REFERENCES countries(country_id)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+     );
+
+     CREATE TABLE IF NOT EXISTS temperatures (
+         temp_id SERIAL PRIMARY KEY,
+         temp_value NUMERIC(6, 4) NOT NULL,
+         temp_timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
+         city_id INTEGER NOT NULL,
+         unique (temp_timestamp, city_id),
+         CONSTRAINT fk_city_id
+             FOREIGN KEY(city_id)
+             REFERENCES cities(city_id)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+     );
+     """),
+
+    # Orașele unei țări sunt deja găsite prin indexul constrângerii
+    # unique (country_id, city_name), deci nu mai este nevoie de un index pe
+    # cities(country_id).
+    (2, "Indecși pentru filtrele și paginarea rutelor de citire",
+     """
+     -- Filtrul după coordonate din GET /api/temperatures.
+     CREATE INDEX IF NOT EXISTS cities_lat_lon_idx
+         ON cities (city_lat, city_lon);
+
+     -- Temperaturile unui oraș, în ordinea paginării; acoperă și valoarea,
+     -- deci rutele pe oraș / țară pot folosi doar indexul.
+     CREATE INDEX IF NOT EXISTS temperatures_city_ts_idx
+         ON temperatures (city_id, temp_timestamp, temp_id)
+         INCLUDE (temp_value);
+
+     -- Intervalele de date și paginarea din GET /api/temperatures.
+     CREATE INDEX IF NOT EXISTS temperatures_ts_id_idx
+         ON temperatures (temp_timestamp, temp_id);
+     """),
+
+    (3, "Agregatele orare și zilnice ale temperaturilor", _create_rollups),
+
+    (4, "Partiționarea lunară a tabelului temperatures",
+     _partition_temperatures),
+]
+
+def schema_version(cursor):
+    """
+    Returns:
+        int: ultima versiune aplicată (0, dacă nu s-a aplicat nicio migrare)
+    """
+    cursor.execute(""" SELECT COALESCE(MAX(version), 0) \
+                       FROM schema_version; """)
+    return cursor.fetchone()[0]
+
+def migrate(conn):
+    """
+    Aplică, în ordine, migrările care nu au fost încă aplicate. Fiecare
+    migrare rulează în propria tranzacție, împreună cu înregistrarea ei în
+    „schema_version”, deci o migrare eșuată nu lasă schema pe jumătate
+    modificată.
+
+    Args:
+        conn - conexiunea psycopg2, fără tranzacție în desfășurare.
+    Returns:
+        list: versiunile aplicate acum
+    """
+    cursor = conn.cursor()
+    applied = []
+
+    # Lacătul este la nivel de sesiune, ca să fie păstrat între tranzacții.
+    cursor.execute(""" SELECT pg_advisory_lock(%s); """, (MIGRATION_LOCK_ID,))
+
+    try:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+            """)
+        conn.commit()
+
+        current = schema_version(cursor)
+
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+
+            if callable(step):
+                step(cursor)
+            else:
+                cursor.execute(step)
+
+            cursor.execute(""" INSERT INTO schema_version(version,          \
+                               description) VALUES (%s, %s); """,
+                           (version, description))
+            conn.commit()
+            applied.append(version)
+    except psycopg2.Error:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # Dacă serverul a căzut, lacătul a dispărut odată cu sesiunea.
+        if not conn.closed:
+            cursor.execute(""" SELECT pg_advisory_unlock(%s); """,
+                           (MIGRATION_LOCK_ID,))
+            conn.commit()
+            cursor.close()
+
+    return applied
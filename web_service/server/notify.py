@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from time import sleep
+
+import logging
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+LOGGER = logging.getLogger(__name__)
+
+class Listener:
+    """
+    Ascultă notificările PostgreSQL (LISTEN / NOTIFY) pe o conexiune dedicată,
+    într-un thread separat, și le transmite funcțiilor abonate. Un singur
+    Listener per proces deservește oricâți abonați.
+
+    Notificările trimise cât timp conexiunea este căzută se pierd, așa că
+    după fiecare reconectare sunt apelate funcțiile înregistrate cu
+    on_reconnect(), care își pot reface starea.
+    """
+    def __init__(self, poll_interval=5.0, **conn_kwargs):
+        """
+        Args:
+            poll_interval - cât așteaptă o notificare, în secunde, înainte de
+                a verifica dacă abonații s-au schimbat.
+            conn_kwargs - argumentele pentru psycopg2.connect().
+        """
+        self.poll_interval = poll_interval
+        self._conn_kwargs = conn_kwargs
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._reconnect_callbacks = []
+        self._listening = set()
+        self._thread = None
+        # Setat după ce primele canale abonate sunt ascultate.
+        self.ready = threading.Event()
+
+    def subscribe(self, channel, callback):
+        """
+        Abonează o funcție la un canal.
+
+        Args:
+            channel - numele canalului.
+            callback - funcția, apelată cu conținutul (payload) notificării.
+        """
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        """
+        Anulează o abonare făcută cu subscribe().
+        """
+        with self._lock:
+            callbacks = self._subscribers.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def on_reconnect(self, callback):
+        """
+        Înregistrează o funcție fără argumente, apelată după ce conexiunea de
+        ascultare a fost refăcută.
+        """
+        with self._lock:
+            self._reconnect_callbacks.append(callback)
+
+    def start(self):
+        """
+        Pornește thread-ul de ascultare, dacă nu a fost deja pornit.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="pg-listener")
+            self._thread.start()
+
+    def _connect(self):
+        """
+        Deschide conexiunea de ascultare, reîncercând până reușește.
+        """
+        while True:
+            try:
+                conn = psycopg2.connect(**self._conn_kwargs)
+                conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                return conn
+            except psycopg2.OperationalError:
+                sleep(1)
+
+    def _listen_new_channels(self, conn):
+        """
+        Trimite LISTEN pentru canalele abonate de la ultima verificare.
+        """
+        with self._lock:
+            channels = set(self._subscribers) - self._listening
+
+        cursor = conn.cursor()
+        for channel in channels:
+            cursor.execute("LISTEN %s;" % psycopg2.extensions.quote_ident(
+                channel, cursor))
+            self._listening.add(channel)
+        cursor.close()
+
+    def _dispatch(self, notify):
+        """
+        Transmite o notificare abonaților canalului ei.
+        """
+        with self._lock:
+            callbacks = list(self._subscribers.get(notify.channel, []))
+
+        for callback in callbacks:
+            try:
+                callback(notify.payload)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Abonatul canalului %s a eșuat.",
+                                 notify.channel)
+
+    def _run(self):
+        """
+        Bucla thread-ului de ascultare.
+        """
+        first = True
+
+        while True:
+            conn = self._connect()
+            self._listening = set()
+
+            try:
+                self._listen_new_channels(conn)
+                self.ready.set()
+
+                if not first:
+                    with self._lock:
+                        callbacks = list(self._reconnect_callbacks)
+                    for callback in callbacks:
+                        callback()
+                first = False
+
+                while True:
+                    readable, _, _ = select.select([conn], [], [],
+                                                   self.poll_interval)
+                    if readable:
+                        conn.poll()
+                        while conn.notifies:
+                            self._dispatch(conn.notifies.pop(0))
+                    self._listen_new_channels(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                LOGGER.warning("Conexiunea de ascultare a căzut; se reface.")
+                conn.close()
+                sleep(1)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from datetime import datetime
+from time import sleep
+
+import logging
+import threading
+
+import psycopg2
+
+import rollups
+
+LOGGER = logging.getLogger(__name__)
+
+# Cheia lacătului consultativ care împiedică două procese să creeze sau să
+# șteargă simultan partiții.
+PARTITION_LOCK_ID = 20201127
+
+def month_start(timestamp):
+    """
+    Returns:
+        datetime: începutul lunii în care se află timestamp-ul
+    """
+    return datetime(timestamp.year, timestamp.month, 1)
+
+def add_months(month, count):
+    """
+    Returns:
+        datetime: începutul lunii aflate la count luni după luna dată
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def partition_name(month):
+    """
+    Returns:
+        str: numele partiției lunii date (de exemplu, temperatures_p202011)
+    """
+    return "temperatures_p%04d%02d" % (month.year, month.month)
+
+def existing_partitions(cursor):
+    """
+    Returns:
+        dict: luna fiecărei partiții a tabelului temperatures, cu numele ei
+    """
+    cursor.execute(""" SELECT child.relname FROM pg_inherits              \
+                       INNER JOIN pg_class AS child                       \
+                       ON child.oid = pg_inherits.inhrelid                \
+                       WHERE pg_inherits.inhparent =                      \
+                       'temperatures'::regclass; """)
+
+    months = {}
+    for (name,) in cursor.fetchall():
+        try:
+            month = datetime.strptime(name, "temperatures_p%Y%m")
+        except ValueError:
+            # Partiție creată de altcineva; nu este administrată de aici.
+            continue
+        months[month] = name
+
+    return months
+
+def create_partitions(cursor, months):
+    """
+    Creează, în tranzacția curentă, partițiile lunare care lipsesc.
+
+    Args:
+        cursor - cursorul tranzacției.
+        months - lunile (începutul lor) pentru care trebuie să existe partiții.
+    Returns:
+        list: numele partițiilor create
+    """
+    cursor.execute(""" SELECT pg_advisory_xact_lock(%s); """,
+                   (PARTITION_LOCK_ID,))
+    existing = existing_partitions(cursor)
+
+    created = []
+    for month in sorted(set(months) - set(existing)):
+        name = partition_name(month)
+        cursor.execute(""" CREATE TABLE %s PARTITION OF temperatures       \
+                           FOR VALUES FROM (%%s) TO (%%s); """ % name,
+                       (month, add_months(month, 1)))
+        created.append(name)
+
+    return created
+
+def drop_partitions_before(cursor, horizon):
+    """
+    Șterge, în tranzacția curentă, partițiile lunilor dinaintea orizontului
+    dat, împreună cu agregatele temperaturilor din ele.
+
+    Returns:
+        list: numele partițiilor șterse
+    """
+    cursor.execute(""" SELECT pg_advisory_xact_lock(%s); """,
+                   (PARTITION_LOCK_ID,))
+
+    dropped = []
+    for month, name in sorted(existing_partitions(cursor).items()):
+        if month < horizon:
+            cursor.execute(""" DROP TABLE %s; """ % name)
+            dropped.append(name)
+
+    if dropped:
+        rollups.discard_before(cursor, horizon)
+
+    return dropped
+
+class PartitionManager:
+    """
+    Administrează partițiile lunare ale tabelului temperatures: creează din
+    timp partițiile lunilor următoare și, dacă este configurată o perioadă de
+    retenție, șterge partițiile întregi mai vechi de atât.
+
+    Partițiile lunilor trecute sunt create la cerere, când se adaugă
+    temperaturi din ele. Temperaturile mai vechi decât perioada de retenție
+    sau mai noi decât ultima partiție creată din timp sunt refuzate.
+    """
+    def __init__(self, premake_months, retention_months=0):
+        """
+        Args:
+            premake_months - pentru câte luni după cea curentă se creează
+                partițiile din timp.
+            retention_months - câte luni întregi dinaintea lunii curente se
+                păstrează; 0 păstrează toate temperaturile.
+        """
+        self.premake_months = premake_months
+        self.retention_months = retention_months
+        self._lock = threading.Lock()
+        self._known = set()
+        self._thread = None
+
+    def horizon(self, now):
+        """
+        Returns:
+            datetime: cel mai vechi moment păstrat
+            None: dacă nu există retenție
+        """
+        if self.retention_months <= 0:
+            return None
+        return add_months(month_start(now), -self.retention_months)
+
+    def accepts(self, timestamp, now):
+        """
+        Returns:
+            True, dacă o temperatură din momentul dat poate fi păstrată
+            False, altfel
+        """
+        horizon = self.horizon(now)
+        if horizon is not None and timestamp < horizon:
+            return False
+        return timestamp < add_months(month_start(now),
+                                      self.premake_months + 1)
+
+    def missing(self, timestamps):
+        """
+        Returns:
+            set: lunile momentelor date pentru care nu se știe că există
+            partiții
+        """
+        months = {month_start(timestamp) for timestamp in timestamps}
+        with self._lock:
+            return months - self._known
+
+    def ensure(self, conn, timestamps):
+        """
+        Creează partițiile care lipsesc pentru momentele date, cu excepția
+        celor refuzate de accepts(), într-o tranzacție separată. Partițiile
+        nu sunt create în tranzacția care inserează temperaturile, pentru că
+        blochează tabelul temperatures până la commit.
+
+        Args:
+            conn - conexiunea psycopg2, fără tranzacție în desfășurare.
+            timestamps - momentele temperaturilor de inserat.
+        """
+        months = self.missing(timestamps)
+        if not months:
+            return
+
+        cursor = conn.cursor()
+        try:
+            cursor.execute(""" SELECT LOCALTIMESTAMP; """)
+            now = cursor.fetchone()[0]
+            months = [month for month in months if self.accepts(month, now)]
+            created = create_partitions(cursor, months)
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        conn.commit()
+
+        if created:
+            LOGGER.info("Partiții create: %s", created)
+
+        with self._lock:
+            self._known.update(months)
+
+    def maintain(self, conn):
+        """
+        Creează partițiile lunii curente și ale următoarelor premake_months
+        luni și șterge partițiile expirate.
+
+        Args:
+            conn - conexiunea psycopg2, fără tranzacție în desfășurare.
+        Returns:
+            dict: numele partițiilor create și ale celor șterse
+        """
+        cursor = conn.cursor()
+        try:
+            cursor.execute(""" SELECT LOCALTIMESTAMP; """)
+            now = cursor.fetchone()[0]
+            current = month_start(now)
+
+            created = create_partitions(
+                cursor, [add_months(current, count)
+                         for count in range(self.premake_months + 1)])
+
+            horizon = self.horizon(now)
+            dropped = drop_partitions_before(cursor, horizon) \
+                      if horizon is not None else []
+
+            known = set(existing_partitions(cursor))
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        conn.commit()
+
+        with self._lock:
+            self._known = known
+
+        return {"created": created, "dropped": dropped}
+
+    def start(self, pool, interval):
+        """
+        Pornește thread-ul care rulează maintain() periodic, dacă nu a fost
+        deja pornit.
+
+        Args:
+            pool - pool-ul din care se iau conexiunile.
+            interval - secundele dintre două rulări.
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                sleep(interval)
+                try:
+                    with pool.connection() as conn:
+                        result = self.maintain(conn)
+                    if result["created"] or result["dropped"]:
+                        LOGGER.info("Partiții create: %s, șterse: %s",
+                                    result["created"], result["dropped"])
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Întreținerea partițiilor a eșuat.")
+
+        self._thread = threading.Thread(target=run, daemon=True,
+                                        name="pg-partitions")
+        self._thread.start()
@@ -0,0 +1,1010 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from contextlib import contextmanager
+from datetime import date
+from time import sleep
+
+import logging
+import os
+
+import psycopg2
+import psycopg2.errors
+
+from db_pool import ConnectionPool, PoolTimeout, connection_params
+from ingest import WriteBehindWriter
+from metrics import TimedCursor
+from migrations import migrate
+from notify import Listener
+from partitions import PartitionManager
+from profiling import SlowQueryLog
+from replicas import Replica, ReplicaRouter, replica_params
+from rollups import add_readings, refresh_buckets
+from serialization import register_numeric_as_float
+from storage import (Conflict, InvalidValue, MissingReference, QueryTimeout,
+                     Results, Storage, StorageError, Transaction, Unavailable,
+                     update_statuses)
+import feed
+import statements
+
+LOGGER = logging.getLogger(__name__)
+
+# Valorile NUMERIC sunt întoarse direct ca float, gata de serializat.
+register_numeric_as_float()
+
+# Coloanele întoarse de rutele care citesc temperaturi; momentul are
+# formatul storage.DISPLAY_FORMAT.
+TEMP_COLUMNS = """ temperatures.city_id, temperatures.temp_id,                 \
+                   temperatures.temp_value,                                   \
+                   TO_CHAR(temperatures.temp_timestamp,'YYYY-MM-DD HH:MI:SS') \
+                   AS temp_timestamp """
+# Ordinea temperaturilor în rutele de citire și în paginare.
+TEMP_ORDER = "ORDER BY temperatures.temp_timestamp, temperatures.temp_id"
+
+def is_date(value):
+    """
+    Returns:
+        True, dacă valoarea este o dată calendaristică („2020-11-25”)
+        False, altfel
+    """
+    try:
+        date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return False
+
+    return True
+
+@contextmanager
+def translate_errors():
+    """
+    Context manager care transformă erorile psycopg2 și ale pool-ului în
+    erorile din storage.py. Celelalte erori psycopg2 (de exemplu, o
+    instrucțiune greșită) nu sunt transformate.
+    """
+    try:
+        yield
+    except psycopg2.errors.QueryCanceled as err:
+        # Bugetul de timp a fost depășit sau interogarea a fost anulată.
+        raise QueryTimeout() from err
+    except (psycopg2.errors.NumericValueOutOfRange,
+            psycopg2.errors.StringDataRightTruncation) as err:
+        # O valoare nu încape în coloana ei.
+        raise InvalidValue() from err
+    except psycopg2.errors.ForeignKeyViolation as err:
+        raise MissingReference() from err
+    except psycopg2.errors.UniqueViolation as err:
+        raise Conflict() from err
+    except (psycopg2.OperationalError, psycopg2.InterfaceError,
+            PoolTimeout) as err:
+        # Baza de date nu este disponibilă (de exemplu, este repornită) sau
+        # toate conexiunile sunt ocupate. O conexiune stricată este
+        # înlocuită de pool la o cerere următoare.
+        raise Unavailable() from err
+
+def limit_statements(cursor, timeout):
+    """
+    Limitează durata instrucțiunilor SQL din tranzacția curentă a cursorului
+    la timeout milisecunde (0 nu o limitează); o instrucțiune care o
+    depășește este anulată de server, cu QueryCanceled.
+    """
+    if timeout > 0:
+        cursor.execute(""" SET LOCAL statement_timeout = %s; """, (timeout,))
+
+def temp_filters(filters, table="temperatures",
+                 ts_column="temperatures.temp_timestamp"):
+    """
+    Construiește condițiile pentru filtrele unei citiri de temperaturi (vezi
+    Storage.temperatures()).
+
+    Args:
+        filters - dicționarul de filtre.
+        table - tabelul filtrat, care are coloana city_id (temperatures sau
+            un tabel de agregate).
+        ts_column - coloana cu momentul temperaturii.
+    Returns:
+        (from_clause, conditions, params) - tabelele, cu legătura cu tabelul
+        cities dacă este nevoie de ea, condițiile (SQL cu parametri %s) și
+        parametrii lor
+    """
+    conditions = []
+    params = []
+
+    if "city" in filters:
+        conditions.append("%s.city_id = %%s" % table)
+        params.append(filters["city"])
+
+    if "cities" in filters:
+        conditions.append("%s.city_id = ANY(%%s)" % table)
+        params.append(list(filters["cities"]))
+
+    join_cities = False
+    for name, column in (("country", "cities.country_id"),
+                         ("lat", "cities.city_lat"),
+                         ("lon", "cities.city_lon")):
+        if name in filters:
+            conditions.append("%s = %%s" % column)
+            params.append(filters[name])
+            join_cities = True
+
+    # Capătul „until” este inclusiv: se întorc și temperaturile din acea zi.
+    if "from" in filters:
+        conditions.append("%s >= %%s::timestamp" % ts_column)
+        params.append(filters["from"])
+
+    if "until" in filters:
+        conditions.append("%s < %%s::timestamp + '1 day'::interval" %
+                          ts_column)
+        params.append(filters["until"])
+
+    from_clause = table
+    if join_cities:
+        from_clause += """ INNER JOIN cities                                  \
+                           ON %s.city_id = cities.city_id """ % table
+
+    return from_clause, conditions, params
+
+def where(conditions):
+    """
+    Returns:
+        str: clauza WHERE cu toate condițiile sau nimic, dacă nu există
+    """
+    return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+class PostgresStorage(Storage):
+    """
+    Stocarea în PostgreSQL, cu un pool de conexiuni pentru fiecare proces.
+
+    Dimensiunea pool-ului se configurează prin variabilele de mediu
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT (secunde de așteptare pentru o
+    conexiune liberă) și DB_POOL_CHECK_INTERVAL (după câte secunde de
+    inactivitate se verifică o conexiune înainte de a fi folosită).
+    Citirile de temperaturi pot merge la replicile din DB_REPLICAS (vezi
+    replicas.py).
+
+    Schema este adusă la ultima versiune de open(), cu migrările din
+    migrations.py care lipsesc. Tot aici sunt create partițiile lunilor
+    următoare ale temperaturilor, este pornită întreținerea lor periodică și,
+    cu TEMP_WRITE_BEHIND=1, este pornită scrierea în loturi a temperaturilor
+    (vezi ingest.py). Notificările merg prin LISTEN / NOTIFY, deci ajung la
+    toate procesele serviciului.
+    """
+    def __init__(self):
+        db_params = connection_params()
+
+        self.pool = ConnectionPool(
+            minconn=int(os.getenv("DB_POOL_MIN", "1")),
+            maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+            timeout=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+            check_interval=float(os.getenv("DB_POOL_CHECK_INTERVAL", "30")),
+            cursor_factory=TimedCursor,
+            **db_params
+        )
+
+        # Replicile de citire: DSN-uri separate prin „;”, fiecare cu pool-ul
+        # său, deschis leneș.
+        replicas = []
+        for params in replica_params(os.getenv("DB_REPLICAS", ""), db_params):
+            replicas.append(Replica(
+                "%s:%s" % (params["host"], params["port"]),
+                ConnectionPool(
+                    minconn=0,
+                    maxconn=int(os.getenv("DB_REPLICA_POOL_MAX",
+                                          os.getenv("DB_POOL_MAX", "10"))),
+                    timeout=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+                    check_interval=float(
+                        os.getenv("DB_POOL_CHECK_INTERVAL", "30")),
+                    cursor_factory=TimedCursor,
+                    **params
+                ),
+                params))
+
+        # Împărțirea citirilor între replici, dacă DB_REPLICAS este setat.
+        self.router = None
+        if replicas:
+            self.router = ReplicaRouter(
+                self.pool, replicas,
+                policy=os.getenv("DB_REPLICA_POLICY", "round_robin"),
+                max_lag=float(os.getenv("DB_REPLICA_MAX_LAG", "5")),
+                check_interval=float(
+                    os.getenv("DB_REPLICA_CHECK_INTERVAL", "1")))
+            self.replicated = True
+
+        # Interogările mai lente de SLOW_QUERY_MS milisecunde (0 dezactivează
+        # jurnalul) sunt scrise în jurnal, unele cu planul de execuție.
+        slow_query_ms = float(os.getenv("SLOW_QUERY_MS", "0"))
+        if slow_query_ms > 0:
+            TimedCursor.slow_log = SlowQueryLog(
+                db_params, threshold=slow_query_ms / 1000,
+                explain_sample=float(
+                    os.getenv("SLOW_QUERY_EXPLAIN_SAMPLE", "1")),
+                max_per_minute=int(
+                    os.getenv("SLOW_QUERY_MAX_PER_MINUTE", "10")))
+
+        # Partițiile lunare ale temperaturilor: câte luni viitoare sunt create
+        # din timp și câte luni întregi trecute sunt păstrate (0 le păstrează
+        # pe toate), plus la câte secunde sunt create partițiile noi și
+        # șterse cele expirate.
+        self.partitions = PartitionManager(
+            premake_months=int(os.getenv("TEMP_PARTITION_PREMAKE", "3")),
+            retention_months=int(os.getenv("TEMP_RETENTION_MONTHS", "0")))
+        self.partition_interval = float(
+            os.getenv("TEMP_PARTITION_INTERVAL", "3600"))
+
+        self.listener = Listener(**db_params)
+
+    def subscribe(self, channel, callback):
+        self.listener.subscribe(channel, callback)
+
+    def on_reconnect(self, callback):
+        self.listener.on_reconnect(callback)
+
+    def open(self):
+        """
+        Rulează în buclă până pornește serverul bazei de date.
+        """
+        self.listener.start()
+
+        while True:
+            try:
+                self.pool.fill()
+
+                with self.pool.connection() as conn:
+                    applied = migrate(conn)
+                    maintained = self.partitions.maintain(conn)
+                break
+            except psycopg2.OperationalError:
+                sleep(1)
+
+        if applied:
+            LOGGER.info("Migrări aplicate: %s", applied)
+        if maintained["created"] or maintained["dropped"]:
+            LOGGER.info("Partiții create: %s, șterse: %s",
+                        maintained["created"], maintained["dropped"])
+
+        # Datele sunt citite de apelant după ce modificările lor pot fi
+        # primite, ca să nu se piardă niciuna.
+        self.listener.ready.wait(10)
+
+        self.partitions.start(self.pool, self.partition_interval)
+
+        if self.router is not None:
+            self.router.start()
+
+        if os.getenv("TEMP_WRITE_BEHIND", "0") == "1":
+            self.writer = WriteBehindWriter(
+                self.pool,
+                flush_interval=float(
+                    os.getenv("TEMP_FLUSH_INTERVAL_MS", "5")) / 1000,
+                flush_rows=int(os.getenv("TEMP_FLUSH_ROWS", "500")),
+                max_queued=int(os.getenv("TEMP_QUEUE_MAX", "10000")),
+                queue_timeout=float(os.getenv("TEMP_QUEUE_TIMEOUT", "1")))
+            self.writer.start()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def transaction(self, timeout=0):
+        return PostgresTransaction(self, timeout)
+
+    def _page(self, query, params, timeout):
+        """
+        Returns:
+            (description, rows): rezultatul unei interogări de citire,
+            rulată pe serverul principal
+        """
+        with translate_errors(), self.pool.connection() as conn:
+            cursor = conn.cursor()
+            limit_statements(cursor, timeout)
+            statements.execute(cursor, query, params)
+            rows = cursor.fetchall()
+            description = cursor.description
+            cursor.close()
+            conn.commit()
+        return description, rows
+
+    def countries_page(self, limit, after=None, timeout=0):
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append("country_id > %s")
+            params.append(after)
+
+        return self._page(""" SELECT * FROM countries %s                      \
+                              ORDER BY country_id LIMIT %%s; """ %
+                          where(conditions), params + [limit + 1], timeout)
+
+    def cities_page(self, limit, after=None, country_id=None, timeout=0):
+        conditions = []
+        params = []
+        if country_id is not None:
+            conditions.append("country_id = %s")
+            params.append(country_id)
+        if after is not None:
+            conditions.append("city_id > %s")
+            params.append(after)
+
+        return self._page(""" SELECT * FROM cities %s                         \
+                              ORDER BY city_id LIMIT %%s; """ %
+                          where(conditions), params + [limit + 1], timeout)
+
+    def countries_by_ids(self, ids, timeout=0):
+        return self._page(""" SELECT * FROM countries                          \
+                              WHERE country_id = ANY(%s)                     \
+                              ORDER BY country_id; """, (list(ids),), timeout)
+
+    def cities_by_ids(self, ids, timeout=0):
+        return self._page(""" SELECT * FROM cities WHERE city_id = ANY(%s)    \
+                              ORDER BY city_id; """, (list(ids),), timeout)
+
+    def find_cities(self, city_ids=None, country_ids=None):
+        with translate_errors(), self.pool.connection() as conn:
+            cities = find_cities(conn, city_ids, country_ids)
+            conn.commit()
+        return cities
+
+    def latest_readings(self, city_ids=None):
+        # Pentru fiecare oraș, o singură căutare în indexul
+        # (city_id, temp_timestamp, temp_id), de la capătul lui.
+        query = """ SELECT last.temp_id, cities.city_id, last.temp_value,     \
+                           last.temp_timestamp                               \
+                    FROM cities CROSS JOIN LATERAL (                         \
+                        SELECT temp_id, temp_value, temp_timestamp           \
+                        FROM temperatures                                    \
+                        WHERE temperatures.city_id = cities.city_id          \
+                        ORDER BY temp_timestamp DESC, temp_id DESC           \
+                        LIMIT 1) AS last """
+        params = None
+        if city_ids is not None:
+            query += " WHERE cities.city_id = ANY(%s)"
+            params = (list(city_ids),)
+
+        with translate_errors(), self.pool.connection() as conn:
+            cursor = conn.cursor()
+            statements.execute(cursor, query + ";", params)
+            rows = cursor.fetchall()
+            cursor.close()
+            conn.commit()
+        return rows
+
+    def read_connection(self, primary=False):
+        """
+        Alege conexiunea pentru o citire: o replică, dacă există una
+        disponibilă și citirea nu trebuie să meargă la serverul principal,
+        altfel serverul principal. Dacă replica aleasă nu răspunde, este
+        scoasă din rotație și se citește de la serverul principal.
+
+        Returns:
+            (pool, conexiune, replică sau None) - conexiunea trebuie întoarsă
+            în pool-ul ei
+        """
+        if self.router is not None and not primary:
+            pool, replica = self.router.choose()
+            if replica is not None:
+                try:
+                    return pool, pool.getconn(), replica
+                except psycopg2.OperationalError:
+                    self.router.failed(replica)
+                except PoolTimeout:
+                    # Replica este ocupată; citirea merge la serverul
+                    # principal.
+                    pass
+
+        with translate_errors():
+            return self.pool, self.pool.getconn(), None
+
+    def temperatures(self, filters, limit, after=None, timeout=0,
+                     primary=False):
+        from_clause, conditions, params = temp_filters(filters)
+        if after is not None:
+            conditions.append("(temperatures.temp_timestamp, "
+                              "temperatures.temp_id) > (%s, %s)")
+            params += list(after)
+
+        query = """ SELECT %s FROM %s %s %s LIMIT %%s; """ % (
+            TEMP_COLUMNS, from_clause, where(conditions), TEMP_ORDER)
+        # Cheia ultimului rând din pagină și, dacă există, a primului rând din
+        # pagina următoare.
+        key_query = """ SELECT temperatures.temp_timestamp,                   \
+                               temperatures.temp_id                          \
+                        FROM %s %s %s LIMIT 2 OFFSET %%s; """ % (
+                            from_clause, where(conditions), TEMP_ORDER)
+
+        return PostgresResults(self, primary, timeout, query,
+                               params + [limit], key_query,
+                               params + [limit - 1])
+
+    def temperature_stats(self, bucket, filters, timeout=0, primary=False):
+        if all(is_date(filters[name]) for name in ("from", "until")
+               if name in filters):
+            # Capetele intervalului sunt zile întregi, deci se pot folosi
+            # agregatele orare sau zilnice (vezi rollups.py) în locul
+            # temperaturilor.
+            table = "temp_rollup_hourly" if bucket == "hour" \
+                    else "temp_rollup_daily"
+            from_clause, conditions, params = temp_filters(
+                filters, table, "%s.bucket" % table)
+            query = """ SELECT TO_CHAR(DATE_TRUNC(%%s, %s.bucket),             \
+                                       'YYYY-MM-DD HH24:MI:SS') AS bucket,   \
+                        MIN(%s.temp_min) AS min,                             \
+                        MAX(%s.temp_max) AS max,                             \
+                        SUM(%s.temp_sum) / SUM(%s.temp_count) AS avg,        \
+                        SUM(%s.temp_count)::bigint AS count                  \
+                        FROM %s %s                                           \
+                        GROUP BY DATE_TRUNC(%%s, %s.bucket)                  \
+                        ORDER BY DATE_TRUNC(%%s, %s.bucket); """ % (
+                            (table,) * 6 + (from_clause, where(conditions)) +
+                            (table,) * 2)
+        else:
+            from_clause, conditions, params = temp_filters(filters)
+            query = """ SELECT TO_CHAR(DATE_TRUNC(%%s,                         \
+                                                  temperatures.temp_timestamp),\
+                                       'YYYY-MM-DD HH24:MI:SS') AS bucket,   \
+                        MIN(temperatures.temp_value) AS min,                 \
+                        MAX(temperatures.temp_value) AS max,                 \
+                        AVG(temperatures.temp_value) AS avg,                 \
+                        COUNT(*) AS count                                    \
+                        FROM %s %s                                           \
+                        GROUP BY DATE_TRUNC(%%s, temperatures.temp_timestamp)\
+                        ORDER BY DATE_TRUNC(%%s,                             \
+                                            temperatures.temp_timestamp); """ \
+                    % (from_clause, where(conditions))
+
+        return PostgresResults(self, primary, timeout, query,
+                               [bucket] + params + [bucket, bucket])
+
+    def stats(self):
+        stats = self.pool.stats()
+        if self.router is not None:
+            stats["replicas"] = self.router.stats()
+        return stats
+
+def find_cities(conn, city_ids=None, country_ids=None):
+    """
+    Citește orașele pe conexiunea dată (vezi Storage.find_cities()).
+    """
+    query = """ SELECT city_id, city_lat, city_lon, city_name, country_id \
+                FROM cities """
+    params = None
+    if city_ids is not None or country_ids is not None:
+        query += " WHERE city_id = ANY(%s) OR country_id = ANY(%s)"
+        params = (list(city_ids or ()), list(country_ids or ()))
+
+    cursor = conn.cursor()
+    statements.execute(cursor, query + ";", params)
+    columns = [column[0] for column in cursor.description]
+    cities = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    cursor.close()
+    return cities
+
+class PostgresTransaction(Transaction):
+    """
+    Tranzacție pe o conexiune din pool-ul serverului principal, scoasă la
+    prima instrucțiune și întoarsă în pool la ieșire; pool-ul anulează
+    tranzacția, dacă nu s-a făcut commit.
+    """
+    def __init__(self, storage, timeout):
+        self._storage = storage
+        self._timeout = timeout
+        self._conn = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._storage.pool.putconn(conn)
+
+    def _connection(self):
+        """
+        Returns:
+            conexiunea tranzacției, scoasă din pool la prima folosire
+        """
+        if self._conn is None:
+            with translate_errors():
+                self._conn = self._storage.pool.getconn()
+                cursor = self._conn.cursor()
+                limit_statements(cursor, self._timeout)
+                cursor.close()
+        return self._conn
+
+    def _cursor(self):
+        """
+        Returns:
+            un cursor nou al tranzacției
+        """
+        return self._connection().cursor()
+
+    def _fetch(self, query, params):
+        """
+        Returns:
+            list: rândurile întoarse de o instrucțiune a tranzacției
+        """
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                statements.execute(cursor, query, params)
+                return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _execute(self, query, params):
+        """
+        Rulează o instrucțiune a tranzacției care nu întoarce rânduri.
+        """
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                statements.execute(cursor, query, params)
+        finally:
+            cursor.close()
+
+    def add_country(self, name, lat, lon):
+        return self._fetch(""" INSERT INTO countries(country_name,            \
+                                                     country_lat,            \
+                                                     country_lon)            \
+                               VALUES(%s, %s, %s) RETURNING country_id; """,
+                           (name, lat, lon))[0][0]
+
+    def update_country(self, country_id, name, lat, lon):
+        return bool(self._fetch(""" UPDATE countries SET country_name=%s,     \
+                                    country_lat=%s, country_lon=%s           \
+                                    WHERE country_id=%s                      \
+                                    RETURNING country_id; """,
+                                (name, lat, lon, country_id)))
+
+    def delete_country(self, country_id):
+        return bool(self._fetch(""" DELETE FROM countries WHERE country_id=%s \
+                                    RETURNING 1; """, (country_id,)))
+
+    def add_city(self, country_id, name, lat, lon):
+        return self._fetch(""" INSERT INTO cities(country_id, city_name,      \
+                                                  city_lat, city_lon)        \
+                               VALUES(%s, %s, %s, %s) RETURNING city_id; """,
+                           (country_id, name, lat, lon))[0][0]
+
+    def update_city(self, city_id, country_id, name, lat, lon):
+        # Se întoarce și țara dinainte de modificare.
+        updated = self._fetch(""" UPDATE cities SET country_id=%s,            \
+                                  city_name=%s, city_lat=%s, city_lon=%s     \
+                                  FROM cities AS old                         \
+                                  WHERE cities.city_id=%s                    \
+                                  AND old.city_id=cities.city_id             \
+                                  RETURNING old.country_id; """,
+                              (country_id, name, lat, lon, city_id))
+        return updated[0][0] if updated else None
+
+    def delete_city(self, city_id):
+        deleted = self._fetch(""" DELETE FROM cities WHERE city_id=%s         \
+                                  RETURNING country_id; """, (city_id,))
+        return deleted[0][0] if deleted else None
+
+    def add_countries(self, items):
+        results = [None] * len(items)
+        pending = {}
+        rows = []
+        for idx, (name, lat, lon) in enumerate(items):
+            if name in pending:
+                # Același nume apare de două ori în lot.
+                results[idx] = (409, None)
+                continue
+            pending[name] = idx
+            rows.append((name, lat, lon))
+
+        inserted = []
+        if rows:
+            inserted = self._fetch(""" INSERT INTO countries(country_name,    \
+                                           country_lat, country_lon)         \
+                                       SELECT * FROM UNNEST(%s::varchar[],   \
+                                                            %s::numeric[],   \
+                                                            %s::numeric[])   \
+                                       ON CONFLICT (country_name) DO NOTHING \
+                                       RETURNING country_id,                 \
+                                       country_name; """,
+                                   [list(column) for column in zip(*rows)])
+
+        for country_id, name in inserted:
+            results[pending.pop(name)] = (201, country_id)
+        # Ce nu a fost inserat se lovește de o țară existentă.
+        for idx in pending.values():
+            results[idx] = (409, None)
+
+        return results
+
+    def update_countries(self, items):
+        # Țările modificate și cele care au deja numele noi sunt blocate până
+        # la commit.
+        current = self._fetch(""" SELECT country_id, country_name            \
+                                  FROM countries                             \
+                                  WHERE country_id = ANY(%s)                 \
+                                  OR country_name = ANY(%s) FOR UPDATE; """,
+                              ([item[0] for item in items],
+                               [item[1] for item in items]))
+        statuses = update_statuses(
+            [(country_id, name) for country_id, name, _, _ in items],
+            {row[0] for row in current}, {row[1]: row[0] for row in current})
+
+        rows = [item for item, status in zip(items, statuses)
+                if status == 200]
+        if rows:
+            self._execute(""" UPDATE countries SET country_name=new.name,     \
+                              country_lat=new.lat, country_lon=new.lon       \
+                              FROM UNNEST(%s::integer[], %s::varchar[],      \
+                                          %s::numeric[], %s::numeric[])      \
+                                   AS new(id, name, lat, lon)                \
+                              WHERE countries.country_id = new.id; """,
+                          [list(column) for column in zip(*rows)])
+
+        return statuses
+
+    def delete_countries(self, country_ids):
+        deleted = {row[0] for row in self._fetch(
+            """ DELETE FROM countries WHERE country_id = ANY(%s)              \
+                RETURNING country_id; """, (list(country_ids),))}
+
+        statuses = []
+        for country_id in country_ids:
+            statuses.append(200 if country_id in deleted else 404)
+            deleted.discard(country_id)
+        return statuses
+
+    def add_cities(self, items):
+        # Țările sunt blocate până la commit, ca să nu poată fi șterse între
+        # verificare și inserare.
+        known_countries = {row[0] for row in self._fetch(
+            """ SELECT country_id FROM countries WHERE country_id = ANY(%s)   \
+                FOR KEY SHARE; """, (list({item[0] for item in items}),))}
+
+        results = [None] * len(items)
+        pending = {}
+        rows = []
+        for idx, (country_id, name, lat, lon) in enumerate(items):
+            if country_id not in known_countries:
+                # Țara cu id-ul dat nu există.
+                results[idx] = (404, None)
+                continue
+            if (country_id, name) in pending:
+                # Același oraș apare de două ori în lot.
+                results[idx] = (409, None)
+                continue
+            pending[(country_id, name)] = idx
+            rows.append((country_id, name, lat, lon))
+
+        inserted = []
+        if rows:
+            inserted = self._fetch(""" INSERT INTO cities(country_id,         \
+                                           city_name, city_lat, city_lon)    \
+                                       SELECT * FROM UNNEST(%s::integer[],   \
+                                                            %s::varchar[],   \
+                                                            %s::numeric[],   \
+                                                            %s::numeric[])   \
+                                       ON CONFLICT (country_id, city_name)   \
+                                       DO NOTHING                            \
+                                       RETURNING city_id, country_id,        \
+                                       city_name; """,
+                                   [list(column) for column in zip(*rows)])
+
+        for city_id, country_id, name in inserted:
+            results[pending.pop((country_id, name))] = (201, city_id)
+        # Ce nu a fost inserat se lovește de un oraș existent.
+        for idx in pending.values():
+            results[idx] = (409, None)
+
+        return results
+
+    def update_cities(self, items):
+        known_countries = {row[0] for row in self._fetch(
+            """ SELECT country_id FROM countries WHERE country_id = ANY(%s)   \
+                FOR KEY SHARE; """, (list({item[1] for item in items}),))}
+
+        # Orașele modificate și cele care au deja numele noi, în aceeași
+        # țară, sunt blocate până la commit.
+        current = self._fetch(""" SELECT city_id, country_id, city_name      \
+                                  FROM cities WHERE city_id = ANY(%s)        \
+                                  OR (country_id, city_name) IN              \
+                                     (SELECT * FROM UNNEST(%s::integer[],    \
+                                                           %s::varchar[]))   \
+                                  FOR UPDATE; """,
+                              ([item[0] for item in items],
+                               [item[1] for item in items],
+                               [item[2] for item in items]))
+        old_countries = {row[0]: row[1] for row in current}
+        statuses = update_statuses(
+            [(city_id, (country_id, name))
+             if country_id in known_countries else None
+             for city_id, country_id, name, _, _ in items],
+            old_countries, {(row[1], row[2]): row[0] for row in current})
+
+        rows = [item for item, status in zip(items, statuses)
+                if status == 200]
+        if rows:
+            self._execute(""" UPDATE cities SET country_id=new.country_id,    \
+                              city_name=new.name, city_lat=new.lat,          \
+                              city_lon=new.lon                               \
+                              FROM UNNEST(%s::integer[], %s::integer[],      \
+                                          %s::varchar[], %s::numeric[],      \
+                                          %s::numeric[])                     \
+                                   AS new(id, country_id, name, lat, lon)    \
+                              WHERE cities.city_id = new.id; """,
+                          [list(column) for column in zip(*rows)])
+
+        results = []
+        for item, status in zip(items, statuses):
+            if status is None:
+                # Țara cu id-ul dat nu există.
+                results.append((404, None))
+            elif status == 200:
+                results.append((200, old_countries[item[0]]))
+            else:
+                results.append((status, None))
+        return results
+
+    def delete_cities(self, city_ids):
+        deleted = dict(self._fetch(""" DELETE FROM cities                     \
+                                       WHERE city_id = ANY(%s)               \
+                                       RETURNING city_id, country_id; """,
+                                   (list(city_ids),)))
+
+        results = []
+        for city_id in city_ids:
+            country_id = deleted.pop(city_id, None)
+            results.append((404, None) if country_id is None
+                           else (200, country_id))
+        return results
+
+    def add_temperature(self, city_id, value):
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                statements.execute(cursor, """ INSERT INTO temperatures(      \
+                                                   city_id, temp_value)      \
+                                               VALUES(%s, %s)                \
+                                               RETURNING temp_id, city_id,   \
+                                               temp_value,                   \
+                                               temp_timestamp; """,
+                                   (city_id, value))
+                temp_id, *reading = cursor.fetchone()
+                add_readings(cursor, [reading])
+                feed.publish(cursor, feed.CREATED, [[temp_id] + reading])
+        finally:
+            cursor.close()
+        return temp_id
+
+    def add_temperatures(self, items):
+        items = list(items)
+        partitions = self._storage.partitions
+
+        # Partițiile lunilor din trecut sunt create înainte de tranzacția
+        # lotului, care nu a început încă.
+        timestamps = [item[2] for item in items if item[2] is not None]
+        if self._conn is None and partitions.missing(timestamps):
+            with translate_errors(), self._storage.pool.connection() as conn:
+                partitions.ensure(conn, timestamps)
+
+        results = [None] * len(items)
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                # Orașele sunt blocate până la commit, ca să nu poată fi
+                # șterse între verificare și inserare.
+                statements.execute(cursor, """ SELECT city_id FROM cities     \
+                                               WHERE city_id = ANY(%s)       \
+                                               FOR KEY SHARE; """,
+                                   (list({item[0] for item in items}),))
+                known_cities = {row[0] for row in cursor.fetchall()}
+
+                statements.execute(cursor, """ SELECT LOCALTIMESTAMP; """)
+                now = cursor.fetchone()[0]
+
+                rows = []
+                pending = {}
+                for idx, (city_id, value, timestamp) in enumerate(items):
+                    if city_id not in known_cities:
+                        # Orașul cu id-ul dat nu există.
+                        results[idx] = (404, None)
+                        continue
+
+                    key = (city_id, timestamp if timestamp is not None
+                           else now)
+                    if not partitions.accepts(key[1], now):
+                        # Timestamp-ul este mai vechi decât perioada de
+                        # retenție sau prea departe în viitor.
+                        results[idx] = (400, None)
+                        continue
+
+                    if key in pending:
+                        # Același oraș și același timestamp apar de două ori
+                        # în lot.
+                        results[idx] = (409, None)
+                        continue
+
+                    pending[key] = idx
+                    rows.append((city_id, value, key[1]))
+
+                # Tot lotul este trimis ca trei liste, deci instrucțiunea are
+                # același text (și poate fi pregătită) pentru orice
+                # dimensiune a lotului.
+                inserted = []
+                if rows:
+                    statements.execute(
+                        cursor,
+                        """ INSERT INTO temperatures(city_id, temp_value,     \
+                                                     temp_timestamp)         \
+                            SELECT * FROM UNNEST(%s::integer[],              \
+                                                 %s::numeric[],              \
+                                                 %s::timestamp[])            \
+                            ON CONFLICT (temp_timestamp, city_id) DO NOTHING \
+                            RETURNING temp_id, city_id, temp_timestamp,      \
+                            temp_value; """,
+                        [list(column) for column in zip(*rows)])
+                    inserted = cursor.fetchall()
+                add_readings(cursor, [(city_id, value, timestamp)
+                                      for _, city_id, timestamp, value
+                                      in inserted])
+                feed.publish(cursor, feed.CREATED, [
+                    (temp_id, city_id, value, timestamp)
+                    for temp_id, city_id, timestamp, value in inserted])
+        finally:
+            cursor.close()
+
+        # Ce nu a fost inserat se lovește de o temperatură existentă.
+        for idx in pending.values():
+            results[idx] = (409, None)
+        for temp_id, city_id, timestamp, _ in inserted:
+            results[pending[(city_id, timestamp)]] = (201, temp_id)
+
+        return results
+
+    def update_temperature(self, temp_id, city_id, value):
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                statements.execute(cursor, """ UPDATE temperatures            \
+                                               SET city_id=%s, temp_value=%s \
+                                               FROM temperatures AS old      \
+                                               WHERE temperatures.temp_id=%s \
+                                               AND old.temp_id =             \
+                                                   temperatures.temp_id      \
+                                               RETURNING old.city_id,        \
+                                               temperatures.city_id,         \
+                                               temperatures.temp_timestamp,  \
+                                               temperatures.temp_value; """,
+                                   (city_id, value, temp_id))
+                updated = cursor.fetchall()
+                # Agregatele vechiului și noului oraș, din intervalul
+                # temperaturii.
+                refresh_buckets(cursor, [
+                    key for old_city, new_city, timestamp, _ in updated
+                    for key in ((old_city, timestamp), (new_city, timestamp))])
+                feed.publish(cursor, feed.UPDATED, [
+                    (temp_id, new_city, value, timestamp, old_city)
+                    for old_city, new_city, timestamp, value in updated])
+        finally:
+            cursor.close()
+        return bool(updated)
+
+    def delete_temperature(self, temp_id):
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                statements.execute(cursor, """ DELETE FROM temperatures       \
+                                               WHERE temp_id=%s              \
+                                               RETURNING city_id,            \
+                                               temp_timestamp; """,
+                                   (temp_id,))
+                deleted = cursor.fetchall()
+                refresh_buckets(cursor, deleted)
+                feed.publish(cursor, feed.DELETED, [
+                    (temp_id, city_id, None, timestamp)
+                    for city_id, timestamp in deleted])
+        finally:
+            cursor.close()
+        return bool(deleted)
+
+    def find_cities(self, city_ids=None, country_ids=None):
+        conn = self._connection()
+        with translate_errors():
+            return find_cities(conn, city_ids, country_ids)
+
+    def notify(self, channel, payload):
+        cursor = self._cursor()
+        try:
+            with translate_errors():
+                statements.execute(cursor, """ SELECT pg_notify(%s, %s); """,
+                                   (channel, payload))
+        finally:
+            cursor.close()
+
+    def commit(self):
+        if self._conn is not None:
+            with translate_errors():
+                self._conn.commit()
+
+class PostgresResults(Results):
+    """
+    Citire pe un cursor de server, într-o tranzacție REPEATABLE READ, deci
+    interogarea cheii paginii următoare și interogarea rândurilor văd aceleași
+    date. Conexiunea este ținută până la close() și este luată de la o
+    replică de citire, dacă există (vezi PostgresStorage.read_connection()).
+    """
+    def __init__(self, storage, primary, timeout, query, params,
+                 key_query=None, key_params=None):
+        self._storage = storage
+        self._primary = primary
+        self._timeout = timeout
+        self._query = query
+        self._params = params
+        self._key_query = key_query
+        self._key_params = key_params
+        self._pool = None
+        self._conn = None
+        self._cursor = None
+        self._cancelled = False
+
+    def open(self, size):
+        while True:
+            if self._cancelled:
+                raise QueryTimeout()
+
+            pool, conn, replica = self._storage.read_connection(
+                self._primary)
+            self._pool, self._conn = pool, conn
+            cursor = conn.cursor(name="stream_cursor")
+
+            try:
+                key_cursor = conn.cursor()
+                key_cursor.execute(""" SET TRANSACTION ISOLATION LEVEL \
+                                       REPEATABLE READ READ ONLY; """)
+                limit_statements(key_cursor, self._timeout)
+                if self._key_query is not None:
+                    statements.execute(key_cursor, self._key_query,
+                                       self._key_params)
+                    keys = key_cursor.fetchall()
+                    if len(keys) == 2:
+                        self.next_key = keys[0]
+                key_cursor.close()
+
+                cursor.execute(self._query, self._params)
+                rows = cursor.fetchmany(size)
+            except psycopg2.errors.QueryCanceled as err:
+                self.close()
+                raise QueryTimeout() from err
+            except psycopg2.Error as err:
+                self.close()
+                if conn.closed:
+                    if replica is None:
+                        raise Unavailable() from err
+                    # Replica a căzut; citirea se reia de la altă replică
+                    # sau de la serverul principal.
+                    self._storage.router.failed(replica)
+                    continue
+                # Unul din parametri a avut tipul greșit.
+                raise InvalidValue() from err
+
+            # Descrierea coloanelor unui cursor de server este cunoscută abia
+            # după prima citire.
+            self._cursor = cursor
+            self.description = cursor.description
+            return rows
+
+    def fetchmany(self, size):
+        try:
+            return self._cursor.fetchmany(size)
+        except psycopg2.errors.QueryCanceled as err:
+            raise QueryTimeout() from err
+        except psycopg2.Error as err:
+            raise StorageError(str(err)) from err
+
+    def cancel(self):
+        self._cancelled = True
+        conn = self._conn
+        if conn is not None:
+            conn.cancel()
+
+    def close(self):
+        # Tranzacția (și cu ea, cursorul de server) este anulată de pool.
+        conn, self._conn = self._conn, None
+        self._cursor = None
+        if conn is not None:
+            self._pool.putconn(conn)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from time import monotonic, sleep
+
+import logging
+import os
+import signal
+import socket
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIHandler, WSGIServer
+from gevent.socket import wait_read, wait_write
+
+import gevent
+import psycopg2
+import psycopg2.extensions
+
+LOGGER = logging.getLogger(__name__)
+
+def gevent_wait_callback(conn, timeout=None):
+    """
+    Așteaptă rezultatul unei operații psycopg2 fără a bloca procesul, lăsând
+    celelalte greenlet-uri să ruleze între timp.
+    """
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        if state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(
+                "Rezultat neașteptat de la poll(): %r" % state)
+
+def patch_psycopg():
+    """
+    Face ca toate conexiunile psycopg2 să cedeze controlul celorlalte
+    greenlet-uri cât timp așteaptă baza de date (ca psycogreen).
+    """
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+# Cheia din environ sub care workerii pun socket-ul clientului.
+SOCKET_KEY = "prefork.socket"
+
+class _Handler(WSGIHandler):
+    """
+    Handler-ul workerilor: pune socket-ul clientului în environ, pentru
+    DisconnectWatch.
+    """
+    def get_environ(self):
+        environ = super().get_environ()
+        environ[SOCKET_KEY] = self.socket
+        return environ
+
+class DisconnectWatch:
+    """
+    Urmărește, într-un greenlet separat, conexiunea clientului unei cereri
+    și apelează on_disconnect() dacă acesta o închide înainte de stop() (de
+    exemplu, pentru a anula interogarea cererii). Sub alte servere decât
+    PreforkServer, nu face nimic.
+    """
+    def __init__(self, environ, on_disconnect):
+        """
+        Args:
+            environ - environ-ul WSGI al cererii.
+            on_disconnect - funcția apelată la deconectarea clientului.
+        """
+        self._on_disconnect = on_disconnect
+        self.disconnected = False
+        sock = environ.get(SOCKET_KEY)
+        self._greenlet = gevent.spawn(self._run, sock) \
+                         if sock is not None else None
+
+    def _run(self, sock):
+        """
+        Așteaptă închiderea conexiunii.
+        """
+        try:
+            wait_read(sock.fileno())
+            if sock.recv(1, socket.MSG_PEEK):
+                # Clientul a trimis deja cererea următoare, deci este încă
+                # acolo.
+                return
+        except (OSError, ValueError):
+            pass
+
+        # stop() poate fi apelată între trezirea greenlet-ului și acest
+        # punct; după ea, funcția nu mai este apelată.
+        if self._on_disconnect is not None:
+            self.disconnected = True
+            self._on_disconnect()
+
+    def stop(self):
+        """
+        Oprește urmărirea; trebuie apelată înainte ca resursa anulată de
+        on_disconnect() (de exemplu, conexiunea la baza de date) să fie
+        refolosită.
+        """
+        self._on_disconnect = None
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+
+class PreforkServer:
+    """
+    Server WSGI de producție: un proces principal deschide socket-ul și
+    pornește mai multe procese worker, fiecare cu un server gevent care
+    deservește mii de conexiuni (inclusiv keep-alive) în greenlet-uri.
+
+    Procesul principal nu folosește baza de date; fiecare worker își
+    deschide propriile conexiuni prin init_worker(). Un worker oprit
+    neașteptat este repornit.
+
+    Semnale pentru procesul principal:
+        SIGTERM, SIGINT - oprire: workerii nu mai acceptă conexiuni noi și
+            termină cererile în curs, cel mult graceful_timeout secunde.
+        SIGHUP - reîncărcare: sunt porniți workeri noi, iar cei vechi sunt
+            opriți ca la SIGTERM, fără ca vreo conexiune să fie refuzată.
+        SIGTTIN, SIGTTOU - un worker în plus, respectiv în minus.
+    """
+    def __init__(self, app, address, workers, init_worker=None,
+                 exit_worker=None, drain_worker=None, graceful_timeout=30.0,
+                 worker_connections=10000, backlog=2048):
+        """
+        Args:
+            app - aplicația WSGI.
+            address - tuplul (adresă, port) pe care se ascultă.
+            workers - numărul de procese worker.
+            init_worker - funcție fără argumente apelată în fiecare worker,
+                după fork, înainte de a accepta conexiuni.
+            exit_worker - funcție fără argumente apelată în fiecare worker
+                după ce a terminat cererile în curs, înainte de a se opri.
+            drain_worker - funcție fără argumente apelată în fiecare worker
+                când începe oprirea, ca cererile care nu se termină singure
+                (fluxurile de evenimente) să fie încheiate.
+            graceful_timeout - cât așteaptă un worker oprit terminarea
+                cererilor în curs, în secunde.
+            worker_connections - numărul maxim de conexiuni deservite
+                simultan de un worker.
+            backlog - lungimea cozii de conexiuni a socket-ului.
+        """
+        self.app = app
+        self.address = address
+        self.workers = max(workers, 1)
+        self.init_worker = init_worker
+        self.exit_worker = exit_worker
+        self.drain_worker = drain_worker
+        self.graceful_timeout = graceful_timeout
+        self.worker_connections = worker_connections
+        self.backlog = backlog
+
+        self._socket = None
+        # Workerii activi și cei care se opresc: pid -> momentul opririi.
+        self._active = set()
+        self._stopping = {}
+        self._signals = []
+
+    def _listen(self):
+        """
+        Deschide socket-ul comun al workerilor.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Antetul și corpul răspunsului sunt trimise separat; fără
+        # TCP_NODELAY (moștenit de conexiunile acceptate), corpul ar aștepta
+        # confirmarea întârziată a antetului, adică ~40 ms.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def _spawn(self):
+        """
+        Pornește un worker nou.
+        """
+        pid = os.fork()
+        if pid:
+            self._active.add(pid)
+            return
+
+        status = 0
+        try:
+            self._run_worker()
+        except BaseException:  # pylint: disable=broad-except
+            LOGGER.exception("Workerul %d a eșuat.", os.getpid())
+            status = 1
+        finally:
+            # Workerul nu se întoarce niciodată în bucla procesului principal.
+            os._exit(status)  # pylint: disable=protected-access
+
+    def _run_worker(self):
+        """
+        Bucla unui worker.
+        """
+        master = os.getppid()
+
+        for signum in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, signal.SIG_IGN)
+
+        if self.init_worker is not None:
+            self.init_worker()
+
+        server = WSGIServer(self._socket, self.app,
+                            spawn=Pool(self.worker_connections),
+                            handler_class=_Handler,
+                            log=None, error_log=LOGGER)
+
+        def stop():
+            if self.drain_worker is not None:
+                self.drain_worker()
+            server.stop(timeout=self.graceful_timeout)
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            gevent.signal_handler(signum, gevent.spawn, stop)
+
+        def watch_master():
+            # Dacă procesul principal a murit, workerul se oprește și el.
+            while os.getppid() == master:
+                gevent.sleep(1)
+            stop()
+
+        gevent.spawn(watch_master)
+
+        LOGGER.info("Workerul %d ascultă pe %s:%d.", os.getpid(),
+                    *self.address)
+        server.serve_forever()
+
+        if self.exit_worker is not None:
+            self.exit_worker()
+
+    def _stop_worker(self, pid, signum=signal.SIGTERM):
+        """
+        Cere oprirea unui worker.
+        """
+        self._active.discard(pid)
+        self._stopping.setdefault(pid, monotonic())
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        """
+        Colectează workerii care s-au oprit.
+
+        Returns:
+            list: pid-urile workerilor activi care s-au oprit neașteptat
+        """
+        crashed = []
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid in self._active:
+                self._active.discard(pid)
+                crashed.append(pid)
+            self._stopping.pop(pid, None)
+        return crashed
+
+    def serve_forever(self):
+        """
+        Deschide socket-ul, pornește workerii și îi supraveghează până la
+        oprire.
+        """
+        self._socket = self._listen()
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                       signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, lambda signum, _frame:
+                          self._signals.append(signum))
+
+        LOGGER.info("Procesul principal %d pornește %d workeri.",
+                    os.getpid(), self.workers)
+
+        shutting_down = False
+        while not shutting_down or self._active or self._stopping:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    if not shutting_down:
+                        self._socket.close()
+                    shutting_down = True
+                    for pid in list(self._active):
+                        self._stop_worker(pid)
+                elif signum == signal.SIGHUP and not shutting_down:
+                    LOGGER.info("Reîncărcare: se înlocuiesc workerii.")
+                    old = list(self._active)
+                    for _ in range(self.workers):
+                        self._spawn()
+                    for pid in old:
+                        self._stop_worker(pid)
+                elif signum == signal.SIGTTIN:
+                    self.workers += 1
+                elif signum == signal.SIGTTOU:
+                    self.workers = max(self.workers - 1, 1)
+
+            for pid in self._reap():
+                LOGGER.warning("Workerul %d s-a oprit neașteptat.", pid)
+
+            if not shutting_down:
+                while len(self._active) < self.workers:
+                    self._spawn()
+                while len(self._active) > self.workers:
+                    self._stop_worker(max(self._active))
+
+            # Workerii care nu s-au oprit la timp sunt omorâți.
+            now = monotonic()
+            for pid, since in list(self._stopping.items()):
+                if now - since > self.graceful_timeout + 5:
+                    self._stop_worker(pid, signal.SIGKILL)
+                    self._stopping[pid] = now
+
+            sleep(0.2)
+
+        LOGGER.info("Procesul principal %d s-a oprit.", os.getpid())
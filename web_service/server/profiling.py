@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from collections import deque
+from datetime import datetime
+from time import monotonic
+
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+
+import psycopg2
+
+import statements
+
+LOGGER = logging.getLogger(__name__)
+
+# Cât dintr-o interogare sau din parametrii ei ajunge în jurnal.
+MAX_LOGGED_CHARS = 2000
+
+# Instrucțiunile care au plan de execuție și, dintre ele, cele care pot fi
+# executate din nou (EXPLAIN ANALYZE) fără efecte: interogările fără
+# modificări (nici în WITH, nici FOR UPDATE) și fără funcții cu efecte în
+# afara tranzacției (lacătele consultative de sesiune rămân luate după
+# ROLLBACK).
+EXPLAINABLE = re.compile(
+    r"\s*(SELECT|WITH|VALUES|TABLE|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+READ_ONLY = re.compile(r"\s*(SELECT|WITH|VALUES|TABLE)\b", re.IGNORECASE)
+SIDE_EFFECTS = re.compile(
+    r"\b(pg_\w*advisory\w*|pg_notify|nextval|setval)\s*\(|"
+    r"\b(INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+def _shorten(text):
+    """
+    Returns:
+        str: textul pe un singur rând, trunchiat la MAX_LOGGED_CHARS
+    """
+    text = " ".join(text.split())
+    if len(text) > MAX_LOGGED_CHARS:
+        return text[:MAX_LOGGED_CHARS] + "... (%d caractere)" % len(text)
+    return text
+
+class SlowQueryLog:
+    """
+    Jurnalul interogărilor lente: fiecare apel execute() / fetch*() care
+    durează cel puțin threshold secunde este scris în jurnal, cu SQL-ul,
+    parametrii și durata, cel mult max_per_minute pe minut (restul sunt doar
+    numărate).
+
+    O fracțiune explain_sample din interogările scrise în jurnal primește și
+    planul de execuție, obținut pe o conexiune separată, dintr-un thread
+    separat, ca cererea să nu aștepte: EXPLAIN (ANALYZE, BUFFERS) pentru
+    SELECT, rulat într-o tranzacție READ ONLY, și EXPLAIN simplu pentru
+    celelalte instrucțiuni (INSERT, UPDATE, DELETE și interogările cu
+    efecte), care nu trebuie executate din nou.
+    """
+    def __init__(self, conn_kwargs, threshold, explain_sample=1.0,
+                 max_per_minute=10, explain_timeout=30.0):
+        """
+        Args:
+            conn_kwargs - argumentele pentru psycopg2.connect() ale
+                conexiunii folosite pentru EXPLAIN.
+            threshold - durata minimă, în secunde, a unei interogări lente.
+            explain_sample - fracțiunea (între 0 și 1) din interogările
+                lente scrise în jurnal pentru care se obține planul.
+            max_per_minute - numărul maxim de interogări lente scrise în
+                jurnal pe minut.
+            explain_timeout - durata maximă, în secunde, a unui EXPLAIN.
+        """
+        self.threshold = threshold
+        self.explain_sample = explain_sample
+        self.max_per_minute = max_per_minute
+        self.explain_timeout = explain_timeout
+        self._conn_kwargs = conn_kwargs
+
+        self._lock = threading.Lock()
+        # Momentele ultimelor interogări scrise în jurnal, pentru limită.
+        self._logged = deque()
+        self._pending = deque()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+        self._slow = 0
+        self._suppressed = 0
+        self._explained = 0
+
+    def _allow(self):
+        """
+        Returns:
+            True, dacă interogarea poate fi scrisă în jurnal acum (se
+            apelează cu self._lock luat)
+        """
+        now = monotonic()
+        while self._logged and now - self._logged[0] >= 60:
+            self._logged.popleft()
+        if len(self._logged) >= self.max_per_minute:
+            return False
+        self._logged.append(now)
+        return True
+
+    def record(self, query, params, seconds, route):
+        """
+        Înregistrează o interogare lentă.
+
+        Args:
+            query - SQL-ul, cu parametrii nelegați (str sau bytes).
+            params - parametrii interogării.
+            seconds - durata apelului.
+            route - ruta cererii care a rulat interogarea.
+        """
+        if isinstance(query, bytes):
+            query = query.decode(errors="replace")
+        # Pentru o instrucțiune pregătită, planul este al interogării ei.
+        query = statements.source(query)
+
+        with self._lock:
+            self._slow += 1
+            if not self._allow():
+                self._suppressed += 1
+                return
+
+            if EXPLAINABLE.match(query) and \
+               random.random() < self.explain_sample:
+                self._pending.append((query, params, seconds, route))
+                self._wakeup.notify()
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, daemon=True, name="slow-queries")
+                    self._thread.start()
+                return
+
+        LOGGER.warning("Interogare lentă (%.1f ms, ruta %s): %s "
+                       "Parametri: %s", seconds * 1000, route,
+                       _shorten(query), _shorten(repr(params)))
+
+    def _explain(self, conn, query, params):
+        """
+        Returns:
+            str: planul de execuție al interogării
+        """
+        analyze = READ_ONLY.match(query) is not None and \
+            SIDE_EFFECTS.search(query) is None
+        cursor = conn.cursor()
+        try:
+            cursor.execute(""" SET TRANSACTION READ ONLY; """)
+            cursor.execute(""" SET LOCAL statement_timeout = %s; """,
+                           (int(self.explain_timeout * 1000),))
+            cursor.execute(("EXPLAIN (ANALYZE, BUFFERS) " if analyze
+                            else "EXPLAIN ") + query, params)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.close()
+            conn.rollback()
+
+    def _run(self):
+        """
+        Bucla thread-ului care obține planurile interogărilor lente.
+        """
+        conn = None
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+                query, params, seconds, route = self._pending.popleft()
+
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(**self._conn_kwargs)
+                plan = self._explain(conn, query, params)
+            except psycopg2.Error as err:
+                plan = "(planul nu a putut fi obținut: %s)" % (
+                    str(err).strip(),)
+                if conn is not None and not conn.closed:
+                    conn.rollback()
+            else:
+                with self._lock:
+                    self._explained += 1
+
+            LOGGER.warning("Interogare lentă (%.1f ms, ruta %s): %s "
+                           "Parametri: %s\n%s", seconds * 1000, route,
+                           _shorten(query), _shorten(repr(params)), plan)
+
+    def stats(self):
+        """
+        Returns:
+            dict cu numărul de interogări lente
+        """
+        with self._lock:
+            return {"threshold_ms": self.threshold * 1000,
+                    "slow": self._slow, "suppressed": self._suppressed,
+                    "explained": self._explained,
+                    "pending": len(self._pending)}
+
+class ProfilerMiddleware:
+    """
+    Middleware WSGI care rulează unele cereri sub cProfile, inclusiv
+    trimiterea corpului răspunsului (pentru fluxuri, aici se citește din
+    baza de date și se serializează):
+
+    * cererile cu antetul „X-Profile: <token>” primesc, în locul corpului,
+      raportul profilului (text, primele funcții după timpul cumulat), iar
+      codul original este pus în antetul X-Profiled-Status;
+    * o fracțiune sample din celelalte cereri este profilată în fundal, iar
+      profilul (format pstats, de deschis cu pstats sau snakeviz) este
+      salvat în directory.
+
+    Un singur profil rulează la un moment dat într-un proces; sub gevent,
+    profilul conține și celelalte greenlet-uri rulate între timp.
+    """
+    def __init__(self, app, token="", sample=0.0, directory=None,
+                 report_lines=60):
+        """
+        Args:
+            app - aplicația WSGI.
+            token - valoarea cerută în antetul X-Profile; gol dezactivează
+                antetul.
+            sample - fracțiunea (între 0 și 1) din cereri profilate în fundal.
+            directory - directorul în care sunt salvate profilurile; None nu
+                le salvează (și dezactivează eșantionarea).
+            report_lines - câte funcții apar în raportul întors.
+        """
+        self.app = app
+        self.token = token
+        self.sample = sample if directory else 0.0
+        self.directory = directory
+        self.report_lines = report_lines
+        self._busy = threading.Lock()
+
+    def _requested(self, environ):
+        """
+        Returns:
+            True, dacă cererea a cerut profilul prin antet
+        """
+        header = environ.get("HTTP_X_PROFILE")
+        return bool(self.token) and header is not None and \
+            hmac.compare_digest(header.encode(), self.token.encode())
+
+    def _save(self, profiler, environ):
+        """
+        Salvează profilul în self.directory.
+        """
+        name = "%s-%d-%s-%s.prof" % (
+            datetime.now().strftime("%Y%m%dT%H%M%S.%f"), os.getpid(),
+            environ.get("REQUEST_METHOD", ""),
+            re.sub(r"[^A-Za-z0-9]+", "_", environ.get("PATH_INFO", ""))
+            .strip("_")[:100])
+        try:
+            profiler.dump_stats(os.path.join(self.directory, name))
+        except OSError:
+            LOGGER.exception("Profilul nu a fost salvat.")
+
+    def __call__(self, environ, start_response):
+        requested = self._requested(environ)
+        if not requested and (self.sample <= 0 or
+                              random.random() >= self.sample):
+            return self.app(environ, start_response)
+
+        if not self._busy.acquire(blocking=False):
+            # Un alt profil rulează deja.
+            return self.app(environ, start_response)
+
+        profiler = cProfile.Profile()
+        if requested:
+            return self._report(profiler, environ, start_response)
+        return self._sampled(profiler, environ, start_response)
+
+    def _report(self, profiler, environ, start_response):
+        """
+        Rulează cererea sub profil și întoarce raportul profilului.
+        """
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return lambda _data: None
+
+        profiler.enable()
+        try:
+            body = self.app(environ, capture)
+            try:
+                size = sum(len(chunk) for chunk in body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+        finally:
+            profiler.disable()
+            self._busy.release()
+
+        if self.directory:
+            self._save(profiler, environ)
+
+        report = io.StringIO()
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats("cumulative").print_stats(self.report_lines)
+        payload = ("%s %s -> %s, %d octeți\n\n%s" % (
+            environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"),
+            response[0] if response else "?", size,
+            report.getvalue())).encode()
+
+        start_response("200 OK", [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(len(payload))),
+            ("X-Profiled-Status", response[0] if response else "")])
+        return [payload]
+
+    def _sampled(self, profiler, environ, start_response):
+        """
+        Rulează cererea sub profil, fără să schimbe răspunsul. Profilul este
+        salvat după trimiterea ultimului octet.
+        """
+        profiler.enable()
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self._busy.release()
+            raise
+        finally:
+            profiler.disable()
+
+        return _ProfiledBody(body, profiler, lambda: self._finish(
+            profiler, environ))
+
+    def _finish(self, profiler, environ):
+        """
+        Încheie un profil eșantionat.
+        """
+        self._busy.release()
+        self._save(profiler, environ)
+
+class _ProfiledBody:
+    """
+    Corpul unui răspuns WSGI profilat: fiecare bucată este produsă sub
+    profil, iar la închidere este apelat on_close.
+    """
+    def __init__(self, body, profiler, on_close):
+        self._body = body
+        self._profiler = profiler
+        self._on_close = on_close
+
+    def __iter__(self):
+        iterator = iter(self._body)
+        while True:
+            self._profiler.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._profiler.disable()
+            yield chunk
+
+    def close(self):
+        """
+        Închide corpul și încheie profilul.
+        """
+        try:
+            if hasattr(self._body, "close"):
+                self._profiler.enable()
+                try:
+                    self._body.close()
+                finally:
+                    self._profiler.disable()
+        finally:
+            self._on_close()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from itertools import count
+from time import sleep
+
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+LOGGER = logging.getLogger(__name__)
+
+# Politicile de alegere a replicii.
+ROUND_ROBIN = "round_robin"
+LEAST_LOAD = "least_load"
+
+# Întârzierea replicii, în secunde: 0 dacă a aplicat tot ce a primit (sau
+# nu este replică), altfel vechimea ultimei tranzacții aplicate. O replică
+# al cărei proces walreceiver nu primește WAL de la serverul principal (de
+# exemplu, după ce a pierdut conexiunea cu el) întoarce NULL: ar părea la zi,
+# fiindcă nu mai primește nimic. Starea walreceiver-ului este vizibilă doar
+# pentru superutilizatori și membrii rolului pg_read_all_stats.
+LAG_QUERY = """ SELECT CASE                                                   \
+                    WHEN NOT pg_is_in_recovery() THEN 0                      \
+                    WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver      \
+                                     WHERE status = 'streaming') THEN NULL   \
+                    WHEN pg_last_wal_receive_lsn() =                         \
+                         pg_last_wal_replay_lsn() THEN 0                     \
+                    ELSE COALESCE(EXTRACT(EPOCH FROM                         \
+                         now() - pg_last_xact_replay_timestamp()), 0)        \
+                END; """
+
+def replica_params(dsns, primary_params):
+    """
+    Returns:
+        list: argumentele pentru psycopg2.connect() ale fiecărei replici,
+        date ca șiruri DSN („host=replica1 port=5432”) sau URI-uri separate
+        prin „;”; ce lipsește este luat de la serverul principal
+    """
+    params = []
+    for dsn in dsns.split(";"):
+        if dsn.strip():
+            replica = dict(primary_params)
+            replica.update(psycopg2.extensions.parse_dsn(dsn.strip()))
+            params.append(replica)
+    return params
+
+class Replica:
+    """
+    O replică de citire: pool-ul ei și starea ei, stabilită de verificările
+    periodice.
+    """
+    def __init__(self, name, pool, conn_kwargs):
+        self.name = name
+        self.pool = pool
+        self.conn_kwargs = conn_kwargs
+        # O replică nouă primește cereri abia după prima verificare reușită.
+        self.healthy = False
+        self.lag = None
+        self.reads = 0
+        self.failures = 0
+
+class ReplicaRouter:
+    """
+    Împarte citirile între replicile de citire ale bazei de date, prin
+    rotație (round_robin) sau după încărcarea pool-urilor lor (least_load).
+
+    Un thread separat verifică fiecare replică la check_interval secunde,
+    pe o conexiune proprie: o replică oprită, deconectată de la serverul
+    principal sau rămasă în urmă cu mai mult de max_lag secunde nu mai
+    primește citiri până la o verificare reușită.
+    Fără nicio replică disponibilă, citirile merg la serverul principal.
+    """
+    def __init__(self, primary, replicas, policy=ROUND_ROBIN, max_lag=5.0,
+                 check_interval=1.0):
+        """
+        Args:
+            primary - pool-ul serverului principal.
+            replicas - lista de Replica.
+            policy - ROUND_ROBIN sau LEAST_LOAD.
+            max_lag - întârzierea maximă acceptată a unei replici, în
+                secunde.
+            check_interval - la câte secunde sunt verificate replicile.
+        """
+        if policy not in (ROUND_ROBIN, LEAST_LOAD):
+            raise ValueError("Politică necunoscută: %s" % policy)
+
+        self.primary = primary
+        self.replicas = replicas
+        self.policy = policy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._turn = count()
+        self._thread = None
+        self._primary_reads = 0
+
+    def choose(self):
+        """
+        Returns:
+            (pool, Replica) pentru citirea curentă sau (pool-ul principal,
+            None), dacă nicio replică nu este disponibilă
+        """
+        with self._lock:
+            healthy = [replica for replica in self.replicas
+                       if replica.healthy]
+            if not healthy:
+                self._primary_reads += 1
+                return self.primary, None
+
+            if self.policy == LEAST_LOAD:
+                replica = min(healthy, key=lambda replica: replica.pool.load())
+            else:
+                replica = healthy[next(self._turn) % len(healthy)]
+            replica.reads += 1
+            return replica.pool, replica
+
+    def failed(self, replica):
+        """
+        Scoate o replică din rotație după o eroare de conexiune, până la
+        următoarea verificare reușită.
+        """
+        with self._lock:
+            if replica.healthy:
+                LOGGER.warning("Replica %s nu răspunde.", replica.name)
+            replica.healthy = False
+            replica.failures += 1
+
+    def check(self):
+        """
+        Verifică toate replicile.
+        """
+        for replica in self.replicas:
+            try:
+                conn = psycopg2.connect(**dict(
+                    {"connect_timeout": max(int(self.check_interval), 1)},
+                    **replica.conn_kwargs))
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute(LAG_QUERY)
+                    lag = cursor.fetchone()[0]
+                    if lag is not None:
+                        lag = float(lag)
+                finally:
+                    conn.close()
+            except psycopg2.Error:
+                lag = None
+
+            healthy = lag is not None and lag <= self.max_lag
+            with self._lock:
+                if healthy != replica.healthy:
+                    LOGGER.warning("Replica %s %s (întârziere: %s).",
+                                   replica.name, "revine în rotație"
+                                   if healthy else "iese din rotație",
+                                   "%.3f s" % lag if lag is not None
+                                   else "necunoscută")
+                replica.healthy = healthy
+                replica.lag = lag
+
+    def start(self):
+        """
+        Verifică replicile o dată și pornește thread-ul de verificare.
+        """
+        self.check()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="replica-checks")
+            self._thread.start()
+
+    def _run(self):
+        """
+        Bucla thread-ului de verificare.
+        """
+        while True:
+            sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Verificarea replicilor a eșuat.")
+
+    def stats(self):
+        """
+        Returns:
+            dict cu starea fiecărei replici
+        """
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "primary_reads": self._primary_reads,
+                "replicas": [dict(replica.pool.stats(), name=replica.name,
+                                  healthy=replica.healthy, lag=replica.lag,
+                                  reads=replica.reads,
+                                  failures=replica.failures)
+                             for replica in self.replicas],
+            }
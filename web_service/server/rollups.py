@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+import json
+import sys
+
+import psycopg2
+
+from db_pool import connection_params
+from serialization import register_numeric_as_float
+import statements
+
+# Tabelele de agregate, împreună cu intervalul de timp al fiecăruia.
+ROLLUPS = (("temp_rollup_hourly", "hour"), ("temp_rollup_daily", "day"))
+
+# Prima cheie a lacătelor consultative luate pe fiecare oraș (a doua cheie
+# este id-ul orașului) înainte de a modifica agregatele lui.
+ROLLUP_LOCK_ID = 20201126
+
+def _lock_cities(cursor, city_ids):
+    """
+    Blochează, până la sfârșitul tranzacției, agregatele orașelor date.
+    Orașele sunt blocate mereu în aceeași ordine, ca să nu apară deadlock-uri.
+
+    Fără lacăt, o recalculare (refresh_buckets) care nu vede o inserare
+    încă necomitată i-ar putea suprascrie adunarea făcută de add_readings().
+    """
+    for city_id in sorted(set(city_ids)):
+        statements.execute(cursor,
+                           """ SELECT pg_advisory_xact_lock(%s, %s); """,
+                           (ROLLUP_LOCK_ID, city_id))
+
+def add_readings(cursor, readings):
+    """
+    Adaugă în agregate temperaturi tocmai inserate, în tranzacția curentă.
+
+    Args:
+        cursor - cursorul tranzacției care a inserat temperaturile.
+        readings - lista de tupluri (id oraș, valoare, timestamp).
+    """
+    if not readings:
+        return
+
+    _lock_cities(cursor, [reading[0] for reading in readings])
+
+    for table, interval in ROLLUPS:
+        query = """ INSERT INTO %s(city_id, bucket, temp_min, temp_max,       \
+                                   temp_sum, temp_count)                      \
+                    SELECT city_id, DATE_TRUNC('%s', ts), MIN(value),         \
+                           MAX(value), SUM(value), COUNT(*)                   \
+                    FROM UNNEST(%%s::integer[], %%s::numeric[],               \
+                                %%s::timestamp[]) AS new(city_id, value, ts)  \
+                    GROUP BY city_id, DATE_TRUNC('%s', ts)                    \
+                    ON CONFLICT (city_id, bucket) DO UPDATE SET               \
+                    temp_min = LEAST(%s.temp_min, EXCLUDED.temp_min),         \
+                    temp_max = GREATEST(%s.temp_max, EXCLUDED.temp_max),      \
+                    temp_sum = %s.temp_sum + EXCLUDED.temp_sum,               \
+                    temp_count = %s.temp_count + EXCLUDED.temp_count; """ % (
+                        table, interval, interval, table, table, table, table)
+
+        # Tot lotul într-o singură instrucțiune, pentru că ON CONFLICT nu
+        # poate modifica de două ori același rând; trimis ca trei liste,
+        # textul instrucțiunii nu depinde de dimensiunea lotului.
+        statements.execute(cursor, query, [list(column)
+                                           for column in zip(*readings)])
+
+def refresh_buckets(cursor, keys):
+    """
+    Recalculează din temperaturi agregatele care conțin momentele date, de
+    exemplu după modificarea sau ștergerea unei temperaturi. Agregatele
+    rămase fără nicio temperatură sunt șterse.
+
+    Args:
+        cursor - cursorul tranzacției care a modificat temperaturile.
+        keys - lista de tupluri (id oraș, timestamp).
+    """
+    if not keys:
+        return
+
+    _lock_cities(cursor, [key[0] for key in keys])
+
+    for table, interval in ROLLUPS:
+        buckets = """ SELECT DISTINCT city_id, DATE_TRUNC('%s', ts) AS bucket  \
+                      FROM UNNEST(%%s::integer[], %%s::timestamp[])            \
+                      AS changed(city_id, ts) """ % interval
+        columns = [list(column) for column in zip(*keys)]
+
+        statements.execute(cursor, """
+            WITH buckets AS (%s)
+            INSERT INTO %s(city_id, bucket, temp_min, temp_max, temp_sum,
+                           temp_count)
+            SELECT buckets.city_id, buckets.bucket, MIN(t.temp_value),
+                   MAX(t.temp_value), SUM(t.temp_value), COUNT(*)
+            FROM buckets INNER JOIN temperatures AS t
+            ON t.city_id = buckets.city_id
+            AND t.temp_timestamp >= buckets.bucket
+            AND t.temp_timestamp < buckets.bucket + '1 %s'::interval
+            GROUP BY buckets.city_id, buckets.bucket
+            ON CONFLICT (city_id, bucket) DO UPDATE SET
+            temp_min = EXCLUDED.temp_min, temp_max = EXCLUDED.temp_max,
+            temp_sum = EXCLUDED.temp_sum, temp_count = EXCLUDED.temp_count;
+            """ % (buckets, table, interval), columns)
+
+        statements.execute(cursor, """
+            WITH buckets AS (%s)
+            DELETE FROM %s AS r USING buckets
+            WHERE r.city_id = buckets.city_id AND r.bucket = buckets.bucket
+            AND NOT EXISTS (
+                SELECT 1 FROM temperatures AS t
+                WHERE t.city_id = buckets.city_id
+                AND t.temp_timestamp >= buckets.bucket
+                AND t.temp_timestamp < buckets.bucket + '1 %s'::interval);
+            """ % (buckets, table, interval), columns)
+
+def discard_before(cursor, horizon):
+    """
+    Șterge agregatele de dinaintea momentului dat, de exemplu după ce
+    temperaturile din acea perioadă au fost șterse de politica de retenție.
+    Momentul trebuie să fie începutul unei zile.
+    """
+    for table, _ in ROLLUPS:
+        cursor.execute(""" DELETE FROM %s WHERE bucket < %%s; """ % table,
+                       (horizon,))
+
+def backfill(cursor):
+    """
+    Calculează agregatele pentru toate temperaturile, în tabele goale.
+    """
+    for table, interval in ROLLUPS:
+        cursor.execute(
+            """ INSERT INTO %s(city_id, bucket, temp_min, temp_max, temp_sum, \
+                               temp_count)                                    \
+                SELECT city_id, DATE_TRUNC('%s', temp_timestamp),             \
+                       MIN(temp_value), MAX(temp_value), SUM(temp_value),     \
+                       COUNT(*)                                               \
+                FROM temperatures                                             \
+                GROUP BY city_id, DATE_TRUNC('%s', temp_timestamp); """ % (
+                    table, interval, interval))
+
+def rebuild(conn):
+    """
+    Reface toate agregatele din temperaturi, într-o singură tranzacție.
+    Scrierile de temperaturi așteaptă cât timp durează reconstruirea.
+
+    Returns:
+        dict: numărul de agregate din fiecare tabel
+    """
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(""" LOCK TABLE temperatures IN SHARE MODE; """)
+        cursor.execute(""" TRUNCATE %s; """ %
+                       ", ".join(table for table, _ in ROLLUPS))
+        backfill(cursor)
+
+        counts = {}
+        for table, _ in ROLLUPS:
+            cursor.execute(""" SELECT COUNT(*) FROM %s; """ % table)
+            counts[table] = cursor.fetchone()[0]
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    conn.commit()
+
+    return counts
+
+def check(conn, limit=100):
+    """
+    Compară agregatele cu valorile calculate din temperaturi, într-un singur
+    snapshot al bazei de date.
+
+    Args:
+        conn - conexiunea psycopg2, fără tranzacție în desfășurare.
+        limit - câte diferențe sunt raportate pentru fiecare tabel.
+    Returns:
+        dict: pentru fiecare tabel, numărul de diferențe și primele dintre ele
+    """
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    cursor = conn.cursor()
+    report = {}
+
+    try:
+        for table, interval in ROLLUPS:
+            cursor.execute(
+                """ WITH raw AS (                                             \
+                        SELECT city_id,                                       \
+                               DATE_TRUNC('%s', temp_timestamp) AS bucket,    \
+                               MIN(temp_value) AS temp_min,                   \
+                               MAX(temp_value) AS temp_max,                   \
+                               SUM(temp_value) AS temp_sum,                   \
+                               COUNT(*) AS temp_count                         \
+                        FROM temperatures                                     \
+                        GROUP BY city_id, DATE_TRUNC('%s', temp_timestamp))   \
+                    SELECT COALESCE(raw.city_id, r.city_id),                  \
+                           TO_CHAR(COALESCE(raw.bucket, r.bucket),            \
+                                   'YYYY-MM-DD HH24:MI:SS'),                  \
+                           r.temp_count, raw.temp_count                       \
+                    FROM raw FULL OUTER JOIN %s AS r                          \
+                    ON raw.city_id = r.city_id AND raw.bucket = r.bucket      \
+                    WHERE (r.temp_min, r.temp_max, r.temp_sum, r.temp_count)  \
+                    IS DISTINCT FROM (raw.temp_min, raw.temp_max,             \
+                                      raw.temp_sum, raw.temp_count)           \
+                    ORDER BY 1, 2; """ % (interval, interval, table))
+            rows = cursor.fetchall()
+            report[table] = {
+                "mismatches": len(rows),
+                "first": [{"city": row[0], "bucket": row[1],
+                           "rollup_count": row[2], "raw_count": row[3]}
+                          for row in rows[:limit]],
+            }
+    finally:
+        cursor.close()
+        conn.rollback()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+
+    return report
+
+def main():
+    """
+    Reconstruiește (rebuild) sau verifică (check) agregatele temperaturilor.
+
+    Utilizare: python rollups.py rebuild|check
+    La verificare, codul de ieșire este 1 dacă s-au găsit diferențe.
+    """
+    if len(sys.argv) != 2 or sys.argv[1] not in ("rebuild", "check"):
+        print(main.__doc__.strip().splitlines()[2], file=sys.stderr)
+        return 2
+
+    register_numeric_as_float()
+    conn = psycopg2.connect(**connection_params())
+
+    try:
+        if sys.argv[1] == "rebuild":
+            result = rebuild(conn)
+            status = 0
+        else:
+            result = check(conn)
+            status = int(any(table["mismatches"] for table in result.values()))
+    finally:
+        conn.close()
+
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
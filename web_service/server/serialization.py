@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from json.encoder import encode_basestring_ascii
+from math import isfinite
+
+import csv
+import io
+import json
+
+import psycopg2.extensions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# OID-urile tipurilor numerice PostgreSQL, după care se aleg convertoarele
+# scriitorului bazat pe șablon.
+INT_OIDS = frozenset((20, 21, 23))
+FLOAT_OIDS = frozenset((700, 701, 1700))
+TIMESTAMP_OID = 1114
+
+# Formatele în care pot fi trimise rezultatele rutelor de tip flux: numele
+# din parametrul „format” -> tipul MIME.
+FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Formatele care au nevoie de pyarrow și formatele care pot fi folosite.
+ARROW_FORMATS = frozenset(("arrow", "parquet"))
+AVAILABLE_FORMATS = frozenset(FORMATS) - (
+    frozenset() if pyarrow is not None else ARROW_FORMATS)
+
+def register_numeric_as_float():
+    """
+    Face ca psycopg2 să întoarcă valorile NUMERIC direct ca float, în loc de
+    Decimal, pentru toate conexiunile.
+    """
+    dec2float = psycopg2.extensions.new_type(
+        psycopg2.extensions.DECIMAL.values,
+        "DEC2FLOAT",
+        lambda value, _cursor: float(value) if value is not None else None)
+    psycopg2.extensions.register_type(dec2float)
+
+def _int(value):
+    """
+    Convertorul pentru coloanele întregi.
+    """
+    return "null" if value is None else "%d" % value
+
+def _float(value):
+    """
+    Convertorul pentru coloanele reale. NaN și infinit nu există în JSON.
+    """
+    return "null" if value is None or not isfinite(value) else repr(value)
+
+def _str(value):
+    """
+    Convertorul pentru celelalte coloane.
+    """
+    return "null" if value is None else encode_basestring_ascii(str(value))
+
+class RowEncoder:
+    """
+    Serializează rânduri întoarse ca tupluri de un cursor obișnuit (nu
+    RealDictCursor) ca obiecte JSON cu cheile sortate, la fel ca json.dumps.
+
+    Cu orjson, tuplurile sunt transformate în dicționare chiar înainte de
+    serializare. Fără orjson, se folosește un șablon calculat o singură dată
+    din descrierea coloanelor, în care se pun valorile convertite.
+    """
+    def __init__(self, description):
+        """
+        Args:
+            description - cursor.description al interogării.
+        """
+        self.columns = [column[0] for column in description]
+
+        if orjson is None:
+            order = sorted(range(len(self.columns)),
+                           key=lambda idx: self.columns[idx])
+            self._order = order
+            self._template = "{" + ",".join(
+                "%s:%%s" % encode_basestring_ascii(self.columns[idx])
+                for idx in order) + "}"
+            self._converters = []
+            for idx in order:
+                type_code = description[idx][1]
+                if type_code in INT_OIDS:
+                    self._converters.append(_int)
+                elif type_code in FLOAT_OIDS:
+                    self._converters.append(_float)
+                else:
+                    self._converters.append(_str)
+
+    def _objects(self, rows):
+        """
+        Returns:
+            list: șirurile JSON ale rândurilor, prin scriitorul pe șablon
+        """
+        template = self._template
+        pairs = list(zip(self._order, self._converters))
+        return [template % tuple(conv(row[idx]) for idx, conv in pairs)
+                for row in rows]
+
+    def encode_list(self, rows):
+        """
+        Returns:
+            bytes: lista JSON a rândurilor
+        """
+        if orjson is not None:
+            columns = self.columns
+            return orjson.dumps([dict(zip(columns, row)) for row in rows],
+                                option=orjson.OPT_SORT_KEYS)
+        return ("[" + ",".join(self._objects(rows)) + "]").encode()
+
+    def encode_items(self, rows):
+        """
+        Returns:
+            bytes: rândurile ca elemente de listă JSON, separate prin virgulă
+            și fără paranteze, pentru a fi trimise în flux
+        """
+        return self.encode_list(rows)[1:-1]
+
+    def encode_lines(self, rows):
+        """
+        Returns:
+            bytes: rândurile în format NDJSON, câte unul pe linie
+        """
+        if orjson is not None:
+            columns = self.columns
+            return b"".join(orjson.dumps(dict(zip(columns, row)),
+                                         option=orjson.OPT_SORT_KEYS |
+                                         orjson.OPT_APPEND_NEWLINE)
+                            for row in rows)
+        return "".join(obj + "\n" for obj in self._objects(rows)).encode()
+
+class StreamWriter:
+    """
+    Scrie rândurile unei interogări într-unul din FORMATS, lot cu lot:
+    begin(), apoi encode() pentru fiecare lot, apoi end(). Fiecare apel
+    întoarce octeții de trimis.
+    """
+    def __init__(self, description):
+        """
+        Args:
+            description - cursor.description al interogării.
+        """
+        self.columns = [column[0] for column in description]
+
+    def begin(self):
+        """
+        Returns:
+            bytes: începutul răspunsului
+        """
+        return b""
+
+    def encode(self, rows):
+        """
+        Returns:
+            bytes: un lot de rânduri
+        """
+        raise NotImplementedError
+
+    def end(self):
+        """
+        Returns:
+            bytes: sfârșitul răspunsului
+        """
+        return b""
+
+class JsonWriter(StreamWriter):
+    """
+    Listă JSON de obiecte, cu cheile sortate.
+    """
+    def __init__(self, description):
+        super().__init__(description)
+        self._encoder = RowEncoder(description)
+        self._separator = b""
+
+    def begin(self):
+        return b"["
+
+    def encode(self, rows):
+        data = self._separator + self._encoder.encode_items(rows)
+        self._separator = b","
+        return data
+
+    def end(self):
+        return b"]"
+
+class NdjsonWriter(StreamWriter):
+    """
+    Câte un obiect JSON pe linie.
+    """
+    def __init__(self, description):
+        super().__init__(description)
+        self._encoder = RowEncoder(description)
+
+    def encode(self, rows):
+        return self._encoder.encode_lines(rows)
+
+class CsvWriter(StreamWriter):
+    """
+    CSV cu antet, cu coloanele în ordinea interogării; NULL este un câmp
+    gol.
+    """
+    def __init__(self, description):
+        super().__init__(description)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator="\n")
+
+    def _drain(self):
+        """
+        Returns:
+            bytes: ce a fost scris de la ultimul apel
+        """
+        data = self._buffer.getvalue().encode()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def begin(self):
+        self._writer.writerow(self.columns)
+        return self._drain()
+
+    def encode(self, rows):
+        self._writer.writerows(rows)
+        return self._drain()
+
+class _Sink:
+    """
+    Fișierul în care scrie pyarrow; octeții scriși sunt luați cu drain().
+    """
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        """
+        Adaugă octeți.
+        """
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        """
+        Returns:
+            int: numărul de octeți scriși
+        """
+        return self._position
+
+    def flush(self):
+        """
+        Nu are nimic de făcut.
+        """
+
+    def close(self):
+        """
+        Marchează fișierul ca închis.
+        """
+        self.closed = True
+
+    def drain(self):
+        """
+        Returns:
+            bytes: ce a fost scris de la ultimul apel
+        """
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+class ArrowWriter(StreamWriter):
+    """
+    Format columnar Apache Arrow: fluxul IPC (un record batch pentru fiecare
+    lot) sau, cu parquet=True, un fișier Parquet (un row group pentru
+    fiecare lot, comprimat cu Snappy). Tipurile coloanelor sunt luate din
+    descrierea cursorului.
+    """
+    def __init__(self, description, parquet=False):
+        super().__init__(description)
+        fields = []
+        for column in description:
+            if column[1] in INT_OIDS:
+                kind = pyarrow.int64()
+            elif column[1] in FLOAT_OIDS:
+                kind = pyarrow.float64()
+            elif column[1] == TIMESTAMP_OID:
+                kind = pyarrow.timestamp("us")
+            else:
+                kind = pyarrow.string()
+            fields.append(pyarrow.field(column[0], kind))
+        self._schema = pyarrow.schema(fields)
+        self._sink = _Sink()
+        if parquet:
+            self._writer = pyarrow.parquet.ParquetWriter(
+                self._sink, self._schema, compression="snappy")
+        else:
+            self._writer = pyarrow.ipc.new_stream(self._sink, self._schema)
+        self._parquet = parquet
+
+    def begin(self):
+        return self._sink.drain()
+
+    def encode(self, rows):
+        arrays = [pyarrow.array(list(values), type=field.type)
+                  for values, field in zip(zip(*rows), self._schema)]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self._schema)
+        if self._parquet:
+            self._writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        return self._sink.drain()
+
+    def end(self):
+        self._writer.close()
+        return self._sink.drain()
+
+def stream_writer(name, description):
+    """
+    Returns:
+        StreamWriter: scriitorul formatului cu numele dat (din FORMATS)
+    """
+    if name == "ndjson":
+        return NdjsonWriter(description)
+    if name == "csv":
+        return CsvWriter(description)
+    if name in ARROW_FORMATS:
+        return ArrowWriter(description, parquet=name == "parquet")
+    return JsonWriter(description)
@@ -4,37 +4,178 @@
 (C) Copyright 2020
 """
 
-from decimal import Decimal
-from time import sleep
-
 import os
 
+# Serverul de producție (vezi main()) cere ca modulele standard să fie
+# înlocuite cu variantele gevent înaintea oricărui alt import.
+if os.getenv("WEB_SERVICE_SERVER", "debug") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+# pylint: disable=wrong-import-position
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from math import isfinite
+from time import time
+from urllib.parse import parse_qs, urlencode
+
+import atexit
+import base64
+import binascii
+import logging
+import shutil
+import tempfile
+
 from flask import Flask, Response, request, json
-from psycopg2.extras import RealDictCursor
+from werkzeug.exceptions import HTTPException
 
 import jsonschema
-import psycopg2
-
-APP = Flask(__name__)
-CONN = None
 
-class DecimalEncoder(json.JSONEncoder):
-    """
-    Clasa de conversie a numerelor reale cu virgulă din Decimal în float.
-    """
-    def default(self, obj):
-        """
-        Funcția auxiliară.
+from admission import AdmissionMiddleware, TokenBuckets, parse_limits
+from cache import ResponseCache
+from feed import TemperatureFeed
+from geo import CityIndex
+from ingest import QueueFull
+from latest import LatestReadings
+from metrics import METRICS, MetricsMiddleware, set_route
+from pg_storage import PostgresStorage
+from prefork import DisconnectWatch, PreforkServer, patch_psycopg
+from profiling import ProfilerMiddleware
+from serialization import (AVAILABLE_FORMATS, FORMATS, RowEncoder,
+                           stream_writer)
+from sqlite_storage import SqliteStorage
+from storage import (POSTGRES, SQLITE, Conflict, InvalidValue,
+                     MissingReference, QueryTimeout, StorageError, Unavailable)
+import feed
 
-        Args:
-            obj - obiectul de verificar / convertit.
-        Returns:
-            float: numărul convertit, dacă era Decimal
-            object: dacă obiectul nu era Decimal
-        """
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return json.JSONEncoder.default(self, obj)
+APP = Flask(__name__)
+# Cererile cu antetul „X-Profile: PROFILE_TOKEN” primesc profilul lor în
+# locul răspunsului, iar o fracțiune PROFILE_SAMPLE din cereri este profilată
+# și salvată în PROFILE_DIR. Fiecare cerere este măsurată, pentru
+# GET /metrics.
+APP.wsgi_app = ProfilerMiddleware(
+    APP.wsgi_app, token=os.getenv("PROFILE_TOKEN", ""),
+    sample=float(os.getenv("PROFILE_SAMPLE", "0")),
+    directory=os.getenv("PROFILE_DIR") or None)
+
+# Controlul admiterii (vezi admission_class()): limita de rată a fiecărui
+# client, în cereri pe secundă (0 o dezactivează), limita de concurență și
+# coada fiecărei rute (0 le dezactivează), cu excepțiile din
+# ADMISSION_ROUTES, și limita interogărilor scumpe (HEAVY_CLASS).
+ADMISSION_LIMITS = parse_limits(os.getenv("ADMISSION_ROUTES", ""))
+ADMISSION_LIMITS.setdefault("heavy", (
+    int(os.getenv("ADMISSION_HEAVY_CONCURRENCY", "0")),
+    int(os.getenv("ADMISSION_HEAVY_QUEUE", "8"))))
+ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "0"))
+ADMISSION = AdmissionMiddleware(
+    APP.wsgi_app, lambda environ: admission_class(environ),
+    rate_limit=TokenBuckets(
+        ADMISSION_RATE, int(os.getenv("ADMISSION_BURST", "20")))
+    if ADMISSION_RATE > 0 else None,
+    limits=ADMISSION_LIMITS,
+    default_limit=(int(os.getenv("ADMISSION_CONCURRENCY", "0")),
+                   int(os.getenv("ADMISSION_QUEUE", "100"))),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1")),
+    client_header=os.getenv("ADMISSION_CLIENT_HEADER") or None)
+APP.wsgi_app = MetricsMiddleware(ADMISSION)
+# Stocarea datelor (vezi storage.py): PostgreSQL sau, cu
+# WEB_SERVICE_STORAGE=sqlite, SQLite, în fișierul SQLITE_PATH sau doar în
+# memorie.
+STORAGE_ENGINE = os.getenv("WEB_SERVICE_STORAGE", POSTGRES)
+STORAGE = None
+# Câte secunde după o scriere citirile clientului merg la serverul
+# principal (0 dezactivează); momentul scrierii este ținut într-un cookie.
+READ_YOUR_WRITES = float(os.getenv("DB_READ_YOUR_WRITES", "0"))
+LAST_WRITE_COOKIE = "last_write"
+
+# Răspunsurile rutelor de citire pentru țări și orașe; 0 dezactivează cache-ul.
+CACHE = ResponseCache(int(os.getenv("CACHE_MAX_ENTRIES", "1024")))
+# Canalul pe care procesele își anunță invalidările cache-ului.
+CACHE_CHANNEL = "cache_invalidation"
+
+# Indexul spațial al orașelor, folosit de rutele de căutare după distanță.
+CITY_INDEX = CityIndex(float(os.getenv("CITY_INDEX_CELL_DEG", "1.0")))
+# Canalul pe care procesele își anunță orașele modificate („city:1,2” sau
+# „country:3”), ca să-și actualizeze indexul spațial.
+CITY_CHANNEL = "city_changes"
+# Numărul maxim de orașe întors de GET /api/cities/nearest.
+CITY_NEAREST_MAX = int(os.getenv("CITY_NEAREST_MAX", "1000"))
+
+# Ultima temperatură a fiecărui oraș, pentru GET /api/temperatures/latest.
+LATEST = LatestReadings()
+
+# Fluxul temperaturilor scrise, pentru GET /api/temperatures/stream: câți
+# clienți poate avea un proces și câte evenimente poate avea în așteptare un
+# client înainte de a fi deconectat.
+TEMP_FEED = TemperatureFeed(
+    CITY_INDEX.country_of,
+    max_subscribers=int(os.getenv("TEMP_STREAM_MAX_CLIENTS", "10000")),
+    max_queued=int(os.getenv("TEMP_STREAM_QUEUE", "1000")))
+# La câte secunde fără evenimente se trimite un comentariu clienților, ca
+# proxy-urile să nu închidă conexiunea.
+TEMP_STREAM_HEARTBEAT = float(os.getenv("TEMP_STREAM_HEARTBEAT", "15"))
+
+# Numărul maxim de temperaturi primite de POST /api/temperatures/batch.
+TEMP_BATCH_MAX = int(os.getenv("TEMP_BATCH_MAX", "10000"))
+# Numărul maxim de elemente primite de rutele /api/countries/batch și
+# /api/cities/batch.
+CATALOG_BATCH_MAX = int(os.getenv("CATALOG_BATCH_MAX", "50000"))
+# Câte rânduri sunt citite deodată de rutele de tip flux.
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+# Dimensiunea maximă (și implicită) a unei pagini pentru țări și orașe,
+# respectiv pentru temperaturi.
+PAGE_MAX_SIZE = int(os.getenv("PAGE_MAX_SIZE", "1000"))
+TEMP_PAGE_MAX_SIZE = int(os.getenv("TEMP_PAGE_MAX_SIZE", "100000"))
+# Bugetul de timp, în milisecunde, al fiecărei instrucțiuni SQL a unei
+# cereri (0 nu îl limitează), cu excepțiile din STATEMENT_TIMEOUTS, date
+# pentru clasele din admission_class() („heavy=60000;/api/cities=2000”).
+STATEMENT_TIMEOUT = int(os.getenv("STATEMENT_TIMEOUT_MS", "0"))
+STATEMENT_TIMEOUTS = {
+    klass.strip(): int(timeout) for klass, _, timeout in (
+        item.rpartition("=") for item
+        in os.getenv("STATEMENT_TIMEOUTS", "").split(";") if item.strip())
+}
+
+TEMP_BATCH_VALIDATOR = jsonschema.Draft7Validator({
+    "type": "object",
+    "properties": {
+        "idOras": {"type": "integer"},
+        "valoare": {"type": "number"},
+        "timestamp": {"type": "string"},
+    },
+    "required": ["idOras", "valoare"],
+})
+
+# Elementele rutelor /api/countries/batch și /api/cities/batch, pentru
+# adăugare (POST), modificare (PUT) și ștergere (DELETE); id-urile trebuie să
+# încapă în coloanele INTEGER.
+ID_SCHEMA = {"type": "integer", "minimum": -2 ** 31, "maximum": 2 ** 31 - 1}
+COUNTRY_BATCH_VALIDATORS = {
+    method: jsonschema.Draft7Validator({
+        "type": "object",
+        "properties": {
+            "id": ID_SCHEMA,
+            "nume": {"type": "string"},
+            "lat": {"type": "number"},
+            "lon": {"type": "number"},
+        },
+        "required": required + ["nume", "lat", "lon"],
+    }) for method, required in (("POST", []), ("PUT", ["id"]))
+}
+CITY_BATCH_VALIDATORS = {
+    method: jsonschema.Draft7Validator({
+        "type": "object",
+        "properties": {
+            "id": ID_SCHEMA,
+            "idTara": ID_SCHEMA,
+            "nume": {"type": "string"},
+            "lat": {"type": "number"},
+            "lon": {"type": "number"},
+        },
+        "required": required + ["idTara", "nume", "lat", "lon"],
+    }) for method, required in (("POST", []), ("PUT", ["id"]))
+}
+ID_VALIDATOR = jsonschema.Draft7Validator(ID_SCHEMA)
 
 def validate_json(json_data, json_schema):
     """
@@ -51,86 +192,810 @@ def validate_json(json_data, json_schema):
 
     return True
 
-def init_postgres():
+def parse_timestamp(value):
+    """
+    Interpretează un timestamp ISO 8601 („2020-11-25 10:30:00” sau
+    „2020-11-25T10:30:00+02:00”). Timestamp-urile cu fus orar sunt convertite
+    în UTC.
+
+    Returns:
+        datetime: timestamp-ul, fără fus orar
+        None: dacă valoarea nu este un timestamp valid
+    """
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return timestamp
+
+def numeric_in_range(value, limit):
+    """
+    Returns:
+        True, dacă valoarea, rotunjită la 4 zecimale, este finită și are
+        modulul mai mic decât limit (NUMERIC(6, 4): 100, NUMERIC(7, 4): 1000)
+        False, altfel
+    """
+    value = Decimal(str(value))
+    return value.is_finite() and \
+           abs(value.quantize(Decimal("0.0001"), ROUND_HALF_UP)) < limit
+
+def temperature_in_range(value):
+    """
+    Returns:
+        True, dacă valoarea încape în coloana temp_value, NUMERIC(6, 4)
+        False, altfel
+    """
+    return numeric_in_range(value, 100)
+
+def place_fits(item):
+    """
+    Returns:
+        True, dacă numele și coordonatele unei țări sau ale unui oraș dintr-un
+        lot încap în coloanele lor (VARCHAR(255), NUMERIC(6, 4) și
+        NUMERIC(7, 4))
+        False, altfel
+    """
+    return len(item["nume"]) <= 255 and numeric_in_range(item["lat"], 100) \
+           and numeric_in_range(item["lon"], 1000)
+
+def number_arg(name, low=None, high=None):
+    """
+    Returns:
+        float: parametrul numeric al cererii curente cu numele dat
+        None: dacă lipsește, nu este un număr finit sau nu este între low și
+        high
+    """
+    try:
+        value = float(request.args[name])
+    except (KeyError, ValueError):
+        return None
+
+    if not isfinite(value) or (low is not None and value < low) or \
+       (high is not None and value > high):
+        return None
+
+    return value
+
+def init_storage():
+    """
+    Deschide stocarea aleasă prin WEB_SERVICE_STORAGE (vezi storage.py) și
+    aduce schema la ultima versiune. Tot aici sunt încărcate indexul spațial
+    al orașelor și ultima temperatură a fiecărui oraș.
+    """
+    global STORAGE
+
+    if STORAGE_ENGINE == SQLITE:
+        STORAGE = SqliteStorage(os.getenv("SQLITE_PATH", ":memory:"))
+    elif STORAGE_ENGINE == POSTGRES:
+        STORAGE = PostgresStorage()
+    else:
+        raise ValueError("Stocare necunoscută: %s" % STORAGE_ENGINE)
+
+    # Invalidările făcute de celelalte procese ale serviciului.
+    STORAGE.subscribe(CACHE_CHANNEL, lambda payload: CACHE.invalidate(
+        *payload.split("\n")))
+    STORAGE.on_reconnect(CACHE.clear)
+    STORAGE.subscribe(CITY_CHANNEL, city_index_notified)
+    STORAGE.on_reconnect(reload_city_index)
+    STORAGE.subscribe(feed.CHANNEL, TEMP_FEED.notified)
+    STORAGE.on_reconnect(TEMP_FEED.reset)
+    STORAGE.subscribe(feed.CHANNEL, latest_notified)
+    STORAGE.on_reconnect(reload_latest)
+    STORAGE.open()
+
+    CITY_INDEX.load(STORAGE.find_cities)
+    LATEST.load(STORAGE.latest_readings)
+
+def statement_timeout():
+    """
+    Returns:
+        int: bugetul de timp al instrucțiunilor SQL ale cererii curente, în
+        milisecunde (0 nu îl limitează), după clasa ei (vezi route_class())
+    """
+    if request.url_rule is None:
+        return STATEMENT_TIMEOUT
+    return STATEMENT_TIMEOUTS.get(
+        route_class(request.url_rule, request.args), STATEMENT_TIMEOUT)
+
+def wrote_recently():
+    """
+    Returns:
+        True, dacă clientul cererii curente a scris în ultimele
+        READ_YOUR_WRITES secunde; citirile lui merg atunci la serverul
+        principal, nu la o replică
+    """
+    if READ_YOUR_WRITES <= 0:
+        return False
+    try:
+        written = float(request.cookies.get(LAST_WRITE_COOKIE, ""))
+    except ValueError:
+        return False
+    return time() - written < READ_YOUR_WRITES
+
+@APP.after_request
+def remember_write(response):
+    """
+    După o scriere reușită, clientul primește cookie-ul cu momentul ei, ca
+    citirile lui următoare să vadă scrierea (vezi wrote_recently()).
+    """
+    if READ_YOUR_WRITES > 0 and STORAGE is not None and \
+       STORAGE.replicated and \
+       request.method not in ("GET", "HEAD", "OPTIONS") and \
+       response.status_code < 400:
+        response.set_cookie(LAST_WRITE_COOKIE, "%.3f" % time(),
+                            max_age=int(READ_YOUR_WRITES) + 1,
+                            httponly=True, samesite="Lax")
+    return response
+
+# Clasa de admitere a interogărilor scumpe: rutele de mai jos, fără
+# niciunul din filtrele care le restrâng.
+HEAVY_CLASS = "heavy"
+HEAVY_ROUTES = {
+    "temp_get": ("lat", "lon", "from", "until"),
+    "temp_by_country_get": ("from", "until"),
+}
+# Rutele de observare, care trebuie să răspundă și sub suprasarcină.
+ADMISSION_EXEMPT = frozenset(("metrics_get", "pool_stats_get",
+                              "cache_stats_get", "stream_stats_get",
+                              "admission_stats_get"))
+
+def admission_class(environ):
+    """
+    Clasifică o cerere pentru controlul admiterii (vezi admission.py),
+    înainte ca Flask să o primească.
+
+    Returns:
+        str: HEAVY_CLASS, pentru interogările scumpe, altfel șablonul rutei
+        None: pentru cererile fără limită de concurență (fluxul de
+        evenimente, care are limita lui, și căile fără rută)
+        False: pentru rutele exceptate de la orice limită
+    """
+    try:
+        rule, _ = APP.url_map.bind_to_environ(environ).match(
+            return_rule=True)
+    except HTTPException:
+        return None
+
+    # Și cererile refuzate sunt măsurate sub ruta lor.
+    set_route(rule.rule)
+
+    if rule.endpoint in ADMISSION_EXEMPT:
+        return False
+    if rule.endpoint == "temp_stream_get":
+        return None
+
+    return route_class(rule, parse_qs(environ.get("QUERY_STRING", "")))
+
+def route_class(rule, args):
+    """
+    Returns:
+        str: HEAVY_CLASS, pentru interogările scumpe, altfel șablonul rutei
+    """
+    filters = HEAVY_ROUTES.get(rule.endpoint)
+    if filters is not None and not any(arg in args for arg in filters):
+        return HEAVY_CLASS
+    return rule.rule
+
+@APP.before_request
+def measure_route():
+    """
+    Cererea curentă este măsurată sub șablonul rutei ei.
+    """
+    if request.url_rule is not None:
+        set_route(request.url_rule.rule)
+
+@APP.errorhandler(QueueFull)
+def queue_full_handler(_err):
+    """
+    Coada de temperaturi este plină: serverul este supraîncărcat.
+    """
+    return Response(status=503, headers={"Retry-After": "1"})
+
+@APP.errorhandler(QueryTimeout)
+def statement_timeout_handler(_err):
+    """
+    O instrucțiune SQL a depășit bugetul de timp al cererii (vezi
+    statement_timeout()) și a fost anulată.
+    """
+    return Response(status=504)
+
+@APP.errorhandler(Unavailable)
+def db_unavailable_handler(_err):
+    """
+    Baza de date nu este disponibilă (de exemplu, este repornită) sau toate
+    conexiunile sunt ocupate.
+    """
+    return Response(status=503, headers={"Retry-After": "1"})
+
+@APP.route("/api/pool/stats", methods=["GET"])
+def pool_stats_get():
+    """
+    GET /api/pool/stats
+
+    Întoarce starea conexiunilor cu baza de date.
+
+    Succes: 200 și, pentru PostgreSQL, starea pool-ului de conexiuni:
+    {min: Int, max: Int, size: Int, in_use: Int, idle: Int,
+    waiting: Int, checkouts: Int, timeouts: Int, reconnects: Int,
+    wait_time_total: Double, wait_time_avg: Double, wait_time_max: Double}
+    și, dacă există replici de citire, replicas: {policy: String,
+    primary_reads: Int, replicas: [{name: String, healthy: Bool,
+    lag: Double, reads: Int, failures: Int, ...}, ...]}; pentru SQLite,
+    {engine: "sqlite", path: String, version: String, timeouts: Int}
+    """
+
+    return Response(
+        response=json.dumps(STORAGE.stats()),
+        status=200,
+        mimetype="application/json"
+    )
+
+def commit_and_invalidate(tx, *namespaces, cities=(), countries=()):
+    """
+    Face commit și invalidează răspunsurile din cache afectate de scriere, în
+    procesul curent și, prin notificări (trimise odată cu commit-ul), în
+    celelalte procese. La fel, orașele modificate sunt citite din nou în
+    indexul spațial al fiecărui proces.
+
+    Args:
+        tx - tranzacția de scriere.
+        namespaces - spațiile de nume ale cache-ului afectate.
+        cities - id-urile orașelor adăugate, modificate sau șterse.
+        countries - id-urile țărilor ale căror orașe au fost șterse în
+            cascadă.
+    """
+    # Conținutul unei notificări este limitat la 8000 de octeți; spațiile de
+    # nume sunt trimise câte 100 („countries\ncities”).
+    for start in range(0, len(namespaces), 100):
+        tx.notify(CACHE_CHANNEL, "\n".join(namespaces[start:start + 100]))
+    for kind, ids in (("city", list(cities)), ("country", list(countries))):
+        for start in range(0, len(ids), 500):
+            tx.notify(CITY_CHANNEL, "%s:%s" % (kind, ",".join(
+                map(str, ids[start:start + 500]))))
+
+    tx.commit()
+    CACHE.invalidate(*namespaces)
+    CITY_INDEX.refresh(tx.find_cities, cities, countries)
+
+def city_index_notified(payload):
+    """
+    Actualizează indexul spațial după o notificare de pe CITY_CHANNEL.
+    """
+    kind, _, ids = payload.partition(":")
+    ids = [int(ident) for ident in ids.split(",")]
+
+    if kind == "city":
+        CITY_INDEX.refresh(STORAGE.find_cities, city_ids=ids)
+    else:
+        CITY_INDEX.refresh(STORAGE.find_cities, country_ids=ids)
+
+def reload_city_index():
+    """
+    Încarcă din nou indexul spațial, de exemplu după ce unele notificări ar
+    fi putut fi pierdute.
+    """
+    CITY_INDEX.load(STORAGE.find_cities)
+
+def latest_notified(payload):
+    """
+    Actualizează ultimele temperaturi ale orașelor după o notificare de pe
+    canalul fluxului de temperaturi.
+    """
+    stale = LATEST.apply(feed.parse(payload))
+    if stale:
+        LATEST.refresh(STORAGE.latest_readings, stale)
+
+def reload_latest():
+    """
+    Încarcă din nou ultimele temperaturi, de exemplu după ce unele
+    notificări ar fi putut fi pierdute.
+    """
+    LATEST.load(STORAGE.latest_readings)
+
+def cached_response(entry):
+    """
+    Construiește răspunsul pentru o intrare din cache, cu ETag și, dacă
+    există o pagină următoare, cu antetul Link, construit pentru cererea
+    curentă. Dacă clientul are deja această versiune (If-None-Match), se
+    întoarce 304 fără corp.
+
+    Args:
+        entry - intrarea (CachedResponse).
+    Returns:
+        Response: 200 sau 304
+    """
+    headers = {"ETag": '"%s"' % entry.etag}
+    headers["Cache-Control"] = "no-cache"
+    if entry.next_cursor is not None:
+        headers["Link"] = next_page_link(entry.next_cursor)
+
+    if request.if_none_match.contains(entry.etag):
+        return Response(status=304, headers=headers)
+
+    return Response(
+        response=entry.body,
+        status=200,
+        headers=headers,
+        mimetype="application/json"
+    )
+
+@APP.route("/metrics", methods=["GET"])
+def metrics_get():
+    """
+    GET /metrics
+
+    Întoarce metricile serviciului în formatul text Prometheus: pentru
+    fiecare rută și metodă, numărul de cereri (pe coduri de răspuns) și
+    histogramele duratei, dimensiunii răspunsului și timpului și rândurilor
+    din baza de date, plus durata fiecărei interogări. În modul de producție,
+    valorile sunt adunate din toți workerii (cu o întârziere de cel mult
+    METRICS_SHARE_INTERVAL secunde pentru ceilalți workeri).
+
+    Succes: 200 și metricile, ca text
+    """
+
+    return Response(
+        response=METRICS.render(),
+        status=200,
+        mimetype="text/plain; version=0.0.4"
+    )
+
+@APP.route("/api/cache/stats", methods=["GET"])
+def cache_stats_get():
+    """
+    GET /api/cache/stats
+
+    Întoarce starea cache-ului de răspunsuri.
+
+    Succes: 200 și {entries: Int, max_entries: Int, hits: Int, misses: Int,
+    invalidations: Int}
+    """
+
+    return Response(
+        response=json.dumps(CACHE.stats()),
+        status=200,
+        mimetype="application/json"
+    )
+
+@APP.route("/api/stream/stats", methods=["GET"])
+def stream_stats_get():
+    """
+    GET /api/stream/stats
+
+    Întoarce starea fluxului de temperaturi al procesului curent.
+
+    Succes: 200 și {subscribers: Int, max_subscribers: Int, events: Int,
+    messages: Int, dropped: Int}
+    """
+
+    return Response(
+        response=json.dumps(TEMP_FEED.stats()),
+        status=200,
+        mimetype="application/json"
+    )
+
+@APP.route("/api/admission/stats", methods=["GET"])
+def admission_stats_get():
+    """
+    GET /api/admission/stats
+
+    Întoarce starea controlului admiterii în procesul curent.
+
+    Succes: 200 și {rate_limit: {rate: Double, burst: Int, clients: Int}
+    sau null, classes: {clasă: {limit: Int, queue: Int, running: Int,
+    waiting: Int, admitted: Int, queued: Int, rejected: Int,
+    timeouts: Int}, ...}}
+    """
+
+    return Response(
+        response=json.dumps(ADMISSION.stats()),
+        status=200,
+        mimetype="application/json"
+    )
+
+def encode_cursor(values):
+    """
+    Codifică cheia ultimului rând dintr-o pagină într-un token opac.
+
+    Args:
+        values - lista valorilor cheii (serializabile JSON).
+    Returns:
+        str: token-ul, sigur pentru URL-uri
+    """
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token):
+    """
+    Decodifică un token produs de encode_cursor().
+
+    Returns:
+        list: valorile cheii
+        None: dacă token-ul este invalid
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+
+    return values if isinstance(values, list) else None
+
+def page_args(max_size):
+    """
+    Citește parametrii de paginare „limit” și „after” ai cererii curente.
+    O limită mai mare decât max_size este redusă la max_size, iar lipsa ei
+    înseamnă max_size.
+
+    Returns:
+        (limit, cheie) - cheia este None pentru prima pagină
+        None: dacă vreunul din parametri este invalid
+    """
+    limit = request.args.get("limit", max_size)
+    try:
+        limit = min(int(limit), max_size)
+    except ValueError:
+        return None
+
+    if limit < 1:
+        return None
+
+    after = request.args.get("after")
+    if after is None:
+        return limit, None
+
+    key = decode_cursor(after)
+    if key is None:
+        return None
+
+    return limit, key
+
+def next_page_link(token):
+    """
+    Construiește antetul Link către pagina următoare, păstrând ceilalți
+    parametri ai cererii curente.
+
+    Returns:
+        str: valoarea antetului Link
+    """
+    args = request.args.copy()
+    args["after"] = token
+    return '<%s?%s>; rel="next"' % (request.base_url,
+                                    urlencode(list(args.items(multi=True))))
+
+def list_page(namespace, fetch_page):
+    """
+    Întoarce o pagină dintr-un tabel mic (țări, orașe), ordonată după cheia
+    primară. Paginarea este pe bază de cheie („keyset”), deci orice pagină
+    costă la fel de mult ca prima.
+
+    Paginile sunt păstrate în cache până la prima scriere care le afectează
+    și sunt trimise cu ETag, deci o pagină nemodificată nu mai ajunge la baza
+    de date.
+
+    Args:
+        namespace - spațiul de nume din cache, invalidat de scrieri.
+        fetch_page - funcția care citește pagina, apelată cu limita, cheia
+            ultimului rând din pagina anterioară (sau None) și bugetul de
+            timp (vezi Storage.countries_page()); cheia este prima coloană.
+    Returns:
+        Response: pagina, cu antetul Link dacă mai există rezultate, sau 304
+    """
+    page = page_args(PAGE_MAX_SIZE)
+    if page is None:
+        return Response(status=400)
+    limit, key = page
+
+    if key is not None and (len(key) != 1 or not isinstance(key[0], int)):
+        return Response(status=400)
+    after = key[0] if key is not None else None
+
+    cache_key = (limit, after)
+    entry = CACHE.get(namespace, cache_key)
+    if entry is not None:
+        return cached_response(entry)
+    generation = CACHE.generation(namespace)
+
+    # Se cere un rând în plus, ca să se știe dacă există o pagină următoare.
+    description, results = fetch_page(limit, after,
+                                      timeout=statement_timeout())
+    encoder = RowEncoder(description)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor([results[-1][0]])
+
+    entry = CACHE.put(namespace, cache_key, generation,
+                      encoder.encode_list(results), next_cursor)
+
+    return cached_response(entry)
+
+def ids_arg():
+    """
+    Citește parametrul „ids” al cererii curente: id-uri separate prin
+    virgulă („1,2,3”).
+
+    Returns:
+        list: id-urile, fără duplicate, în ordine crescătoare
+        None: dacă vreunul nu este un număr întreg
+    """
+    value = request.args["ids"]
+    try:
+        return sorted({int(ident) for ident in value.split(",")}) \
+               if value else []
+    except ValueError:
+        return None
+
+def list_ids(namespace, fetch_rows):
+    """
+    Întoarce rândurile cu id-urile din parametrul „ids” (vezi ids_arg()),
+    citite cu o singură interogare; id-urile care nu există lipsesc din
+    rezultat. Ca paginile din list_page(), răspunsul este păstrat în cache
+    și trimis cu ETag.
+
+    Args:
+        namespace - spațiul de nume din cache, invalidat de scrieri.
+        fetch_rows - funcția care citește rândurile, apelată cu lista
+            id-urilor și bugetul de timp (vezi Storage.countries_by_ids()).
+    Returns:
+        Response: rândurile, în ordinea id-urilor, sau 304
+    """
+    ids = ids_arg()
+    if ids is None or len(ids) > PAGE_MAX_SIZE:
+        return Response(status=400)
+
+    cache_key = ("ids",) + tuple(ids)
+    entry = CACHE.get(namespace, cache_key)
+    if entry is not None:
+        return cached_response(entry)
+    generation = CACHE.generation(namespace)
+
+    description, results = fetch_rows(ids, timeout=statement_timeout())
+    entry = CACHE.put(namespace, cache_key, generation,
+                      RowEncoder(description).encode_list(results))
+
+    return cached_response(entry)
+
+def batch_payload():
+    """
+    Citește corpul unei cereri de tip lot: o listă JSON sau un flux NDJSON
+    (Content-Type: application/x-ndjson), cu câte un element pe linie. O
+    linie care nu este JSON valid devine None, ca elementul să primească 400.
+
+    Returns:
+        list: elementele lotului
+        None: dacă corpul nu este o listă JSON
+    """
+    if request.mimetype != "application/x-ndjson":
+        payload = request.get_json(silent=True)
+        return payload if isinstance(payload, list) else None
+
+    payload = []
+    for line in request.get_data(as_text=True).splitlines():
+        if not line.strip():
+            continue
+        try:
+            payload.append(json.loads(line))
+        except ValueError:
+            payload.append(None)
+
+    return payload
+
+def catalog_batch(is_valid, apply):
+    """
+    Rulează o cerere /api/countries/batch sau /api/cities/batch: elementele
+    invalide primesc 400, iar celelalte sunt aplicate într-o singură
+    tranzacție.
+
+    Args:
+        is_valid - funcția care verifică un element al lotului.
+        apply - funcția apelată cu tranzacția și elementele valide, care
+            face commit și întoarce rezultatul fiecăruia ({status: Int}).
+    Returns:
+        Response: 200 și câte un rezultat pentru fiecare element, în aceeași
+        ordine; 400 sau 413 (prea multe elemente, vezi CATALOG_BATCH_MAX)
+    """
+    payload = batch_payload()
+    if payload is None:
+        return Response(status=400)
+
+    if len(payload) > CATALOG_BATCH_MAX:
+        return Response(status=413)
+
+    indexes = [idx for idx, item in enumerate(payload) if is_valid(item)]
+    results = [{"status": 400} for _ in payload]
+
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            applied = apply(tx, [payload[idx] for idx in indexes])
+        except InvalidValue:
+            # Nu ar trebui să se ajungă aici, valorile fiind verificate mai
+            # sus.
+            return Response(status=400)
+        except Conflict:
+            # Un rând a fost modificat în paralel de altă cerere.
+            return Response(status=409)
+
+    for idx, result in zip(indexes, applied):
+        results[idx] = result
+
+    return Response(
+        response=json.dumps(results),
+        status=200,
+        mimetype="application/json"
+    )
+
+def place_validator(validator):
+    """
+    Returns:
+        funcția care verifică o țară sau un oraș dintr-un lot: obiect valid
+        pentru schema dată, care încape în coloanele tabelului
+    """
+    return lambda item: validator.is_valid(item) and place_fits(item)
+
+def date_filters(filters):
+    """
+    Adaugă filtrele pentru parametrii „from” și „until” ai cererii curente.
+    Capătul „until” este inclusiv: se întorc și temperaturile din acea zi.
+
+    Args:
+        filters - filtrele (vezi Storage.temperatures()), completate pe loc.
+    Returns:
+        dict: filtrele
+    """
+    for arg in ("from", "until"):
+        value = request.args.get(arg)
+        if value is not None:
+            filters[arg] = value
+
+    return filters
+
+def temp_page(filters):
+    """
+    Întoarce o pagină de temperaturi, ordonate după (temp_timestamp,
+    temp_id), ca flux (vezi stream_results()). Parametrii „limit” și „after”
+    sunt citiți din cererea curentă; „after” codifică perechea
+    (temp_timestamp, temp_id) a ultimului rând din pagina anterioară.
+
+    Args:
+        filters - filtrele (vezi Storage.temperatures()).
+    Returns:
+        Response: pagina; 400, dacă parametrii de paginare sunt invalizi
+    """
+    page = page_args(TEMP_PAGE_MAX_SIZE)
+    if page is None:
+        return Response(status=400)
+    limit, key = page
+
+    after = None
+    if key is not None:
+        if len(key) != 2 or not isinstance(key[1], int):
+            return Response(status=400)
+        try:
+            after = (datetime.fromisoformat(key[0]), key[1])
+        except (TypeError, ValueError):
+            return Response(status=400)
+
+    return stream_results(STORAGE.temperatures(
+        filters, limit, after, statement_timeout(), wrote_recently()))
+
+def stream_results(results):
     """
-    Pornește conexiunea cu baza de date și verifică dacă există configurația de
-    de tabele necesară. Dacă nu există, aceasta este creată.
+    Rulează o citire și întoarce un răspuns care trimite rezultatele pe
+    măsură ce sunt citite, în loturi de STREAM_BATCH_SIZE rânduri. Memoria
+    folosită nu depinde de numărul de rânduri, iar primul octet pleacă după
+    primul lot.
+
+    Formatul este ales după parametrul „format” sau, în lipsa lui, după
+    antetul Accept (vezi FORMATS din serialization.py): listă JSON
+    (implicit), NDJSON, câte un obiect pe linie, CSV sau, pentru analize,
+    formatele columnare Apache Arrow (flux IPC) și Parquet, cu un lot de
+    rânduri pentru fiecare lot citit. Dacă citirea eșuează (de exemplu,
+    un filtru are tipul greșit), nu se întoarce nimic.
+
+    Citirea are bugetul de timp al cererii (vezi statement_timeout()).
+    Primul lot este citit înainte de trimiterea antetului, deci o citire
+    care îl depășește până atunci primește 504; mai târziu, fluxul este doar
+    întrerupt. Dacă clientul închide conexiunea, citirea este anulată imediat
+    (vezi DisconnectWatch).
+
+    Dacă rezultatele au o pagină următoare (next_key), se adaugă antetul
+    Link către ea.
+
+    Args:
+        results - citirea (Results), încă nedeschisă.
+    Returns:
+        Response: răspunsul de tip flux; 400, dacă formatul cerut nu există,
+        406, dacă pyarrow nu este instalat, sau 504, dacă citirea a depășit
+        bugetul de timp
     """
-    global CONN
+    name = request.args.get("format")
+    if name is None:
+        mimetype = request.accept_mimetypes.best_match(
+            list(FORMATS.values()), FORMATS["json"])
+        name = next(key for key, value in FORMATS.items()
+                    if value == mimetype)
+    elif name not in FORMATS:
+        return Response(status=400)
+    if name not in AVAILABLE_FORMATS:
+        # pyarrow nu este instalat.
+        return Response(status=406)
+    mimetype = FORMATS[name]
 
-    host = "db"
-    database = os.getenv("POSTGRES_DB", "postgres")
-    user = os.getenv("POSTGRES_USER", "admin")
-    password = os.getenv("POSTGRES_PASSWORD", "adminpass")
+    watch = DisconnectWatch(request.environ, results.cancel)
+    try:
+        rows = results.open(STREAM_BATCH_SIZE)
+    except QueryTimeout:
+        watch.stop()
+        results.close()
+        return Response(status=504)
+    except InvalidValue:
+        watch.stop()
+        results.close()
+        # Unul din filtre a avut tipul greșit, deci nu se întoarce nimic.
+        return Response(
+            response="[]" if name == "json" else "",
+            status=200,
+            mimetype=mimetype
+        )
+    except Exception:
+        watch.stop()
+        results.close()
+        raise
+
+    headers = {}
+    if results.next_key is not None:
+        headers["Link"] = next_page_link(encode_cursor(
+            [results.next_key[0].isoformat(), results.next_key[1]]))
+
+    released = []
+
+    def release():
+        """
+        Eliberează citirea, o singură dată.
+        """
+        if not released:
+            released.append(True)
+            watch.stop()
+            results.close()
 
-    # Rulează în buclă până pornește serverul bazei de date.
-    while True:
+    def generate():
+        """
+        Produce răspunsul bucată cu bucată.
+        """
         try:
-            CONN = psycopg2.connect(host=host, database=database,
-                                    user=user, password=password)
-            cursor = CONN.cursor()
-
-            # Creează tabelul „countries”, dacă nu există.
-            cursor.execute("SELECT * FROM information_schema.tables WHERE "
-                           "table_name=\'countries\'")
-            if not bool(cursor.rowcount):
-                cursor.execute(
-                    """
-                    CREATE TABLE countries (
-                        country_id SERIAL PRIMARY KEY,
-                        country_name VARCHAR(255) NOT NULL UNIQUE,
-                        country_lat NUMERIC(6, 4) NOT NULL,
-                        country_lon NUMERIC(7, 4) NOT NULL
-                    )
-                    """)
-
-            # Creează tabelul „cities”, dacă nu există.
-            cursor.execute("SELECT * FROM information_schema.tables WHERE "
-                           "table_name=\'cities\'")
-            if not bool(cursor.rowcount):
-                cursor.execute(
-                    """
-                    CREATE TABLE cities (
-                        city_id SERIAL PRIMARY KEY,
-                        country_id INTEGER NOT NULL,
-                        city_name VARCHAR(255) NOT NULL,
-                        city_lat NUMERIC(6, 4) NOT NULL,
-                        city_lon NUMERIC(7, 4) NOT NULL,
-                        unique (country_id, city_name),
-                        CONSTRAINT fk_country_id
-                            FOREIGN KEY(country_id)
-                            REFERENCES countries(country_id)
-                            ON DELETE CASCADE
-                            ON UPDATE CASCADE
-                    )
-                    """)
-
-            # Creează tabelul „temperatures”, dacă nu există.
-            cursor.execute("SELECT * FROM information_schema.tables WHERE "
-                           "table_name=\'temperatures\'")
-            if not bool(cursor.rowcount):
-                cursor.execute(
-                    """
-                    CREATE TABLE temperatures (
-                        temp_id SERIAL PRIMARY KEY,
-                        temp_value NUMERIC(6, 4) NOT NULL,
-                        temp_timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
-                        city_id INTEGER NOT NULL,
-                        unique (temp_timestamp, city_id),
-                        CONSTRAINT fk_city_id
-                            FOREIGN KEY(city_id)
-                            REFERENCES cities(city_id)
-                            ON DELETE CASCADE
-                            ON UPDATE CASCADE
-                    )
-                    """)
-
-            cursor.close()
-            CONN.commit()
-
-            return
-        except psycopg2.OperationalError:
-            sleep(1)
+            # Descrierea coloanelor este cunoscută abia după prima citire.
+            writer = stream_writer(name, results.description)
+            yield writer.begin()
+
+            batch = rows
+            while batch:
+                yield writer.encode(batch)
+                batch = results.fetchmany(STREAM_BATCH_SIZE)
+
+            yield writer.end()
+        except QueryTimeout:
+            APP.logger.warning("Fluxul de rezultate a fost anulat (%s).",
+                               "clientul a plecat" if watch.disconnected
+                               else "bugetul de timp a fost depășit")
+        except StorageError:
+            # Antetul a plecat deja, deci răspunsul este doar întrerupt.
+            APP.logger.exception("Fluxul de rezultate a fost întrerupt.")
+        finally:
+            release()
+
+    response = Response(generate(), status=200, headers=headers,
+                        mimetype=mimetype)
+    # Citirea trebuie eliberată și dacă fluxul nu este parcurs deloc
+    # (clientul a închis conexiunea înainte de primul octet).
+    response.call_on_close(release)
+
+    return response
 
 ################################## Rute Tari ###################################
 
@@ -162,31 +1027,19 @@ def countries_post():
     if not is_valid:
         return Response(status=400)
 
-    cursor = CONN.cursor()
-
-    values = list(payload.values())
-    values[0] = f"\'{values[0]}\'"
-    values = ", ".join(map(str, values))
-    columns = "country_name, country_lat, country_lon"
-    query = """ INSERT INTO countries(%s) VALUES(%s) \
-                RETURNING country_id; """ % (columns, values)
-
-    try:
-        cursor.execute(query)
-        country_id = cursor.fetchone()[0]
-    except psycopg2.errors.NumericValueOutOfRange:
-        # Latitudinea sau Longitudinea au valori eronate (prea mari sau prea
-        # mici).
-        CONN.rollback()
-        return Response(status=400)
-    except psycopg2.errors.UniqueViolation:
-        # Există deja o țară cu acel nume.
-        CONN.rollback()
-        return Response(status=409)
-    finally:
-        cursor.close()
-
-    CONN.commit()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            country_id = tx.add_country(payload["nume"], payload["lat"],
+                                        payload["lon"])
+        except InvalidValue:
+            # Latitudinea sau Longitudinea au valori eronate (prea mari sau
+            # prea mici).
+            return Response(status=400)
+        except Conflict:
+            # Există deja o țară cu acel nume.
+            return Response(status=409)
+
+        commit_and_invalidate(tx, "countries")
 
     return Response(
         response=json.dumps({"id": country_id}),
@@ -203,20 +1056,102 @@ def countries_get():
 
     Succes: 200 și [ {id: Int, nume: Str, lat: Double, lon: Double}, {...}, ...]
     - lista de obiecte
+
+    Rezultatele sunt paginate: „limit” (implicit și cel mult PAGE_MAX_SIZE) dă
+    dimensiunea paginii, iar „after” este token-ul din antetul Link
+    (rel="next") al paginii anterioare.
+
+    Cu „ids” („?ids=1,2,3”, cel mult PAGE_MAX_SIZE id-uri), se întorc doar
+    țările cu acele id-uri care există, nepaginate, în ordinea id-urilor.
+    Eroare: 400, dacă „limit”, „after” sau „ids” sunt invalizi.
     """
 
-    cursor = CONN.cursor(cursor_factory=RealDictCursor)
-    query = """ SELECT * FROM countries; """
+    if "ids" in request.args:
+        return list_ids("countries", STORAGE.countries_by_ids)
 
-    cursor.execute(query)
-    results = cursor.fetchall()
-    cursor.close()
+    return list_page("countries", STORAGE.countries_page)
 
-    return Response(
-        response=json.dumps(results, cls=DecimalEncoder),
-        status=200,
-        mimetype="application/json"
-    )
+@APP.route("/api/countries/batch", methods=["POST"])
+def countries_batch_post():
+    """
+    POST /api/countries/batch
+
+    Adaugă mai multe țări, într-o singură tranzacție. Corpul cererii este fie
+    o listă JSON, fie un flux NDJSON (vezi POST /api/temperatures/batch).
+
+    Fiecare element primește propriul cod, cu aceeași semnificație ca la
+    POST /api/countries: 201 (adăugată), 400 (obiect invalid, nume prea lung
+    sau coordonate prea mari / prea mici) sau 409 (există deja o țară cu
+    același nume, inclusiv mai devreme în același lot).
+
+    Body: [ {nume: Str, lat: Double, lon: Double}, {...}, ...]
+    Succes: 200 și [ {id: Int, status: 201}, {status: Int}, ...] - câte un
+    rezultat pentru fiecare element, în aceeași ordine
+    Eroare: 400 sau 413 (prea multe elemente, vezi CATALOG_BATCH_MAX)
+    """
+
+    def apply(tx, items):
+        added = tx.add_countries([(item["nume"], item["lat"], item["lon"])
+                                  for item in items])
+        commit_and_invalidate(tx, "countries")
+        return [{"id": country_id, "status": status} if status == 201
+                else {"status": status} for status, country_id in added]
+
+    return catalog_batch(place_validator(COUNTRY_BATCH_VALIDATORS["POST"]),
+                         apply)
+
+@APP.route("/api/countries/batch", methods=["PUT"])
+def countries_batch_put():
+    """
+    PUT /api/countries/batch
+
+    Modifică mai multe țări, într-o singură tranzacție (vezi
+    POST /api/countries/batch). Un nume nou nu poate fi cel pe care îl avea
+    altă țară înaintea lotului, chiar dacă și aceea este redenumită în lot,
+    și nici unul dat mai devreme în același lot.
+
+    Body: [ {id: Int, nume: Str, lat: Double, lon: Double}, {...}, ...]
+    Succes: 200 și [ {status: Int}, ...] - 200, 400, 404 (țara nu există)
+    sau 409 (numele este folosit sau țara apare de două ori în lot)
+    Eroare: 400 sau 413
+    """
+
+    def apply(tx, items):
+        statuses = tx.update_countries([
+            (item["id"], item["nume"], item["lat"], item["lon"])
+            for item in items
+        ])
+        commit_and_invalidate(tx, "countries")
+        return [{"status": status} for status in statuses]
+
+    return catalog_batch(place_validator(COUNTRY_BATCH_VALIDATORS["PUT"]),
+                         apply)
+
+@APP.route("/api/countries/batch", methods=["DELETE"])
+def countries_batch_del():
+    """
+    DELETE /api/countries/batch
+
+    Șterge mai multe țări și, în cascadă, orașele lor, într-o singură
+    tranzacție (vezi POST /api/countries/batch).
+
+    Body: [ Int, ...] - id-urile țărilor
+    Succes: 200 și [ {status: Int}, ...] - 200, 400 (id invalid) sau 404
+    (țara nu există sau apare mai devreme în lot)
+    Eroare: 400 sau 413
+    """
+
+    def apply(tx, country_ids):
+        statuses = tx.delete_countries(country_ids)
+        deleted = [country_id for country_id, status
+                   in zip(country_ids, statuses) if status == 200]
+        # Orașele țărilor sunt șterse în cascadă.
+        commit_and_invalidate(tx, "countries", "cities", *[
+            "cities/country/%d" % country_id for country_id in deleted
+        ], countries=deleted)
+        return [{"status": status} for status in statuses]
+
+    return catalog_batch(ID_VALIDATOR.is_valid, apply)
 
 @APP.route("/api/countries/<int:country_id>", methods=["PUT"])
 def countries_put(country_id=None):
@@ -247,38 +1182,23 @@ def countries_put(country_id=None):
     if not is_valid or country_id != payload["id"]:
         return Response(status=400)
 
-    cursor = CONN.cursor()
-
-    values = list(payload.values())[1:]
-    values[0] = f"\'{values[0]}\'"
-    columns = ["country_name", "country_lat", "country_lon"]
-    changes = []
-    for col, val in zip(columns, map(str, values)):
-        changes.append("%s=%s" % (col, val))
-
-    query = """ UPDATE countries SET %s WHERE country_id=%d \
-                RETURNING country_id; """ % (", ".join(changes), country_id)
-
-    try:
-        cursor.execute(query)
-        num_updates = len(cursor.fetchall())
-    except psycopg2.errors.NumericValueOutOfRange:
-        # Latitudinea sau Longitudinea au valori eronate (prea mari sau prea
-        # mici).
-        CONN.rollback()
-        return Response(status=400)
-    except psycopg2.errors.UniqueViolation:
-        # Există deja o țară cu acel nume.
-        CONN.rollback()
-        return Response(status=409)
-    finally:
-        cursor.close()
-
-    if num_updates == 0:
-        # Țara de actualizat nu există în baza de date.
-        return Response(status=404)
-
-    CONN.commit()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            updated = tx.update_country(country_id, payload["nume"],
+                                        payload["lat"], payload["lon"])
+        except InvalidValue:
+            # Latitudinea sau Longitudinea au valori eronate (prea mari sau
+            # prea mici).
+            return Response(status=400)
+        except Conflict:
+            # Există deja o țară cu acel nume.
+            return Response(status=409)
+
+        if not updated:
+            # Țara de actualizat nu există în baza de date.
+            return Response(status=404)
+
+        commit_and_invalidate(tx, "countries")
 
     return Response(status=200)
 
@@ -293,20 +1213,15 @@ def countries_del(country_id=None):
     Eroare: 404
     """
 
-    cursor = CONN.cursor()
-
-    query = """ DELETE FROM countries WHERE country_id=%d \
-                RETURNING 1; """ % country_id
-
-    cursor.execute(query)
-    num_updates = len(cursor.fetchall())
-    cursor.close()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        if not tx.delete_country(country_id):
+            # Țara de șters nu există în baza de date.
+            return Response(status=404)
 
-    if num_updates == 0:
-        # Țara de șters nu există în baza de date.
-        return Response(status=404)
-
-    CONN.commit()
+        # Orașele țării sunt șterse în cascadă.
+        commit_and_invalidate(tx, "countries", "cities",
+                              "cities/country/%d" % country_id,
+                              countries=[country_id])
 
     return Response(status=200)
 
@@ -341,35 +1256,24 @@ def cities_post():
     if not is_valid:
         return Response(status=400)
 
-    cursor = CONN.cursor()
-
-    values = list(payload.values())
-    values[1] = f"\'{values[1]}\'"
-    values = ", ".join(map(str, values))
-    columns = "country_id, city_name, city_lat, city_lon"
-    query = """ INSERT INTO cities(%s) VALUES(%s) \
-                RETURNING city_id; """ % (columns, values)
-
-    try:
-        cursor.execute(query)
-        city_id = cursor.fetchone()[0]
-    except psycopg2.errors.NumericValueOutOfRange:
-        # Latitudinea sau Longitudinea au valori eronate (prea mari sau prea
-        # mici).
-        CONN.rollback()
-        return Response(status=400)
-    except psycopg2.errors.ForeignKeyViolation:
-        # Nu există o țară cu id-ul dat.
-        CONN.rollback()
-        return Response(status=404)
-    except psycopg2.errors.UniqueViolation:
-        # Există deja un oraș cu acest nume în aceeași țară.
-        CONN.rollback()
-        return Response(status=409)
-    finally:
-        cursor.close()
-
-    CONN.commit()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            city_id = tx.add_city(payload["idTara"], payload["nume"],
+                                  payload["lat"], payload["lon"])
+        except InvalidValue:
+            # Latitudinea sau Longitudinea au valori eronate (prea mari sau
+            # prea mici).
+            return Response(status=400)
+        except MissingReference:
+            # Nu există o țară cu id-ul dat.
+            return Response(status=404)
+        except Conflict:
+            # Există deja un oraș cu acest nume în aceeași țară.
+            return Response(status=409)
+
+        commit_and_invalidate(tx, "cities",
+                              "cities/country/%d" % payload["idTara"],
+                              cities=[city_id])
 
     return Response(
         response=json.dumps({"id": city_id}),
@@ -387,20 +1291,110 @@ def cities_get():
     Succes: 200 și
     [ {id: Int, idTara: Int, nume: Str, lat: Double, lon: Double}, {...}, ...]
     - lista de obiecte
+
+    Rezultatele sunt paginate: „limit” (implicit și cel mult PAGE_MAX_SIZE) dă
+    dimensiunea paginii, iar „after” este token-ul din antetul Link
+    (rel="next") al paginii anterioare.
+
+    Cu „ids” („?ids=1,2,3”, cel mult PAGE_MAX_SIZE id-uri), se întorc doar
+    orașele cu acele id-uri care există, nepaginate, în ordinea id-urilor.
+    Eroare: 400, dacă „limit”, „after” sau „ids” sunt invalizi.
     """
 
-    cursor = CONN.cursor(cursor_factory=RealDictCursor)
-    query = """ SELECT * FROM cities; """
+    if "ids" in request.args:
+        return list_ids("cities", STORAGE.cities_by_ids)
 
-    cursor.execute(query)
-    results = cursor.fetchall()
-    cursor.close()
+    return list_page("cities", STORAGE.cities_page)
 
-    return Response(
-        response=json.dumps(results, cls=DecimalEncoder),
-        status=200,
-        mimetype="application/json"
-    )
+@APP.route("/api/cities/batch", methods=["POST"])
+def cities_batch_post():
+    """
+    POST /api/cities/batch
+
+    Adaugă mai multe orașe, într-o singură tranzacție (vezi
+    POST /api/countries/batch).
+
+    Fiecare element primește propriul cod, cu aceeași semnificație ca la
+    POST /api/cities: 201 (adăugat), 400, 404 (țara nu există) sau 409
+    (există deja un oraș cu același nume în aceeași țară, inclusiv mai
+    devreme în același lot).
+
+    Body: [ {idTara: Int, nume: Str, lat: Double, lon: Double}, {...}, ...]
+    Succes: 200 și [ {id: Int, status: 201}, {status: Int}, ...]
+    Eroare: 400 sau 413
+    """
+
+    def apply(tx, items):
+        added = tx.add_cities([
+            (item["idTara"], item["nume"], item["lat"], item["lon"])
+            for item in items
+        ])
+        created = [(item["idTara"], city_id) for item, (status, city_id)
+                   in zip(items, added) if status == 201]
+        commit_and_invalidate(tx, "cities", *{
+            "cities/country/%d" % country_id for country_id, _ in created
+        }, cities=[city_id for _, city_id in created])
+        return [{"id": city_id, "status": status} if status == 201
+                else {"status": status} for status, city_id in added]
+
+    return catalog_batch(place_validator(CITY_BATCH_VALIDATORS["POST"]),
+                         apply)
+
+@APP.route("/api/cities/batch", methods=["PUT"])
+def cities_batch_put():
+    """
+    PUT /api/cities/batch
+
+    Modifică mai multe orașe, într-o singură tranzacție (vezi
+    PUT /api/countries/batch; cheia unică este țara și numele orașului).
+
+    Body: [ {id: Int, idTara: Int, nume: Str, lat: Double, lon: Double},
+    {...}, ...]
+    Succes: 200 și [ {status: Int}, ...] - 200, 400, 404 (orașul sau țara nu
+    există) sau 409
+    Eroare: 400 sau 413
+    """
+
+    def apply(tx, items):
+        updated = tx.update_cities([
+            (item["id"], item["idTara"], item["nume"], item["lat"],
+             item["lon"]) for item in items
+        ])
+        changed = [(item, old_country) for item, (status, old_country)
+                   in zip(items, updated) if status == 200]
+        # Orașul poate să se fi mutat în altă țară.
+        commit_and_invalidate(tx, "cities", *{
+            "cities/country/%d" % country_id for item, old_country in changed
+            for country_id in (item["idTara"], old_country)
+        }, cities=[item["id"] for item, _ in changed])
+        return [{"status": status} for status, _ in updated]
+
+    return catalog_batch(place_validator(CITY_BATCH_VALIDATORS["PUT"]),
+                         apply)
+
+@APP.route("/api/cities/batch", methods=["DELETE"])
+def cities_batch_del():
+    """
+    DELETE /api/cities/batch
+
+    Șterge mai multe orașe, într-o singură tranzacție (vezi
+    DELETE /api/countries/batch).
+
+    Body: [ Int, ...] - id-urile orașelor
+    Succes: 200 și [ {status: Int}, ...] - 200, 400 (id invalid) sau 404
+    Eroare: 400 sau 413
+    """
+
+    def apply(tx, city_ids):
+        deleted = tx.delete_cities(city_ids)
+        gone = [(city_id, country_id) for city_id, (status, country_id)
+                in zip(city_ids, deleted) if status == 200]
+        commit_and_invalidate(tx, "cities", *{
+            "cities/country/%d" % country_id for _, country_id in gone
+        }, cities=[city_id for city_id, _ in gone])
+        return [{"status": status} for status, _ in deleted]
+
+    return catalog_batch(ID_VALIDATOR.is_valid, apply)
 
 @APP.route("/api/cities/country/<int:country_id>", methods=["GET"])
 def cities_by_country_get(country_id=None):
@@ -412,17 +1406,44 @@ def cities_by_country_get(country_id=None):
     Succes: 200 și
     [ {id: Int, idTara: Int, nume: Str, lat: Double, lon: Double}, {...}, ...]
     - lista de obiecte
+
+    Rezultatele sunt paginate: „limit” (implicit și cel mult PAGE_MAX_SIZE) dă
+    dimensiunea paginii, iar „after” este token-ul din antetul Link
+    (rel="next") al paginii anterioare.
+    Eroare: 400, dacă „limit” sau „after” sunt invalizi.
+    """
+
+    return list_page("cities/country/%d" % country_id,
+                     lambda limit, after, timeout: STORAGE.cities_page(
+                         limit, after, country_id, timeout))
+
+@APP.route("/api/cities/nearest", methods=["GET"])
+def cities_nearest_get():
     """
+    GET /api/cities/nearest?lat=Double&lon=Double&k=Int
 
-    cursor = CONN.cursor(cursor_factory=RealDictCursor)
-    query = """ SELECT * FROM cities WHERE country_id=%d; """ % country_id
+    Întoarce cele mai apropiate k orașe (implicit 1, cel mult
+    CITY_NEAREST_MAX) de punctul dat, în ordinea distanței, folosind indexul
+    spațial din memorie.
+
+    Succes: 200 și
+    [ {id: Int, idTara: Int, nume: Str, lat: Double, lon: Double,
+    distanta: Double}, {...}, ...] - lista de obiecte, cu distanța în km
+    Eroare: 400, dacă lat, lon sau k lipsesc ori sunt invalide
+    """
+
+    lat = number_arg("lat", -90, 90)
+    lon = number_arg("lon", -180, 180)
+    count = number_arg("k", 1, CITY_NEAREST_MAX) if "k" in request.args \
+            else 1
+    if lat is None or lon is None or count is None or count != int(count):
+        return Response(status=400)
 
-    cursor.execute(query)
-    results = cursor.fetchall()
-    cursor.close()
+    cities = [dict(city, distance_km=round(distance, 3)) for distance, city
+              in CITY_INDEX.nearest(lat, lon, int(count))]
 
     return Response(
-        response=json.dumps(results, cls=DecimalEncoder),
+        response=json.dumps(cities),
         status=200,
         mimetype="application/json"
     )
@@ -457,42 +1478,32 @@ def cities_put(city_id=None):
     if not is_valid or city_id != payload["id"]:
         return Response(status=400)
 
-    cursor = CONN.cursor()
-
-    values = list(payload.values())[1:]
-    values[1] = f"\'{values[1]}\'"
-    columns = ["country_id", "city_name", "city_lat", "city_lon"]
-    changes = []
-    for col, val in zip(columns, map(str, values)):
-        changes.append("%s=%s" % (col, val))
-
-    query = """ UPDATE cities SET %s WHERE city_id=%d \
-                RETURNING city_id; """ % (", ".join(changes), city_id)
-
-    try:
-        cursor.execute(query)
-        num_updates = len(cursor.fetchall())
-    except psycopg2.errors.NumericValueOutOfRange:
-        # Latitudinea sau Longitudinea au valori eronate (prea mari sau prea
-        # mici).
-        CONN.rollback()
-        return Response(status=400)
-    except psycopg2.errors.ForeignKeyViolation:
-        # Țara cu id-ul dat nu există.
-        CONN.rollback()
-        return Response(status=404)
-    except psycopg2.errors.UniqueViolation:
-        # Există deja un oraș cu același nume în aceeași țară.
-        CONN.rollback()
-        return Response(status=409)
-    finally:
-        cursor.close()
-
-    if num_updates == 0:
-        # Orașul de actualizat nu există.
-        return Response(status=404)
-
-    CONN.commit()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            # Se întoarce și țara dinainte de modificare, ca să fie
+            # invalidate orașele ambelor țări.
+            old_country_id = tx.update_city(city_id, payload["idTara"],
+                                            payload["nume"], payload["lat"],
+                                            payload["lon"])
+        except InvalidValue:
+            # Latitudinea sau Longitudinea au valori eronate (prea mari sau
+            # prea mici).
+            return Response(status=400)
+        except MissingReference:
+            # Țara cu id-ul dat nu există.
+            return Response(status=404)
+        except Conflict:
+            # Există deja un oraș cu același nume în aceeași țară.
+            return Response(status=409)
+
+        if old_country_id is None:
+            # Orașul de actualizat nu există.
+            return Response(status=404)
+
+        commit_and_invalidate(tx, "cities",
+                              "cities/country/%d" % old_country_id,
+                              "cities/country/%d" % payload["idTara"],
+                              cities=[city_id])
 
     return Response(status=200)
 
@@ -507,19 +1518,14 @@ def cities_del(city_id=None):
     Eroare: 404
     """
 
-    cursor = CONN.cursor()
-
-    query = """ DELETE FROM cities WHERE city_id=%d RETURNING 1; """ % city_id
+    with STORAGE.transaction(statement_timeout()) as tx:
+        country_id = tx.delete_city(city_id)
+        if country_id is None:
+            # Orașul de șters nu există.
+            return Response(status=404)
 
-    cursor.execute(query)
-    num_updates = len(cursor.fetchall())
-    cursor.close()
-
-    if num_updates == 0:
-        # Orașul de șters nu există.
-        return Response(status=404)
-
-    CONN.commit()
+        commit_and_invalidate(tx, "cities", "cities/country/%d" % country_id,
+                              cities=[city_id])
 
     return Response(status=200)
 
@@ -534,7 +1540,8 @@ def temp_post():
 
     Body: {idOras: Int, valoare: Double} - obiect
     Succes: 201 și { id: Int }
-    Eroare: 400, 404 sau 409
+    Eroare: 400, 404 sau 409; 503, dacă temperaturile sunt scrise în loturi
+    și coada este plină
     """
 
     body_schema = {
@@ -552,33 +1559,37 @@ def temp_post():
     if not is_valid:
         return Response(status=400)
 
-    cursor = CONN.cursor()
+    if STORAGE.writer is not None:
+        if not temperature_in_range(payload["valoare"]):
+            return Response(status=400)
 
-    values = list(payload.values())
-    values = ", ".join(map(str, values))
-    columns = "city_id, temp_value"
-    query = """ INSERT INTO temperatures(%s) VALUES(%s) \
-                RETURNING temp_id; """ % (columns, values)
+        # Răspunsul este trimis după commit-ul lotului temperaturii.
+        status, temp_id = STORAGE.writer.submit(payload["idOras"],
+                                                payload["valoare"])
+        if status != 201:
+            return Response(status=status, headers={"Retry-After": "1"}
+                            if status == 503 else None)
 
-    try:
-        cursor.execute(query)
-        temp_id = cursor.fetchone()[0]
-    except psycopg2.errors.NumericValueOutOfRange:
-        # Valoarea este eronată (prea mare sau prea mică).
-        CONN.rollback()
-        return Response(status=400)
-    except psycopg2.errors.ForeignKeyViolation:
-        # Orașul cu id-ul dat nu există.
-        CONN.rollback()
-        return Response(status=404)
-    except psycopg2.errors.UniqueViolation:
-        # Există deja o intrare din același oraș cu același timestamp.
-        CONN.rollback()
-        return Response(status=409)
-    finally:
-        cursor.close()
-
-    CONN.commit()
+        return Response(
+            response=json.dumps({"id": temp_id}),
+            status=201,
+            mimetype="application/json"
+        )
+
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            temp_id = tx.add_temperature(payload["idOras"], payload["valoare"])
+        except InvalidValue:
+            # Valoarea este eronată (prea mare sau prea mică).
+            return Response(status=400)
+        except MissingReference:
+            # Orașul cu id-ul dat nu există.
+            return Response(status=404)
+        except Conflict:
+            # Există deja o intrare din același oraș cu același timestamp.
+            return Response(status=409)
+
+        tx.commit()
 
     return Response(
         response=json.dumps({"id": temp_id}),
@@ -586,6 +1597,76 @@ def temp_post():
         mimetype="application/json"
     )
 
+@APP.route("/api/temperatures/batch", methods=["POST"])
+def temp_batch_post():
+    """
+    POST /api/temperatures/batch
+
+    Adaugă mai multe temperaturi în baza de date, într-o singură tranzacție.
+    Corpul cererii este fie o listă JSON, fie un flux NDJSON (Content-Type:
+    application/x-ndjson), cu câte un obiect pe linie. Dacă nu se dă
+    timestamp-ul, se folosește momentul de început al tranzacției, la fel ca
+    la POST /api/temperatures.
+
+    Fiecare element primește propriul cod, cu aceeași semnificație ca la
+    POST /api/temperatures: 201 (adăugat), 400 (obiect invalid, valoare
+    prea mare / prea mică sau timestamp mai vechi decât perioada de retenție
+    ori după ultima partiție creată), 404 (orașul nu există) sau 409 (există
+    deja o temperatură în același oraș cu același timestamp, inclusiv mai
+    devreme în același lot).
+
+    Body: [ {idOras: Int, valoare: Double, timestamp: Date?}, {...}, ...]
+    Succes: 200 și [ {id: Int, status: 201}, {status: Int}, ...] - câte un
+    rezultat pentru fiecare element, în aceeași ordine
+    Eroare: 400 sau 413 (prea multe elemente, vezi TEMP_BATCH_MAX)
+    """
+
+    payload = batch_payload()
+    if payload is None:
+        return Response(status=400)
+
+    if len(payload) > TEMP_BATCH_MAX:
+        return Response(status=413)
+
+    results = [{"status": 400} for _ in payload]
+    # Elementele valide: (index, id oraș, valoare, timestamp sau None).
+    items = []
+
+    for idx, item in enumerate(payload):
+        if not TEMP_BATCH_VALIDATOR.is_valid(item):
+            continue
+
+        if not temperature_in_range(item["valoare"]):
+            continue
+
+        timestamp = None
+        if "timestamp" in item:
+            timestamp = parse_timestamp(item["timestamp"])
+            if timestamp is None:
+                continue
+
+        items.append((idx, item["idOras"], item["valoare"], timestamp))
+
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            added = tx.add_temperatures([item[1:] for item in items])
+        except InvalidValue:
+            # Nu ar trebui să se ajungă aici, valorile fiind verificate mai
+            # sus.
+            return Response(status=400)
+
+        tx.commit()
+
+    for (idx, *_), (status, temp_id) in zip(items, added):
+        results[idx] = {"id": temp_id, "status": status} if status == 201 \
+                       else {"status": status}
+
+    return Response(
+        response=json.dumps(results),
+        status=200,
+        mimetype="application/json"
+    )
+
 @APP.route("/api/temperatures", methods=["GET"])
 def temp_get():
     """
@@ -600,68 +1681,19 @@ def temp_get():
 
     Succes: 200 și [ {id: Int, valoare: Double, timestamp: Date}, {...}, ...]
     - lista de obiecte
-    """
 
-    # Condiția este construită bucată cu bucată.
-    condition = ""
-
-    lat = request.args.get("lat")
-    if lat is not None:
-        condition += "cities.city_lat=%s " % lat
-
-    lon = request.args.get("lon")
-    if lon is not None:
-        if condition != "":
-            condition += "and "
-        condition += "cities.city_lon=%s " % lon
-
-    from_date = request.args.get("from")
-    if from_date is not None:
-        if condition != "":
-            condition += "and "
-        condition += "temperatures.temp_timestamp >= \'" + from_date + \
-                    "\'::timestamp "
-
-    until_date = request.args.get("until")
-    if until_date is not None:
-        if condition != "":
-            condition += "and "
-        condition += "temperatures.temp_timestamp < \'" + until_date + \
-                    "\'::timestamp + \'1 day\'::interval "
-
-    cursor = CONN.cursor(cursor_factory=RealDictCursor)
-
-    if condition == "":
-        # Dacă cererea nu a avut argumente în URL.
-        query = """ SELECT city_id, temp_id, temp_value,           \
-                    TO_CHAR(temp_timestamp,'YYYY-MM-DD HH:MI:SS')  \
-                    AS temp_timestamp                              \
-                    FROM temperatures; """
-    else:
-        # Dacă cererea a avut argumente.
-        query = """ SELECT temperatures.city_id, temperatures.temp_id,         \
-                    temperatures.temp_value,                                   \
-                    TO_CHAR(temperatures.temp_timestamp,'YYYY-MM-DD HH:MI:SS') \
-                    AS temp_timestamp                                          \
-                    FROM temperatures INNER JOIN cities                        \
-                    ON temperatures.city_id = cities.city_id                   \
-                    WHERE %s ; """ % condition
+    Rezultatele sunt trimise în flux, pe pagini: „limit” (implicit și cel
+    mult TEMP_PAGE_MAX_SIZE) dă dimensiunea paginii, iar „after” este
+    token-ul din antetul Link (rel="next") al paginii anterioare. Cu antetul
+    Accept: application/x-ndjson, se trimite câte un obiect pe linie.
+    Eroare: 400, dacă „limit” sau „after” sunt invalizi.
+    """
 
-    try:
-        cursor.execute(query)
-        results = cursor.fetchall()
-    except psycopg2.Error:
-        # Unul din parametri a avut tipul greșit, deci nu se întoarce nimic.
-        results = []
-        CONN.rollback()
-    finally:
-        cursor.close()
+    # Coordonatele sunt ale orașelor.
+    filters = {arg: request.args[arg] for arg in ("lat", "lon")
+               if arg in request.args}
 
-    return Response(
-        response=json.dumps(results, cls=DecimalEncoder),
-        status=200,
-        mimetype="application/json"
-    )
+    return temp_page(date_filters(filters))
 
 @APP.route("/api/temperatures/cities/<int:city_id>", methods=["GET"])
 def temp_by_city_get(city_id=None):
@@ -677,50 +1709,15 @@ def temp_by_city_get(city_id=None):
 
     Succes: 200 și [{id: Int, valoare: Double, timestamp: Date}, {...}, ...]
     - lista de obiecte
-    """
-
-    # Condiția este construită bucată cu bucată.
-    date_cond = ""
-
-    from_date = request.args.get("from")
-    if from_date is not None:
-        date_cond = "temp_timestamp >= \'" + from_date + "\'::timestamp "
-
-    until_date = request.args.get("until")
-    if until_date is not None:
-        if date_cond != "":
-            date_cond += "and "
-        date_cond += "temp_timestamp < \'" + until_date + \
-                    "\'::timestamp + \'1 day\'::interval "
-
-    condition = "WHERE city_id=%d" % city_id
-
-    if date_cond != "":
-        condition += " and " + date_cond
-
-    cursor = CONN.cursor(cursor_factory=RealDictCursor)
 
-    query = """ SELECT city_id, temp_id, temp_value,          \
-                TO_CHAR(temp_timestamp,'YYYY-MM-DD HH:MI:SS') \
-                AS temp_timestamp                             \
-                FROM temperatures %s; """ % condition
-
-    try:
-        cursor.execute(query)
-        results = cursor.fetchall()
-    except psycopg2.Error:
-        # Unul din parametrii a avut tipul greșit, deci nu se întoarce nimic.
-        results = []
-        CONN.rollback()
-    finally:
-        cursor.close()
-
-    return Response(
-        response=json.dumps(results, cls=DecimalEncoder),
-        status=200,
-        mimetype="application/json"
-    )
+    Rezultatele sunt trimise în flux, pe pagini: „limit” (implicit și cel
+    mult TEMP_PAGE_MAX_SIZE) dă dimensiunea paginii, iar „after” este
+    token-ul din antetul Link (rel="next") al paginii anterioare. Cu antetul
+    Accept: application/x-ndjson, se trimite câte un obiect pe linie.
+    Eroare: 400, dacă „limit” sau „after” sunt invalizi.
+    """
 
+    return temp_page(date_filters({"city": city_id}))
 
 @APP.route("/api/temperatures/countries/<int:country_id>", methods=["GET"])
 def temp_by_country_get(country_id=None):
@@ -735,53 +1732,186 @@ def temp_by_country_get(country_id=None):
 
     Succes: 200 și [{id: Int, valoare: Double, timestamp: Date}, {...}, ...]
     - lista de obiecte
+
+    Rezultatele sunt trimise în flux, pe pagini: „limit” (implicit și cel
+    mult TEMP_PAGE_MAX_SIZE) dă dimensiunea paginii, iar „after” este
+    token-ul din antetul Link (rel="next") al paginii anterioare. Cu antetul
+    Accept: application/x-ndjson, se trimite câte un obiect pe linie.
+    Eroare: 400, dacă „limit” sau „after” sunt invalizi.
     """
 
-    # Condiția este construită bucată cu bucată.
-    date_cond = ""
+    return temp_page(date_filters({"country": country_id}))
 
-    from_date = request.args.get("from")
-    if from_date is not None:
-        date_cond = "temp_timestamp >= \'" + from_date + "\'::timestamp "
+@APP.route("/api/temperatures/near", methods=["GET"])
+def temp_near_get():
+    """
+    GET /api/temperatures/near?lat=Double&lon=Double&radius_km=Double&
+        from=Date&until=Date
 
-    until_date = request.args.get("until")
-    if until_date is not None:
-        if date_cond != "":
-            date_cond += "and "
-        date_cond += "temp_timestamp < \'" + until_date + \
-                    "\'::timestamp + \'1 day\'::interval "
+    Întoarce temperaturile din orașele aflate la cel mult radius_km
+    kilometri de punctul dat. Orașele sunt găsite în indexul spațial din
+    memorie. Capetele intervalului de date sunt opționale, cu aceeași
+    semnificație ca la GET /api/temperatures.
 
-    condition = "WHERE countries.country_id=%d" % country_id
+    Succes: 200 și [ {id: Int, valoare: Double, timestamp: Date}, {...}, ...]
+    - lista de obiecte, trimisă în flux și paginată ca la GET /api/temperatures
+    Eroare: 400, dacă lat, lon sau radius_km lipsesc ori sunt invalide, sau
+    dacă „limit” sau „after” sunt invalizi
+    """
 
-    if date_cond != "":
-        condition += " and " + date_cond
+    lat = number_arg("lat", -90, 90)
+    lon = number_arg("lon", -180, 180)
+    radius_km = number_arg("radius_km", 0)
+    if lat is None or lon is None or radius_km is None:
+        return Response(status=400)
 
-    cursor = CONN.cursor(cursor_factory=RealDictCursor)
+    city_ids = [city["city_id"] for _, city
+                in CITY_INDEX.within(lat, lon, radius_km)]
 
-    query = """ SELECT temperatures.city_id, temperatures.temp_id,             \
-                temperatures.temp_value,                                       \
-                TO_CHAR(temperatures.temp_timestamp,'YYYY-MM-DD HH:MI:SS')     \
-                AS temp_timestamp                                              \
-                FROM temperatures INNER JOIN cities                            \
-                ON temperatures.city_id = cities.city_id INNER JOIN countries  \
-                ON cities.country_id = countries.country_id %s; """ % condition
+    return temp_page(date_filters({"cities": city_ids}))
 
-    try:
-        cursor.execute(query)
-        results = cursor.fetchall()
-    except psycopg2.Error:
-        # Unul din parametrii a avut tipul greșit, deci nu se întoarce nimic.
-        results = []
-        CONN.rollback()
-    finally:
-        cursor.close()
+@APP.route("/api/temperatures/latest", methods=["GET"])
+def temp_latest_get():
+    """
+    GET /api/temperatures/latest?country=Int&city=Int
+
+    Întoarce ultima temperatură a fiecărui oraș din țara dată, a orașului
+    dat sau, fără filtre, a tuturor orașelor. Răspunsul vine din memorie,
+    fără a folosi baza de date; o scriere apare în el după ce procesul
+    primește notificarea ei (la câteva milisecunde după commit). Orașele
+    fără temperaturi lipsesc din listă.
+
+    Succes: 200 și [{city_id: Int, temp_id: Int, temp_value: Double,
+    temp_timestamp: Date}, {...}, ...] - lista de obiecte, în ordinea
+    orașelor
+    Eroare: 400, dacă city sau country nu sunt întregi; 404, dacă orașul
+    dat nu există
+    """
+
+    filters = {}
+    for arg in ("city", "country"):
+        value = request.args.get(arg)
+        if value is not None:
+            try:
+                filters[arg] = int(value)
+            except ValueError:
+                return Response(status=400)
+
+    if "city" in filters:
+        country_id = CITY_INDEX.country_of(filters["city"])
+        if country_id is None:
+            # Orașul cu id-ul dat nu există.
+            return Response(status=404)
+        city_ids = [filters["city"]]
+        if filters.get("country", country_id) != country_id:
+            city_ids = []
+    else:
+        city_ids = CITY_INDEX.city_ids(filters.get("country"))
 
     return Response(
-        response=json.dumps(results, cls=DecimalEncoder),
+        response=json.dumps(LATEST.get(city_ids)),
         status=200,
         mimetype="application/json"
     )
 
+@APP.route("/api/temperatures/stream", methods=["GET"])
+def temp_stream_get():
+    """
+    GET /api/temperatures/stream?city=Int&country=Int
+
+    Trimite, ca Server-Sent Events (text/event-stream), temperaturile
+    adăugate („created”), modificate („updated”) și șterse („deleted”) de
+    acum înainte, din orașul și/sau țara date (fără filtre, pe toate).
+    Fiecare eveniment are ca date {temp_id: Int, city_id: Int,
+    temp_value: Double, temp_timestamp: Date}; la „deleted” lipsește
+    temp_value, iar la o temperatură mutată în alt oraș, previous_city_id
+    este orașul vechi. Evenimentul „reset” anunță că unele evenimente ar fi
+    putut fi pierdute, iar clientul ar trebui să citească din nou
+    temperaturile. Ștergerile în cascadă (ale orașelor și țărilor) nu sunt
+    trimise.
+
+    Fluxul nu folosește baza de date: evenimentele vin prin notificările
+    stocării (cu PostgreSQL, prin LISTEN, pe o singură conexiune a
+    procesului), comune tuturor clienților.
+
+    Succes: 200 și fluxul de evenimente
+    Eroare: 400, dacă city sau country nu sunt întregi; 503, dacă procesul
+    are deja TEMP_STREAM_MAX_CLIENTS clienți
+    """
+
+    filters = {}
+    for arg in ("city", "country"):
+        value = request.args.get(arg)
+        if value is not None:
+            try:
+                filters[arg] = int(value)
+            except ValueError:
+                return Response(status=400)
+
+    subscription = TEMP_FEED.subscribe(filters.get("city"),
+                                       filters.get("country"))
+    if subscription is None:
+        return Response(status=503, headers={"Retry-After": "1"})
+
+    def generate():
+        # Clientul se reconectează după 5 secunde, dacă fluxul se întrerupe.
+        yield b"retry: 5000\n\n"
+        while True:
+            messages = subscription.next_messages(TEMP_STREAM_HEARTBEAT)
+            if messages:
+                yield b"".join(messages)
+            elif not subscription.closed:
+                yield b": keepalive\n\n"
+
+            if subscription.closed:
+                if subscription.overflowed:
+                    # Clientul nu a citit destul de repede.
+                    yield b"event: reset\ndata: {}\n\n"
+                return
+
+    response = Response(
+        response=generate(),
+        status=200,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        mimetype="text/event-stream"
+    )
+    # Abonarea este anulată și dacă clientul pleacă înainte de primul mesaj.
+    response.call_on_close(lambda: TEMP_FEED.unsubscribe(subscription))
+    return response
+
+@APP.route("/api/temperatures/stats", methods=["GET"])
+def temp_stats_get():
+    """
+    GET /api/temperatures/stats?bucket=Str&city=Int&country=Int&lat=Double&
+        lon=Double&from=Date&until=Date
+
+    Întoarce, pentru fiecare interval de timp (oră, zi sau lună, după
+    „bucket”), temperatura minimă, maximă, medie și numărul de temperaturi,
+    calculate în baza de date. Filtrele sunt opționale și se combină: oraș,
+    țară, coordonatele orașului și capetele intervalului de date, cu aceeași
+    semnificație ca la GET /api/temperatures. Dacă vreunul din filtre are un
+    tip de date greșit, nu se întoarce nimic.
+
+    Cu PostgreSQL, dacă lipsesc capetele intervalului sau sunt date
+    calendaristice, rezultatul se calculează din agregatele orare sau
+    zilnice (vezi rollups.py), nu din fiecare temperatură.
+
+    Succes: 200 și [ {bucket: Date, min: Double, max: Double, avg: Double,
+    count: Int}, {...}, ...] - lista de obiecte, în ordinea intervalelor
+    Eroare: 400, dacă „bucket” lipsește sau nu este hour, day sau month
+    """
+
+    bucket = request.args.get("bucket")
+    if bucket not in ("hour", "day", "month"):
+        return Response(status=400)
+
+    filters = {arg: request.args[arg] for arg in ("city", "country", "lat",
+                                                   "lon")
+               if arg in request.args}
+
+    return stream_results(STORAGE.temperature_stats(
+        bucket, date_filters(filters), statement_timeout(), wrote_recently()))
+
 @APP.route("/api/temperatures/<int:temp_id>", methods=["PUT"])
 def temp_put(temp_id=None):
     """
@@ -810,40 +1940,26 @@ def temp_put(temp_id=None):
     if not is_valid or temp_id != payload["id"]:
         return Response(status=400)
 
-    cursor = CONN.cursor()
-
-    values = list(payload.values())[1:]
-    columns = ["city_id", "temp_value"]
-    changes = []
-    for col, val in zip(columns, map(str, values)):
-        changes.append("%s=%s" % (col, val))
-
-    query = """ UPDATE temperatures SET %s WHERE temp_id=%d \
-                RETURNING temp_id; """ % (", ".join(changes), temp_id)
-
-    try:
-        cursor.execute(query)
-        num_updates = len(cursor.fetchall())
-    except psycopg2.errors.NumericValueOutOfRange:
-        # Valoarea este eronată (prea mare sau prea mică).
-        CONN.rollback()
-        return Response(status=400)
-    except psycopg2.errors.ForeignKeyViolation:
-        # Orașul cu id-ul dat nu există.
-        CONN.rollback()
-        return Response(status=404)
-    except psycopg2.errors.UniqueViolation:
-        # Există deja o temperatură în același oraș și cu același timestamp.
-        CONN.rollback()
-        return Response(status=409)
-    finally:
-        cursor.close()
-
-    if num_updates == 0:
-        # Temperatura cu id-ul dat nu există.
-        return Response(status=404)
-
-    CONN.commit()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        try:
+            updated = tx.update_temperature(temp_id, payload["idOras"],
+                                            payload["valoare"])
+        except InvalidValue:
+            # Valoarea este eronată (prea mare sau prea mică).
+            return Response(status=400)
+        except MissingReference:
+            # Orașul cu id-ul dat nu există.
+            return Response(status=404)
+        except Conflict:
+            # Există deja o temperatură în același oraș și cu același
+            # timestamp.
+            return Response(status=409)
+
+        if not updated:
+            # Temperatura cu id-ul dat nu există.
+            return Response(status=404)
+
+        tx.commit()
 
     return Response(status=200)
 
@@ -858,42 +1974,92 @@ def temp_del(temp_id=None):
     Eroare: 404
     """
 
-    cursor = CONN.cursor()
-
-    query = """ DELETE FROM temperatures \
-                WHERE temp_id=%d RETURNING 1; """ % temp_id
-
-    cursor.execute(query)
-    num_updates = len(cursor.fetchall())
-    cursor.close()
+    with STORAGE.transaction(statement_timeout()) as tx:
+        if not tx.delete_temperature(temp_id):
+            # Temperatura cu id-ul dat nu există.
+            return Response(status=404)
 
-    if num_updates == 0:
-        # Temperatura cu id-ul dat nu există.
-        return Response(status=404)
-
-    CONN.commit()
+        tx.commit()
 
     return Response(status=200)
 
 ##################################### Main #####################################
 
+def shutdown():
+    """
+    Închide fluxurile de evenimente și scrie temperaturile rămase în coadă,
+    la oprirea procesului.
+    """
+    TEMP_FEED.close()
+    if STORAGE is not None:
+        STORAGE.close()
+
 def main():
     """
     Entrypoint-ul programului.
     Aplicația reprezintă un web backend ce lucrează cu o bază de date.
-    """
-    init_postgres()
 
+    Implicit, rulează serverul de dezvoltare Flask în debugging mode, pentru
+    vizualizarea ușoară a efectelor cererilor. Cu WEB_SERVICE_SERVER=gevent,
+    rulează serverul de producție din prefork.py: WEB_SERVICE_WORKERS procese
+    (implicit, câte unul pentru fiecare procesor; unul singur, cu SQLite),
+    fiecare cu propriile conexiuni cu baza de date și cel mult
+    WEB_SERVICE_CONNECTIONS conexiuni HTTP deservite simultan. SIGHUP
+    înlocuiește workerii fără întreruperi, iar SIGTERM îi oprește după ce
+    termină cererile în curs (cel mult WEB_SERVICE_GRACEFUL_TIMEOUT
+    secunde).
+    """
     addr = os.getenv("WEB_SERVICE_ADDR", "0.0.0.0")
     port = os.getenv("WEB_SERVICE_PORT", "80")
+
+    if os.getenv("WEB_SERVICE_SERVER", "debug") == "gevent":
+        logging.basicConfig(level=logging.INFO,
+                            format="%(asctime)s %(process)d %(levelname)s "
+                                   "%(name)s: %(message)s")
+        patch_psycopg()
+
+        # Directorul în care workerii își scriu metricile, ca oricare din ei
+        # să le poată întoarce pe ale tuturor.
+        metrics_dir = tempfile.mkdtemp(prefix="web-service-metrics-")
+        interval = float(os.getenv("METRICS_SHARE_INTERVAL", "1"))
+
+        def init_worker():
+            METRICS.share(metrics_dir, interval)
+            init_storage()
+
+        def exit_worker():
+            shutdown()
+            # Ultimele valori ale workerului rămân în director.
+            METRICS.dump()
+
+        workers = int(os.getenv("WEB_SERVICE_WORKERS", "0")) or \
+                  os.cpu_count() or 1
+        if STORAGE_ENGINE == SQLITE and workers > 1:
+            # Notificările SQLite nu trec dintr-un proces în altul, iar o
+            # bază de date în memorie ar fi diferită în fiecare worker.
+            APP.logger.warning("Stocarea SQLite rulează cu un singur "
+                               "worker, nu %d.", workers)
+            workers = 1
+
+        server = PreforkServer(
+            APP, (addr, int(port)),
+            workers=workers,
+            init_worker=init_worker,
+            exit_worker=exit_worker,
+            drain_worker=TEMP_FEED.close,
+            graceful_timeout=float(
+                os.getenv("WEB_SERVICE_GRACEFUL_TIMEOUT", "30")),
+            worker_connections=int(
+                os.getenv("WEB_SERVICE_CONNECTIONS", "10000")))
+        try:
+            server.serve_forever()
+        finally:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+        return
+
+    init_storage()
+    atexit.register(shutdown)
     APP.run(host=addr, port=int(port), debug=True)
-    # Pentru rulare în mediu de producție se decomentează liniile 885 și 886 și
-    # se șterge linia 879.
-    # Se adaugă și următorul import: from gevent.pywsgi import WSGIServer
-    # Totuși, voi lăsa serverul în debugging mode, pentru vizualizare mai
-    # ușoară a efectelor cererilor.
-    # http_server = WSGIServer(('', 80), APP)
-    # http_server.serve_forever()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,925 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from time import monotonic, perf_counter
+
+import json
+import logging
+import sqlite3
+import threading
+
+from metrics import record_query
+from storage import (Conflict, InvalidValue, MissingReference, QueryTimeout,
+                     Results, Storage, Transaction, Unavailable,
+                     update_statuses)
+import feed
+
+LOGGER = logging.getLogger(__name__)
+
+# Aceleași tabele și constrângeri ca în migrations.py. Coloanele NUMERIC(6, 4)
+# și NUMERIC(7, 4) sunt REAL, cu valorile rotunjite la 4 zecimale înainte de
+# scriere (vezi numeric()) și cu aceleași limite; momentele sunt text
+# („2020-11-25 10:30:00.000000”), deci se ordonează ca datele.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS countries (
+    country_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    country_name TEXT NOT NULL UNIQUE CHECK (length(country_name) <= 255),
+    country_lat REAL NOT NULL CHECK (abs(country_lat) < 100),
+    country_lon REAL NOT NULL CHECK (abs(country_lon) < 1000)
+);
+
+CREATE TABLE IF NOT EXISTS cities (
+    city_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    country_id INTEGER NOT NULL
+        REFERENCES countries(country_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE,
+    city_name TEXT NOT NULL CHECK (length(city_name) <= 255),
+    city_lat REAL NOT NULL CHECK (abs(city_lat) < 100),
+    city_lon REAL NOT NULL CHECK (abs(city_lon) < 1000),
+    UNIQUE (country_id, city_name)
+);
+
+CREATE TABLE IF NOT EXISTS temperatures (
+    temp_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    temp_value REAL NOT NULL CHECK (abs(temp_value) < 100),
+    temp_timestamp TEXT NOT NULL,
+    city_id INTEGER NOT NULL
+        REFERENCES cities(city_id)
+        ON DELETE CASCADE
+        ON UPDATE CASCADE,
+    UNIQUE (temp_timestamp, city_id)
+);
+
+CREATE INDEX IF NOT EXISTS cities_lat_lon_idx
+    ON cities (city_lat, city_lon);
+CREATE INDEX IF NOT EXISTS temperatures_city_ts_idx
+    ON temperatures (city_id, temp_timestamp, temp_id, temp_value);
+CREATE INDEX IF NOT EXISTS temperatures_ts_id_idx
+    ON temperatures (temp_timestamp, temp_id);
+"""
+
+# Formatul momentelor din tabelul temperatures.
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Codurile tipurilor PostgreSQL din descrierea coloanelor, după care
+# serialization.py alege convertoarele.
+INT = 23
+BIGINT = 20
+NUMERIC = 1700
+TEXT = 25
+
+# Momentul temperaturii, în formatul storage.DISPLAY_FORMAT (ora pe 12 ore,
+# ca în pg_storage.TEMP_COLUMNS); strftime() din SQLite nu are „%I”.
+DISPLAY_TIMESTAMP = """ strftime('%Y-%m-%d ', temperatures.temp_timestamp) || \
+                        printf('%02d', (CAST(strftime('%H',                    \
+                               temperatures.temp_timestamp) AS INTEGER)        \
+                               + 11) % 12 + 1) ||                              \
+                        strftime(':%M:%S', temperatures.temp_timestamp) """
+# Începutul fiecărui interval al GET /api/temperatures/stats.
+BUCKET_FORMATS = {
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d 00:00:00",
+    "month": "%Y-%m-01 00:00:00",
+}
+
+def description(*columns):
+    """
+    Returns:
+        tuple: descrierea coloanelor (ca cursor.description) pentru
+        perechile (nume, cod de tip) date
+    """
+    return tuple((name, type_code, None, None, None, None, None)
+                 for name, type_code in columns)
+
+COUNTRY_COLUMNS = description(("country_id", INT), ("country_name", TEXT),
+                              ("country_lat", NUMERIC),
+                              ("country_lon", NUMERIC))
+CITY_COLUMNS = description(("city_id", INT), ("country_id", INT),
+                           ("city_name", TEXT), ("city_lat", NUMERIC),
+                           ("city_lon", NUMERIC))
+TEMP_COLUMNS = description(("city_id", INT), ("temp_id", INT),
+                           ("temp_value", NUMERIC), ("temp_timestamp", TEXT))
+STATS_COLUMNS = description(("bucket", TEXT), ("min", NUMERIC),
+                            ("max", NUMERIC), ("avg", NUMERIC),
+                            ("count", BIGINT))
+
+def numeric(value):
+    """
+    Returns:
+        float: valoarea rotunjită la 4 zecimale, ca într-o coloană
+        NUMERIC(p, 4)
+    Raises:
+        InvalidValue, dacă valoarea nu este un număr finit
+    """
+    try:
+        return float(Decimal(str(value)).quantize(Decimal("0.0001"),
+                                                  ROUND_HALF_UP))
+    except (InvalidOperation, ValueError) as err:
+        raise InvalidValue() from err
+
+def to_text(timestamp):
+    """
+    Returns:
+        str: momentul, în formatul din tabelul temperatures
+    """
+    return timestamp.strftime(TIMESTAMP_FORMAT)
+
+def to_datetime(text):
+    """
+    Returns:
+        datetime: momentul citit din tabelul temperatures
+    """
+    return datetime.strptime(text, TIMESTAMP_FORMAT)
+
+def day_arg(value, days=0):
+    """
+    Returns:
+        str: capătul unui interval de date („from”, „until”), deplasat cu
+        numărul dat de zile, în formatul din tabelul temperatures
+    Raises:
+        InvalidValue, dacă valoarea nu este o dată sau un moment
+    """
+    try:
+        return to_text(datetime.fromisoformat(value) + timedelta(days=days))
+    except (TypeError, ValueError) as err:
+        raise InvalidValue() from err
+
+def typed_arg(value, kind):
+    """
+    Returns:
+        valoarea unui filtru, convertită la tipul coloanei (int sau float),
+        cum o convertește și PostgreSQL
+    Raises:
+        InvalidValue, dacă valoarea nu are tipul coloanei
+    """
+    try:
+        return kind(value)
+    except (TypeError, ValueError) as err:
+        raise InvalidValue() from err
+
+def id_list(ids):
+    """
+    Returns:
+        str: lista de id-uri ca JSON, pentru json_each()
+    """
+    return json.dumps([int(ident) for ident in ids])
+
+def query(conn, sql, params=()):
+    """
+    Rulează o instrucțiune și măsoară durata ei (vezi metrics.py).
+
+    Returns:
+        (cursor, rows) - cursorul, pentru lastrowid și rowcount, și
+        rândurile întoarse
+    """
+    start = perf_counter()
+    cursor = conn.execute(sql, params)
+    rows = cursor.fetchall()
+    record_query(cursor, perf_counter() - start, len(rows))
+    return cursor, rows
+
+def temp_filters(filters):
+    """
+    Construiește condițiile pentru filtrele unei citiri de temperaturi (vezi
+    Storage.temperatures() și pg_storage.temp_filters()).
+
+    Returns:
+        (from_clause, conditions, params)
+    Raises:
+        InvalidValue, dacă un filtru are tipul greșit
+    """
+    conditions = []
+    params = []
+
+    if "city" in filters:
+        conditions.append("temperatures.city_id = ?")
+        params.append(typed_arg(filters["city"], int))
+
+    if "cities" in filters:
+        conditions.append("temperatures.city_id IN "
+                          "(SELECT value FROM json_each(?))")
+        params.append(id_list(filters["cities"]))
+
+    join_cities = False
+    for name, column, kind in (("country", "cities.country_id", int),
+                               ("lat", "cities.city_lat", float),
+                               ("lon", "cities.city_lon", float)):
+        if name in filters:
+            conditions.append("%s = ?" % column)
+            params.append(typed_arg(filters[name], kind))
+            join_cities = True
+
+    # Capătul „until” este inclusiv: se întorc și temperaturile din acea zi.
+    if "from" in filters:
+        conditions.append("temperatures.temp_timestamp >= ?")
+        params.append(day_arg(filters["from"]))
+
+    if "until" in filters:
+        conditions.append("temperatures.temp_timestamp < ?")
+        params.append(day_arg(filters["until"], 1))
+
+    from_clause = "temperatures"
+    if join_cities:
+        from_clause += """ INNER JOIN cities                                  \
+                           ON temperatures.city_id = cities.city_id """
+
+    return from_clause, conditions, params
+
+def where(conditions):
+    """
+    Returns:
+        str: clauza WHERE cu toate condițiile sau nimic, dacă nu există
+    """
+    return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+class SqliteStorage(Storage):
+    """
+    Stocare încorporată, în SQLite: un fișier sau, cu „:memory:”, doar în
+    memoria procesului. Nu are nevoie de un server de baze de date, deci
+    serviciul pornește imediat (de exemplu, pentru teste, benchmark-uri sau
+    instalări pe dispozitive mici).
+
+    Schema are aceleași constrângeri ca în PostgreSQL: nume unice, chei
+    străine cu ștergere în cascadă (PRAGMA foreign_keys) și aceleași limite
+    ale valorilor. Toate cererile folosesc o singură conexiune, pe rând; o
+    tranzacție ține conexiunea de la prima instrucțiune până la commit.
+
+    Notificările sunt livrate doar abonaților din procesul curent, imediat
+    după commit, deci serviciul trebuie să ruleze într-un singur proces.
+    Replicile, partițiile, agregatele și scrierea în loturi ale temperaturilor
+    există doar în PostgreSQL; statisticile sunt calculate direct din
+    temperaturi.
+    """
+    def __init__(self, path=":memory:"):
+        """
+        Args:
+            path - fișierul bazei de date sau „:memory:”.
+        """
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+        # Momentul după care instrucțiunea în curs este întreruptă.
+        self._deadline = None
+        self._subscribers = {}
+        self._timeouts = 0
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def on_reconnect(self, callback):
+        # Notificările sunt livrate în același proces, deci nu se pierd.
+        pass
+
+    def open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               isolation_level=None)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL;")
+        conn.executescript(SCHEMA)
+        # Instrucțiunile sunt întrerupte după bugetul de timp al cererii.
+        conn.set_progress_handler(self._progress, 1000)
+        self._conn = conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _progress(self):
+        """
+        Returns:
+            1, dacă instrucțiunea în curs trebuie întreruptă
+        """
+        deadline = self._deadline
+        return int(deadline is not None and monotonic() > deadline)
+
+    @contextmanager
+    def translate_errors(self):
+        """
+        Context manager care transformă erorile sqlite3 în erorile din
+        storage.py.
+        """
+        try:
+            yield
+        except sqlite3.IntegrityError as err:
+            message = str(err)
+            if message.startswith("UNIQUE"):
+                raise Conflict() from err
+            if message.startswith("FOREIGN KEY"):
+                raise MissingReference() from err
+            # CHECK sau NOT NULL: valoarea nu încape în coloana ei.
+            raise InvalidValue() from err
+        except OverflowError as err:
+            # Un întreg mai mare decât 64 de biți.
+            raise InvalidValue() from err
+        except sqlite3.OperationalError as err:
+            message = str(err)
+            if message == "interrupted":
+                with self._lock:
+                    self._timeouts += 1
+                raise QueryTimeout() from err
+            if "locked" in message or "busy" in message:
+                # Fișierul este blocat de un alt proces.
+                raise Unavailable() from err
+            raise
+
+    @contextmanager
+    def session(self, timeout=0):
+        """
+        Context manager care ține conexiunea, cu bugetul de timp dat (în
+        milisecunde; 0 nu îl limitează), și transformă erorile.
+        """
+        with self._lock:
+            if self._conn is None:
+                raise Unavailable()
+            previous = self._deadline
+            if timeout > 0:
+                self._deadline = monotonic() + timeout / 1000
+            try:
+                with self.translate_errors():
+                    yield self._conn
+            finally:
+                self._deadline = previous
+
+    def dispatch(self, notifications):
+        """
+        Transmite notificările (canal, conținut) abonaților. Se apelează după
+        commit, fără conexiunea ținută.
+        """
+        for channel, payload in notifications:
+            with self._lock:
+                callbacks = list(self._subscribers.get(channel, []))
+            for callback in callbacks:
+                try:
+                    callback(payload)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Abonatul canalului %s a eșuat.",
+                                     channel)
+
+    def transaction(self, timeout=0):
+        return SqliteTransaction(self, timeout)
+
+    def countries_page(self, limit, after=None, timeout=0):
+        with self.session(timeout) as conn:
+            _, rows = query(conn, """ SELECT country_id, country_name,        \
+                                             country_lat, country_lon        \
+                                      FROM countries WHERE country_id > ?    \
+                                      ORDER BY country_id LIMIT ?; """,
+                            (after if after is not None else 0, limit + 1))
+        return COUNTRY_COLUMNS, rows
+
+    def cities_page(self, limit, after=None, country_id=None, timeout=0):
+        conditions = ["city_id > ?"]
+        params = [after if after is not None else 0]
+        if country_id is not None:
+            conditions.append("country_id = ?")
+            params.append(country_id)
+
+        with self.session(timeout) as conn:
+            _, rows = query(conn, """ SELECT city_id, country_id, city_name,  \
+                                             city_lat, city_lon              \
+                                      FROM cities %s                         \
+                                      ORDER BY city_id LIMIT ?; """ %
+                            where(conditions), params + [limit + 1])
+        return CITY_COLUMNS, rows
+
+    def countries_by_ids(self, ids, timeout=0):
+        with self.session(timeout) as conn:
+            _, rows = query(conn, """ SELECT country_id, country_name,        \
+                                             country_lat, country_lon        \
+                                      FROM countries WHERE country_id IN     \
+                                      (SELECT value FROM json_each(?))       \
+                                      ORDER BY country_id; """,
+                            (id_list(ids),))
+        return COUNTRY_COLUMNS, rows
+
+    def cities_by_ids(self, ids, timeout=0):
+        with self.session(timeout) as conn:
+            _, rows = query(conn, """ SELECT city_id, country_id, city_name,  \
+                                             city_lat, city_lon              \
+                                      FROM cities WHERE city_id IN           \
+                                      (SELECT value FROM json_each(?))       \
+                                      ORDER BY city_id; """,
+                            (id_list(ids),))
+        return CITY_COLUMNS, rows
+
+    def find_cities(self, city_ids=None, country_ids=None):
+        sql = """ SELECT city_id, city_lat, city_lon, city_name, country_id   \
+                  FROM cities """
+        params = ()
+        if city_ids is not None or country_ids is not None:
+            sql += """ WHERE city_id IN (SELECT value FROM json_each(?))      \
+                       OR country_id IN (SELECT value FROM json_each(?)) """
+            params = (id_list(city_ids or ()), id_list(country_ids or ()))
+
+        with self.session() as conn:
+            cursor, rows = query(conn, sql + ";", params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def latest_readings(self, city_ids=None):
+        # Pentru fiecare oraș, o singură căutare în indexul
+        # (city_id, temp_timestamp, temp_id), de la capătul lui.
+        sql = """ SELECT temperatures.temp_id, cities.city_id,                \
+                         temperatures.temp_value,                            \
+                         temperatures.temp_timestamp                         \
+                  FROM cities INNER JOIN temperatures                        \
+                  ON temperatures.temp_id = (                                \
+                      SELECT temp_id FROM temperatures AS last               \
+                      WHERE last.city_id = cities.city_id                    \
+                      ORDER BY temp_timestamp DESC, temp_id DESC LIMIT 1) """
+        params = ()
+        if city_ids is not None:
+            sql += " WHERE cities.city_id IN (SELECT value FROM json_each(?))"
+            params = (id_list(city_ids),)
+
+        with self.session() as conn:
+            _, rows = query(conn, sql + ";", params)
+        return [(temp_id, city_id, value, to_datetime(timestamp))
+                for temp_id, city_id, value, timestamp in rows]
+
+    def temperatures(self, filters, limit, after=None, timeout=0,
+                     primary=False):
+        return TemperatureResults(self, filters, limit, after, timeout)
+
+    def temperature_stats(self, bucket, filters, timeout=0, primary=False):
+        return StatsResults(self, bucket, filters, timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"engine": "sqlite", "path": self.path,
+                    "version": sqlite3.sqlite_version,
+                    "timeouts": self._timeouts}
+
+class SqliteTransaction(Transaction):
+    """
+    Tranzacție SQLite (BEGIN IMMEDIATE), începută la prima instrucțiune;
+    până la commit sau la ieșire, conexiunea este ținută doar de ea, iar
+    bugetul de timp se aplică întregii tranzacții.
+    Temperaturile adăugate fără timestamp primesc momentul începerii
+    tranzacției, ca NOW() în PostgreSQL.
+    """
+    def __init__(self, storage, timeout):
+        self._storage = storage
+        self._timeout = timeout
+        self._stack = ExitStack()
+        self._conn = None
+        self._now = None
+        self._notifications = []
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._conn is not None:
+            self._end("ROLLBACK;")
+
+    def _begin(self):
+        """
+        Returns:
+            conexiunea, cu tranzacția începută
+        """
+        if self._conn is None:
+            conn = self._stack.enter_context(
+                self._storage.session(self._timeout))
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+            except BaseException:
+                self._stack.close()
+                raise
+            self._conn = conn
+            self._now = datetime.now()
+        return self._conn
+
+    def _end(self, statement):
+        """
+        Încheie tranzacția cu COMMIT sau ROLLBACK și eliberează conexiunea.
+        """
+        conn, self._conn = self._conn, None
+        try:
+            with self._storage.translate_errors():
+                try:
+                    conn.execute(statement)
+                except sqlite3.Error:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK;")
+                    raise
+        finally:
+            self._stack.close()
+
+    def _run(self, sql, params=()):
+        """
+        Returns:
+            (cursor, rows) - vezi query()
+        """
+        conn = self._begin()
+        with self._storage.translate_errors():
+            return query(conn, sql, params)
+
+    def _publish(self, event, readings):
+        """
+        Anunță temperaturile scrise, pe canalul fluxului de temperaturi.
+        """
+        for payload in feed.payloads(event, readings):
+            self.notify(feed.CHANNEL, payload)
+
+    def add_country(self, name, lat, lon):
+        cursor, _ = self._run(""" INSERT INTO countries(country_name,         \
+                                                        country_lat,         \
+                                                        country_lon)         \
+                                  VALUES(?, ?, ?); """,
+                              (name, numeric(lat), numeric(lon)))
+        return cursor.lastrowid
+
+    def update_country(self, country_id, name, lat, lon):
+        cursor, _ = self._run(""" UPDATE countries SET country_name=?,        \
+                                  country_lat=?, country_lon=?               \
+                                  WHERE country_id=?; """,
+                              (name, numeric(lat), numeric(lon), country_id))
+        return cursor.rowcount > 0
+
+    def delete_country(self, country_id):
+        cursor, _ = self._run(""" DELETE FROM countries                       \
+                                  WHERE country_id=?; """, (country_id,))
+        return cursor.rowcount > 0
+
+    def add_city(self, country_id, name, lat, lon):
+        cursor, _ = self._run(""" INSERT INTO cities(country_id, city_name,   \
+                                                     city_lat, city_lon)     \
+                                  VALUES(?, ?, ?, ?); """,
+                              (country_id, name, numeric(lat), numeric(lon)))
+        return cursor.lastrowid
+
+    def update_city(self, city_id, country_id, name, lat, lon):
+        _, old = self._run(""" SELECT country_id FROM cities                  \
+                               WHERE city_id=?; """, (city_id,))
+        if not old:
+            return None
+
+        self._run(""" UPDATE cities SET country_id=?, city_name=?,            \
+                      city_lat=?, city_lon=? WHERE city_id=?; """,
+                  (country_id, name, numeric(lat), numeric(lon), city_id))
+        return old[0][0]
+
+    def delete_city(self, city_id):
+        _, old = self._run(""" SELECT country_id FROM cities                  \
+                               WHERE city_id=?; """, (city_id,))
+        if not old:
+            return None
+
+        self._run(""" DELETE FROM cities WHERE city_id=?; """, (city_id,))
+        return old[0][0]
+
+    def _known_countries(self, country_ids):
+        """
+        Returns:
+            set: id-urile date care sunt ale unor țări existente
+        """
+        _, known = self._run(""" SELECT country_id FROM countries             \
+                                 WHERE country_id IN                         \
+                                 (SELECT value FROM json_each(?)); """,
+                             (id_list(set(country_ids)),))
+        return {row[0] for row in known}
+
+    def add_countries(self, items):
+        results = []
+        for name, lat, lon in items:
+            # O țară existentă sau una mai devreme în lot, cu același nume,
+            # nu este înlocuită.
+            cursor, _ = self._run(""" INSERT INTO countries(country_name,     \
+                                          country_lat, country_lon)          \
+                                      VALUES(?, ?, ?)                        \
+                                      ON CONFLICT (country_name)             \
+                                      DO NOTHING; """,
+                                  (name, numeric(lat), numeric(lon)))
+            results.append((201, cursor.lastrowid) if cursor.rowcount
+                           else (409, None))
+        return results
+
+    def update_countries(self, items):
+        _, current = self._run(""" SELECT country_id, country_name           \
+                                   FROM countries WHERE country_id IN        \
+                                   (SELECT value FROM json_each(?))          \
+                                   OR country_name IN                        \
+                                   (SELECT value FROM json_each(?)); """,
+                               (id_list(item[0] for item in items),
+                                json.dumps([item[1] for item in items])))
+        statuses = update_statuses(
+            [(country_id, name) for country_id, name, _, _ in items],
+            {row[0] for row in current}, {row[1]: row[0] for row in current})
+
+        for (country_id, name, lat, lon), status in zip(items, statuses):
+            if status == 200:
+                self._run(""" UPDATE countries SET country_name=?,            \
+                              country_lat=?, country_lon=?                   \
+                              WHERE country_id=?; """,
+                          (name, numeric(lat), numeric(lon), country_id))
+        return statuses
+
+    def delete_countries(self, country_ids):
+        statuses = []
+        for country_id in country_ids:
+            cursor, _ = self._run(""" DELETE FROM countries                   \
+                                      WHERE country_id=?; """, (country_id,))
+            statuses.append(200 if cursor.rowcount else 404)
+        return statuses
+
+    def add_cities(self, items):
+        known_countries = self._known_countries(item[0] for item in items)
+
+        results = []
+        for country_id, name, lat, lon in items:
+            if country_id not in known_countries:
+                # Țara cu id-ul dat nu există.
+                results.append((404, None))
+                continue
+
+            cursor, _ = self._run(""" INSERT INTO cities(country_id,          \
+                                          city_name, city_lat, city_lon)     \
+                                      VALUES(?, ?, ?, ?)                     \
+                                      ON CONFLICT (country_id, city_name)    \
+                                      DO NOTHING; """,
+                                  (country_id, name, numeric(lat),
+                                   numeric(lon)))
+            results.append((201, cursor.lastrowid) if cursor.rowcount
+                           else (409, None))
+        return results
+
+    def update_cities(self, items):
+        known_countries = self._known_countries(item[1] for item in items)
+
+        _, current = self._run(""" SELECT city_id, country_id, city_name     \
+                                   FROM cities WHERE city_id IN              \
+                                   (SELECT value FROM json_each(?))          \
+                                   OR (country_id, city_name) IN             \
+                                   (SELECT json_extract(value, '$[0]'),      \
+                                           json_extract(value, '$[1]')       \
+                                    FROM json_each(?)); """,
+                               (id_list(item[0] for item in items),
+                                json.dumps([item[1:3] for item in items])))
+        old_countries = {row[0]: row[1] for row in current}
+        statuses = update_statuses(
+            [(city_id, (country_id, name))
+             if country_id in known_countries else None
+             for city_id, country_id, name, _, _ in items],
+            old_countries, {(row[1], row[2]): row[0] for row in current})
+
+        results = []
+        for (city_id, country_id, name, lat, lon), status in zip(items,
+                                                                  statuses):
+            if status is None:
+                # Țara cu id-ul dat nu există.
+                results.append((404, None))
+            elif status == 200:
+                self._run(""" UPDATE cities SET country_id=?, city_name=?,    \
+                              city_lat=?, city_lon=? WHERE city_id=?; """,
+                          (country_id, name, numeric(lat), numeric(lon),
+                           city_id))
+                results.append((200, old_countries[city_id]))
+            else:
+                results.append((status, None))
+        return results
+
+    def delete_cities(self, city_ids):
+        results = []
+        for city_id in city_ids:
+            country_id = self.delete_city(city_id)
+            results.append((404, None) if country_id is None
+                           else (200, country_id))
+        return results
+
+    def add_temperature(self, city_id, value):
+        value = numeric(value)
+        self._begin()
+        cursor, _ = self._run(""" INSERT INTO temperatures(city_id,           \
+                                                           temp_value,       \
+                                                           temp_timestamp)   \
+                                  VALUES(?, ?, ?); """,
+                              (city_id, value, to_text(self._now)))
+        self._publish(feed.CREATED, [(cursor.lastrowid, city_id, value,
+                                      self._now)])
+        return cursor.lastrowid
+
+    def add_temperatures(self, items):
+        items = [(city_id, numeric(value), timestamp)
+                 for city_id, value, timestamp in items]
+        results = [None] * len(items)
+
+        _, known = self._run(""" SELECT city_id FROM cities                   \
+                                 WHERE city_id IN                            \
+                                 (SELECT value FROM json_each(?)); """,
+                             (id_list({item[0] for item in items}),))
+        known_cities = {row[0] for row in known}
+
+        inserted = []
+        for idx, (city_id, value, timestamp) in enumerate(items):
+            if city_id not in known_cities:
+                # Orașul cu id-ul dat nu există.
+                results[idx] = (404, None)
+                continue
+
+            timestamp = timestamp if timestamp is not None else self._now
+            # O temperatură existentă sau una mai devreme în lot, din același
+            # oraș și cu același timestamp, nu este înlocuită.
+            cursor, _ = self._run(""" INSERT INTO temperatures(city_id,       \
+                                          temp_value, temp_timestamp)        \
+                                      VALUES(?, ?, ?)                        \
+                                      ON CONFLICT (temp_timestamp, city_id)  \
+                                      DO NOTHING; """,
+                                  (city_id, value, to_text(timestamp)))
+            if cursor.rowcount == 0:
+                results[idx] = (409, None)
+                continue
+
+            results[idx] = (201, cursor.lastrowid)
+            inserted.append((cursor.lastrowid, city_id, value, timestamp))
+
+        self._publish(feed.CREATED, inserted)
+        return results
+
+    def update_temperature(self, temp_id, city_id, value):
+        value = numeric(value)
+        _, old = self._run(""" SELECT city_id, temp_timestamp                 \
+                               FROM temperatures WHERE temp_id=?; """,
+                           (temp_id,))
+        if not old:
+            return False
+
+        self._run(""" UPDATE temperatures SET city_id=?, temp_value=?         \
+                      WHERE temp_id=?; """, (city_id, value, temp_id))
+        self._publish(feed.UPDATED, [(temp_id, city_id, value,
+                                      to_datetime(old[0][1]), old[0][0])])
+        return True
+
+    def delete_temperature(self, temp_id):
+        _, old = self._run(""" SELECT city_id, temp_timestamp                 \
+                               FROM temperatures WHERE temp_id=?; """,
+                           (temp_id,))
+        if not old:
+            return False
+
+        self._run(""" DELETE FROM temperatures WHERE temp_id=?; """,
+                  (temp_id,))
+        self._publish(feed.DELETED, [(temp_id, old[0][0], None,
+                                      to_datetime(old[0][1]))])
+        return True
+
+    def find_cities(self, city_ids=None, country_ids=None):
+        # Conexiunea este reentrantă pentru thread-ul tranzacției.
+        return self._storage.find_cities(city_ids, country_ids)
+
+    def notify(self, channel, payload):
+        self._notifications.append((channel, payload))
+
+    def commit(self):
+        if self._conn is not None:
+            self._end("COMMIT;")
+
+        notifications, self._notifications = self._notifications, []
+        self._storage.dispatch(notifications)
+
+class TemperatureResults(Results):
+    """
+    Temperaturile, citite în loturi, fiecare cu propria interogare, care
+    continuă după cheia (temp_timestamp, temp_id) a ultimului rând trimis;
+    conexiunea nu este ținută cât durează fluxul. Pagina se oprește la cheia
+    ultimului ei rând, stabilită la open(), nu după un număr de rânduri: o
+    temperatură adăugată între două loturi poate apărea în pagină, dar
+    niciuna nu rămâne între pagina trimisă și cea indicată de next_key.
+    """
+    def __init__(self, storage, filters, limit, after, timeout):
+        self._storage = storage
+        self._filters = filters
+        self._limit = limit
+        self._after = (to_text(after[0]), after[1]) \
+                      if after is not None else None
+        # Cheia ultimului rând al paginii; None, după ultimul lot.
+        self._until = None
+        self._timeout = timeout
+        self._from_clause = None
+        self._conditions = None
+        self._params = None
+        self.description = TEMP_COLUMNS
+
+    def _where(self):
+        """
+        Returns:
+            (clauza WHERE, parametri), între cheia ultimului rând trimis și
+            cheia ultimului rând al paginii
+        """
+        conditions = list(self._conditions)
+        params = list(self._params)
+        if self._after is not None:
+            conditions.append("(temperatures.temp_timestamp, "
+                              "temperatures.temp_id) > (?, ?)")
+            params += list(self._after)
+        conditions.append("(temperatures.temp_timestamp, "
+                          "temperatures.temp_id) <= (?, ?)")
+        params += list(self._until)
+        return where(conditions), params
+
+    def _key(self, conn, order, offset):
+        """
+        Returns:
+            list: cheile de pe pozițiile offset și offset + 1, în ordinea
+            dată („ASC” sau „DESC”), după cheia ultimului rând trimis
+        """
+        conditions = list(self._conditions)
+        params = list(self._params)
+        if self._after is not None:
+            conditions.append("(temperatures.temp_timestamp, "
+                              "temperatures.temp_id) > (?, ?)")
+            params += list(self._after)
+        _, keys = query(conn, """ SELECT temperatures.temp_timestamp,         \
+                                         temperatures.temp_id                \
+                                  FROM %s %s                                 \
+                                  ORDER BY temperatures.temp_timestamp %s,   \
+                                           temperatures.temp_id %s           \
+                                  LIMIT 2 OFFSET ?; """ % (
+                                      self._from_clause, where(conditions),
+                                      order, order),
+                        params + [offset])
+        return keys
+
+    def open(self, size):
+        self._from_clause, self._conditions, self._params = \
+            temp_filters(self._filters)
+
+        # Cheia ultimului rând din pagină și, dacă există, a primului rând din
+        # pagina următoare; altfel, pagina se termină la ultimul rând.
+        with self._storage.session(self._timeout) as conn:
+            keys = self._key(conn, "ASC", self._limit - 1)
+            if len(keys) == 2:
+                self.next_key = (to_datetime(keys[0][0]), keys[0][1])
+            elif not keys:
+                keys = self._key(conn, "DESC", 0)
+        if keys:
+            self._until = tuple(keys[0])
+
+        return self.fetchmany(size)
+
+    def fetchmany(self, size):
+        if self._until is None:
+            return []
+
+        clause, params = self._where()
+        with self._storage.session(self._timeout) as conn:
+            _, rows = query(conn, """ SELECT temperatures.city_id,            \
+                                             temperatures.temp_id,           \
+                                             temperatures.temp_value,        \
+                                             %s AS temp_timestamp,           \
+                                             temperatures.temp_timestamp     \
+                                      FROM %s %s                             \
+                                      ORDER BY temperatures.temp_timestamp,  \
+                                               temperatures.temp_id          \
+                                      LIMIT ?; """ % (
+                                          DISPLAY_TIMESTAMP,
+                                          self._from_clause, clause),
+                            params + [size])
+
+        if len(rows) < size:
+            self._until = None
+        if rows:
+            self._after = (rows[-1][4], rows[-1][1])
+        return [row[:4] for row in rows]
+
+class StatsResults(Results):
+    """
+    Statisticile temperaturilor, calculate la open(); sunt puține rânduri
+    (câte unul pentru fiecare interval).
+    """
+    def __init__(self, storage, bucket, filters, timeout):
+        self._storage = storage
+        self._bucket = bucket
+        self._filters = filters
+        self._timeout = timeout
+        self._rows = []
+        self.description = STATS_COLUMNS
+
+    def open(self, size):
+        from_clause, conditions, params = temp_filters(self._filters)
+        bucket = "strftime('%s', temperatures.temp_timestamp)" % \
+                 BUCKET_FORMATS[self._bucket]
+
+        with self._storage.session(self._timeout) as conn:
+            _, self._rows = query(conn, """ SELECT %s AS bucket,              \
+                                            MIN(temperatures.temp_value),    \
+                                            MAX(temperatures.temp_value),    \
+                                            AVG(temperatures.temp_value),    \
+                                            COUNT(*)                         \
+                                            FROM %s %s                       \
+                                            GROUP BY 1 ORDER BY 1; """ % (
+                                                bucket, from_clause,
+                                                where(conditions)), params)
+        return self.fetchmany(size)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
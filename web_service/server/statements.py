@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+import hashlib
+import re
+import threading
+import weakref
+
+# Parametrii psycopg2 (%s) și procentele dublate (%%) dintr-o interogare.
+_PLACEHOLDER = re.compile(r"%%|%s")
+
+class _Statement:
+    """
+    O interogare, împreună cu instrucțiunile PREPARE și EXECUTE ale ei.
+    """
+    __slots__ = ("name", "query", "prepare", "execute")
+
+    def __init__(self, query):
+        count = 0
+
+        def number(match):
+            nonlocal count
+            if match.group() == "%%":
+                return "%"
+            count += 1
+            return "$%d" % count
+
+        self.query = query
+        self.name = "stmt_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+        self.prepare = "PREPARE %s AS %s" % (
+            self.name, _PLACEHOLDER.sub(number, query.strip().rstrip(";")))
+        self.execute = "EXECUTE %s" % self.name
+        if count:
+            self.execute += "(%s)" % ", ".join(["%s"] * count)
+
+_LOCK = threading.Lock()
+# Interogarea -> instrucțiunea ei; numele -> instrucțiunea.
+_STATEMENTS = {}
+_BY_NAME = {}
+# Conexiunea -> numele instrucțiunilor pregătite pe ea.
+_PREPARED = weakref.WeakKeyDictionary()
+
+def _statement(query):
+    """
+    Returns:
+        _Statement: instrucțiunea interogării date
+    """
+    statement = _STATEMENTS.get(query)
+    if statement is None:
+        statement = _Statement(query)
+        with _LOCK:
+            _STATEMENTS[query] = statement
+            _BY_NAME[statement.name] = statement
+    return statement
+
+def execute(cursor, query, params=None):
+    """
+    Rulează o interogare ca instrucțiune pregătită pe server (PREPARE), cu
+    parametrii legați. Fiecare interogare distinctă (de exemplu, fiecare
+    combinație de filtre a unei rute) primește un nume fix, derivat din
+    textul ei, și este pregătită o singură dată pe fiecare conexiune, la
+    prima folosire; apoi se trimite doar EXECUTE cu parametrii, iar
+    PostgreSQL nu o mai analizează și poate refolosi planul.
+
+    Instrucțiunile pregătite rămân pe conexiune și după ROLLBACK. Cursoarele
+    de server (cu nume) nu pot rula EXECUTE, deci pentru ele interogarea
+    este rulată direct.
+
+    Args:
+        cursor - cursorul psycopg2.
+        query - interogarea, cu parametri %s; textul trebuie să fie fix
+            (valorile se dau doar prin params).
+        params - parametrii interogării.
+    """
+    if cursor.name is not None:
+        cursor.execute(query, params)
+        return
+
+    statement = _statement(query)
+    conn = cursor.connection
+    with _LOCK:
+        prepared = _PREPARED.setdefault(conn, set())
+        ready = statement.name in prepared
+
+    if not ready:
+        cursor.execute(statement.prepare)
+        with _LOCK:
+            prepared.add(statement.name)
+
+    if params:
+        cursor.execute(statement.execute, params)
+    else:
+        cursor.execute(statement.execute)
+
+def source(query):
+    """
+    Returns:
+        str: interogarea originală, dacă query este EXECUTE-ul unei
+        instrucțiuni pregătite de execute(), altfel query
+    """
+    match = re.match(r"EXECUTE (stmt_[0-9a-f]{16})\b", query)
+    if match is None:
+        return query
+    statement = _BY_NAME.get(match.group(1))
+    return statement.query if statement is not None else query
+
+def stats():
+    """
+    Returns:
+        dict cu numărul de interogări distincte și de conexiuni cu
+        instrucțiuni pregătite
+    """
+    with _LOCK:
+        return {"statements": len(_STATEMENTS),
+                "connections": len(_PREPARED),
+                "prepared": sum(len(names) for names in _PREPARED.values())}
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+"""
+(C) Copyright 2020
+"""
+
+# Motoarele de stocare disponibile (WEB_SERVICE_STORAGE).
+POSTGRES = "postgres"
+SQLITE = "sqlite"
+
+# Momentul unei temperaturi în răspunsuri: ora pe 12 ore, ca la
+# TO_CHAR(..., 'YYYY-MM-DD HH:MI:SS') din pg_storage.TEMP_COLUMNS și ca în
+# sqlite_storage.DISPLAY_TIMESTAMP.
+DISPLAY_FORMAT = "%Y-%m-%d %I:%M:%S"
+
+def display_timestamp(timestamp):
+    """
+    Returns:
+        str: momentul unei temperaturi, cum apare în răspunsuri
+    """
+    return timestamp.strftime(DISPLAY_FORMAT)
+
+class StorageError(Exception):
+    """
+    Eroare a stocării, independentă de motorul bazei de date.
+    """
+
+class InvalidValue(StorageError):
+    """
+    Valoare respinsă de schema bazei de date (de exemplu, o coordonată prea
+    mare) sau parametru de filtrare cu tipul greșit.
+    """
+
+class MissingReference(StorageError):
+    """
+    Rândul la care se face referire (țara unui oraș, orașul unei
+    temperaturi) nu există.
+    """
+
+class Conflict(StorageError):
+    """
+    Scrierea încalcă o constrângere de unicitate.
+    """
+
+class QueryTimeout(StorageError):
+    """
+    O interogare a depășit bugetul de timp al cererii sau a fost anulată.
+    """
+
+class Unavailable(StorageError):
+    """
+    Baza de date nu este disponibilă sau este supraîncărcată.
+    """
+
+def update_statuses(keys, existing, holders):
+    """
+    Stabilește care elemente ale unui lot de modificări pot fi aplicate.
+    Cheia unică nouă a unui rând (numele țării sau țara și numele orașului)
+    nu poate fi una folosită înaintea lotului de alt rând, chiar dacă acela
+    o schimbă în același lot, și nici una cerută mai devreme în lot. Așa,
+    lotul poate fi aplicat cu o singură instrucțiune, în orice ordine a
+    rândurilor, fără să încalce unicitatea.
+
+    Args:
+        keys - pentru fiecare element, (id rând, cheia unică nouă) sau None,
+            pentru elementele respinse deja.
+        existing - id-urile rândurilor care există.
+        holders - cheia unică -> id-ul rândului care o are înaintea lotului.
+    Returns:
+        list: codul fiecărui element: 200, 404 (rândul nu există), 409
+        (cheia este folosită sau rândul apare de două ori în lot) sau None,
+        pentru elementele respinse deja
+    """
+    statuses = []
+    updated = set()
+    claimed = set()
+    for item in keys:
+        if item is None:
+            statuses.append(None)
+            continue
+
+        row_id, key = item
+        if row_id not in existing:
+            statuses.append(404)
+        elif row_id in updated or key in claimed or \
+             holders.get(key, row_id) != row_id:
+            statuses.append(409)
+        else:
+            statuses.append(200)
+            updated.add(row_id)
+            claimed.add(key)
+
+    return statuses
+
+class Storage:
+    """
+    Stocarea țărilor, orașelor și temperaturilor, în spatele rutelor:
+    PostgresStorage (pg_storage.py) sau SqliteStorage (sqlite_storage.py).
+    Amândouă aplică aceleași reguli: numele țărilor și numele orașelor
+    dintr-o țară sunt unice, la fel temperaturile unui oraș dintr-un moment,
+    iar ștergerea unei țări sau a unui oraș le șterge în cascadă orașele,
+    respectiv temperaturile.
+
+    Scrierile se fac într-o tranzacție (transaction()). Fiecare proces
+    primește notificările trimise de tranzacții pe canalele la care s-a
+    abonat cu subscribe(), după commit; funcțiile date la on_reconnect() sunt
+    apelate dacă unele notificări ar fi putut fi pierdute.
+
+    Citirile și tranzacțiile primesc un buget de timp, în milisecunde, al
+    fiecărei instrucțiuni (0 nu îl limitează); o instrucțiune care îl
+    depășește ridică QueryTimeout.
+    """
+    # Scrierea în loturi a temperaturilor (ingest.WriteBehindWriter), dacă
+    # motorul o are și este pornită.
+    writer = None
+    # True, dacă unele citiri pot merge la replici, care pot rămâne puțin în
+    # urma scrierilor (vezi temperatures()).
+    replicated = False
+
+    def subscribe(self, channel, callback):
+        """
+        Abonează callback(payload) la notificările de pe canal. Se apelează
+        înainte de open().
+        """
+        raise NotImplementedError
+
+    def on_reconnect(self, callback):
+        """
+        Înregistrează callback(), apelată după ce unele notificări ar fi
+        putut fi pierdute. Se apelează înainte de open().
+        """
+        raise NotImplementedError
+
+    def open(self):
+        """
+        Deschide baza de date și aduce schema la ultima versiune.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Termină scrierile în curs, la oprirea procesului.
+        """
+
+    def transaction(self, timeout=0):
+        """
+        Returns:
+            Transaction: tranzacție nouă, folosită ca context manager
+        """
+        raise NotImplementedError
+
+    def countries_page(self, limit, after=None, timeout=0):
+        """
+        Returns:
+            (description, rows): cel mult limit + 1 țări cu id-ul mai mare
+            decât after, în ordinea id-urilor, ca tupluri (country_id,
+            country_name, country_lat, country_lon), cu descrierea
+            coloanelor (ca cursor.description)
+        """
+        raise NotImplementedError
+
+    def cities_page(self, limit, after=None, country_id=None, timeout=0):
+        """
+        Returns:
+            (description, rows): cel mult limit + 1 orașe (ale țării date,
+            dacă este dată) cu id-ul mai mare decât after, în ordinea
+            id-urilor, ca tupluri (city_id, country_id, city_name, city_lat,
+            city_lon), cu descrierea coloanelor
+        """
+        raise NotImplementedError
+
+    def countries_by_ids(self, ids, timeout=0):
+        """
+        Returns:
+            (description, rows): țările cu id-urile date care există, în
+            ordinea id-urilor, ca la countries_page()
+        """
+        raise NotImplementedError
+
+    def cities_by_ids(self, ids, timeout=0):
+        """
+        Returns:
+            (description, rows): orașele cu id-urile date care există, în
+            ordinea id-urilor, ca la cities_page()
+        """
+        raise NotImplementedError
+
+    def find_cities(self, city_ids=None, country_ids=None):
+        """
+        Returns:
+            list: orașele cu id-urile date sau din țările date (fără niciun
+            filtru, toate orașele), ca dicționare cu cheile city_id,
+            country_id, city_name, city_lat și city_lon
+        """
+        raise NotImplementedError
+
+    def latest_readings(self, city_ids=None):
+        """
+        Returns:
+            list: ultima temperatură a fiecăruia dintre orașele date (sau a
+            tuturor orașelor), ca tupluri (temp_id, city_id, temp_value,
+            temp_timestamp), cu temp_timestamp ca datetime
+        """
+        raise NotImplementedError
+
+    def temperatures(self, filters, limit, after=None, timeout=0,
+                     primary=False):
+        """
+        Temperaturile care respectă filtrele, ordonate după (temp_timestamp,
+        temp_id), ca tupluri (city_id, temp_id, temp_value, temp_timestamp).
+
+        Args:
+            filters - dicționar cu filtrele opționale: city, country, lat și
+                lon (ale orașului), cities (listă de id-uri de orașe), from
+                și until (date; until este inclusiv, deci se întorc și
+                temperaturile din acea zi). Valorile pot fi șirurile primite
+                în cerere.
+            limit - numărul maxim de temperaturi.
+            after - (temp_timestamp, temp_id) al ultimei temperaturi din
+                pagina anterioară, opțional.
+            timeout - bugetul de timp, în milisecunde.
+            primary - True, dacă citirea nu poate merge la o replică.
+        Returns:
+            Results: rezultatele, cu next_key setat dacă există o pagină
+            următoare
+        """
+        raise NotImplementedError
+
+    def temperature_stats(self, bucket, filters, timeout=0, primary=False):
+        """
+        Pentru fiecare interval de timp (hour, day sau month), temperatura
+        minimă, maximă, medie și numărul de temperaturi care respectă
+        filtrele (vezi temperatures()), ca tupluri (bucket, min, max, avg,
+        count), în ordinea intervalelor.
+
+        Returns:
+            Results: rezultatele
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns:
+            dict cu starea conexiunilor cu baza de date
+        """
+        raise NotImplementedError
+
+class Transaction:
+    """
+    Tranzacție de scriere, folosită ca context manager: la ieșire, dacă nu
+    s-a făcut commit(), scrierile sunt anulate. După o eroare a unei
+    scrieri (InvalidValue, MissingReference sau Conflict), tranzacția nu mai
+    poate fi folosită.
+
+    Notificările trimise cu notify() sunt livrate abia după commit.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        raise NotImplementedError
+
+    def add_country(self, name, lat, lon):
+        """
+        Returns:
+            int: id-ul țării adăugate
+        """
+        raise NotImplementedError
+
+    def update_country(self, country_id, name, lat, lon):
+        """
+        Returns:
+            True, dacă țara există (și a fost modificată)
+        """
+        raise NotImplementedError
+
+    def delete_country(self, country_id):
+        """
+        Șterge țara și, în cascadă, orașele și temperaturile ei.
+
+        Returns:
+            True, dacă țara a existat
+        """
+        raise NotImplementedError
+
+    def add_city(self, country_id, name, lat, lon):
+        """
+        Returns:
+            int: id-ul orașului adăugat
+        """
+        raise NotImplementedError
+
+    def update_city(self, city_id, country_id, name, lat, lon):
+        """
+        Returns:
+            int: id-ul țării de dinainte de modificare
+            None: dacă orașul nu există
+        """
+        raise NotImplementedError
+
+    def delete_city(self, city_id):
+        """
+        Șterge orașul și, în cascadă, temperaturile lui.
+
+        Returns:
+            int: id-ul țării orașului șters
+            None: dacă orașul nu există
+        """
+        raise NotImplementedError
+
+    def add_countries(self, items):
+        """
+        Adaugă mai multe țări. Un element care nu poate fi adăugat nu
+        oprește lotul, ci primește propriul cod.
+
+        Args:
+            items - tupluri (nume, latitudine, longitudine).
+        Returns:
+            list: câte un tuplu (cod, id sau None) pentru fiecare element:
+            201 (adăugată) sau 409 (există deja o țară cu același nume,
+            inclusiv mai devreme în lot)
+        """
+        raise NotImplementedError
+
+    def update_countries(self, items):
+        """
+        Modifică mai multe țări (vezi update_statuses()).
+
+        Args:
+            items - tupluri (id țară, nume, latitudine, longitudine).
+        Returns:
+            list: codul fiecărui element: 200, 404 sau 409
+        """
+        raise NotImplementedError
+
+    def delete_countries(self, country_ids):
+        """
+        Șterge mai multe țări și, în cascadă, orașele și temperaturile lor.
+
+        Returns:
+            list: codul fiecărui id: 200 sau 404 (țara nu există sau a fost
+            ștearsă mai devreme în lot)
+        """
+        raise NotImplementedError
+
+    def add_cities(self, items):
+        """
+        Adaugă mai multe orașe, ca add_countries().
+
+        Args:
+            items - tupluri (id țară, nume, latitudine, longitudine).
+        Returns:
+            list: câte un tuplu (cod, id sau None) pentru fiecare element:
+            201, 404 (țara nu există) sau 409 (există deja un oraș cu același
+            nume în aceeași țară, inclusiv mai devreme în lot)
+        """
+        raise NotImplementedError
+
+    def update_cities(self, items):
+        """
+        Modifică mai multe orașe (vezi update_statuses()).
+
+        Args:
+            items - tupluri (id oraș, id țară, nume, latitudine,
+                longitudine).
+        Returns:
+            list: câte un tuplu (cod, id-ul țării de dinainte de modificare
+            sau None) pentru fiecare element: 200, 404 (orașul sau țara nu
+            există) sau 409
+        """
+        raise NotImplementedError
+
+    def delete_cities(self, city_ids):
+        """
+        Șterge mai multe orașe și, în cascadă, temperaturile lor.
+
+        Returns:
+            list: câte un tuplu (cod, id-ul țării orașului sau None) pentru
+            fiecare id: 200 sau 404
+        """
+        raise NotImplementedError
+
+    def add_temperature(self, city_id, value):
+        """
+        Adaugă o temperatură, cu momentul de început al tranzacției.
+
+        Returns:
+            int: id-ul temperaturii adăugate
+        """
+        raise NotImplementedError
+
+    def add_temperatures(self, items):
+        """
+        Adaugă mai multe temperaturi. Un element care nu poate fi adăugat nu
+        oprește lotul, ci primește propriul cod.
+
+        Args:
+            items - tupluri (id oraș, valoare, timestamp sau None, pentru
+                momentul de început al tranzacției).
+        Returns:
+            list: câte un tuplu (cod, id sau None) pentru fiecare element:
+            201 (adăugat), 400 (timestamp neacceptat), 404 (orașul nu
+            există) sau 409 (există deja o temperatură în același oraș și cu
+            același timestamp, inclusiv mai devreme în lot)
+        """
+        raise NotImplementedError
+
+    def update_temperature(self, temp_id, city_id, value):
+        """
+        Returns:
+            True, dacă temperatura există (și a fost modificată)
+        """
+        raise NotImplementedError
+
+    def delete_temperature(self, temp_id):
+        """
+        Returns:
+            True, dacă temperatura a existat
+        """
+        raise NotImplementedError
+
+    def find_cities(self, city_ids=None, country_ids=None):
+        """
+        Vezi Storage.find_cities(); citirea se face în tranzacție (sau după
+        commit, pe aceeași conexiune).
+        """
+        raise NotImplementedError
+
+    def notify(self, channel, payload):
+        """
+        Trimite o notificare tuturor proceselor abonate la canal, la commit.
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        """
+        Face commit.
+        """
+        raise NotImplementedError
+
+class Results:
+    """
+    Rezultatele unei citiri, trimise în flux: open() rulează interogarea și
+    întoarce primul lot, iar fetchmany() pe următoarele. close() trebuie
+    apelată la final, iar cancel() poate fi apelată din alt thread
+    (greenlet), pentru a opri interogarea.
+    """
+    # Descrierea coloanelor (ca cursor.description), cunoscută după open().
+    description = None
+    # (temp_timestamp, temp_id) al ultimei temperaturi din pagină, dacă
+    # există o pagină următoare.
+    next_key = None
+
+    def open(self, size):
+        """
+        Rulează interogarea.
+
+        Returns:
+            list: primele cel mult size rânduri
+        Raises:
+            InvalidValue, dacă un filtru are tipul greșit; QueryTimeout
+        """
+        raise NotImplementedError
+
+    def fetchmany(self, size):
+        """
+        Returns:
+            list: următoarele cel mult size rânduri (goală, la final)
+        """
+        raise NotImplementedError
+
+    def cancel(self):
+        """
+        Oprește interogarea în curs, dacă motorul poate face asta.
+        """
+
+    def close(self):
+        """
+        Eliberează resursele citirii.
+        """
@@ -0,0 +1,36 @@
+"""
+(C) Copyright 2020
+
+Teste pentru serviciul web, pe stocarea SQLite (fără server de baze de
+date). Se rulează din directorul web_service: python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+# Modulele serverului (server.py, serialization.py etc.) nu formează un pachet.
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, "server")
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+# Stocarea este aleasă la importul lui server.py.
+os.environ["WEB_SERVICE_STORAGE"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+
+import server  # pylint: disable=wrong-import-position
+
+@pytest.fixture
+def client():
+    """
+    Returns:
+        clientul de test Flask al serverului, cu o bază de date nouă, doar în
+        memorie
+    """
+    if server.STORAGE is not None:
+        server.STORAGE.close()
+    server.CACHE.clear()
+    server.init_storage()
+    return server.APP.test_client()
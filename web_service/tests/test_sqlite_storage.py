@@ -0,0 +1,163 @@
+"""
+(C) Copyright 2020
+
+Regulile de unicitate, ștergerea în cascadă și paginarea, verificate pe
+stocarea SQLite, prin rutele serverului.
+"""
+
+from datetime import datetime, timedelta
+
+import server
+
+def add_country(client, name="Romania"):
+    """
+    Returns:
+        int: id-ul țării adăugate
+    """
+    response = client.post("/api/countries",
+                           json={"nume": name, "lat": 45.9, "lon": 24.9})
+    assert response.status_code == 201
+    return response.get_json()["id"]
+
+def add_city(client, country_id, name="Bucuresti"):
+    """
+    Returns:
+        int: id-ul orașului adăugat
+    """
+    response = client.post("/api/cities", json={
+        "idTara": country_id, "nume": name, "lat": 44.4, "lon": 26.1})
+    assert response.status_code == 201
+    return response.get_json()["id"]
+
+def add_readings(client, city_id, count, start=datetime(2020, 1, 1)):
+    """
+    Adaugă count temperaturi orare, începând cu start.
+
+    Returns:
+        list: codurile fiecărei temperaturi
+    """
+    response = client.post("/api/temperatures/batch", json=[
+        {"idOras": city_id, "valoare": hour,
+         "timestamp": (start + timedelta(hours=hour)).isoformat()}
+        for hour in range(count)
+    ])
+    assert response.status_code == 200
+    return [item["status"] for item in response.get_json()]
+
+def next_page(response):
+    """
+    Returns:
+        str: calea paginii următoare, din antetul Link, sau None
+    """
+    link = response.headers.get("Link")
+    if link is None:
+        return None
+    return link[1:link.index(">")].replace("http://localhost", "")
+
+def walk(client, path):
+    """
+    Returns:
+        list: rândurile tuturor paginilor, urmând antetul Link
+    """
+    rows = []
+    while path is not None:
+        response = client.get(path)
+        assert response.status_code == 200
+        rows += response.get_json()
+        path = next_page(response)
+    return rows
+
+def test_duplicates_conflict(client):
+    country_id = add_country(client)
+    response = client.post("/api/countries",
+                           json={"nume": "Romania", "lat": 1, "lon": 1})
+    assert response.status_code == 409
+
+    city_id = add_city(client, country_id)
+    response = client.post("/api/cities", json={
+        "idTara": country_id, "nume": "Bucuresti", "lat": 1, "lon": 1})
+    assert response.status_code == 409
+    # Același nume, în altă țară.
+    add_city(client, add_country(client, "Moldova"))
+
+    assert add_readings(client, city_id, 2) == [201, 201]
+    assert add_readings(client, city_id, 3) == [409, 409, 201]
+
+def test_missing_references(client):
+    response = client.post("/api/cities", json={
+        "idTara": 42, "nume": "Nicaieri", "lat": 1, "lon": 1})
+    assert response.status_code == 404
+    assert add_readings(client, 42, 1) == [404]
+
+def test_country_delete_cascades(client):
+    country_id = add_country(client)
+    city_id = add_city(client, country_id)
+    other_id = add_city(client, add_country(client, "Moldova"), "Chisinau")
+    add_readings(client, city_id, 3)
+    add_readings(client, other_id, 1)
+
+    assert client.delete("/api/countries/%d" % country_id).status_code == 200
+    assert client.delete("/api/countries/%d" % country_id).status_code == 404
+
+    assert client.get("/api/cities/country/%d" % country_id).get_json() == []
+    assert [city["city_id"] for city
+            in client.get("/api/cities").get_json()] == [other_id]
+    assert client.get("/api/temperatures/cities/%d" % city_id).get_json() \
+           == []
+    assert [reading["city_id"] for reading
+            in client.get("/api/temperatures").get_json()] == [other_id]
+    assert [reading["city_id"] for reading
+            in client.get("/api/temperatures/latest").get_json()] == \
+           [other_id]
+
+def test_city_delete_cascades(client):
+    city_id = add_city(client, add_country(client))
+    add_readings(client, city_id, 2)
+
+    assert client.delete("/api/cities/%d" % city_id).status_code == 200
+    assert client.get("/api/temperatures").get_json() == []
+
+def test_list_pagination(client):
+    ids = [add_country(client, "Country %d" % i) for i in range(5)]
+
+    response = client.get("/api/countries?limit=2")
+    assert len(response.get_json()) == 2
+    assert "after=" in next_page(response)
+    assert [country["country_id"] for country
+            in walk(client, "/api/countries?limit=2")] == ids
+    assert client.get("/api/countries?after=zzz").status_code == 400
+
+def test_temperature_pagination(client):
+    city_id = add_city(client, add_country(client))
+    add_readings(client, city_id, 7)
+
+    rows = walk(client, "/api/temperatures?limit=3")
+    assert [row["temp_value"] for row in rows] == list(range(7))
+    assert client.get("/api/temperatures?limit=3&after=zzz").status_code \
+           == 400
+
+def test_page_ends_at_promised_key(client):
+    # Temperaturile adăugate cât timp o pagină este trimisă nu trebuie să
+    # rămână între pagina trimisă și cea indicată de antetul Link.
+    city_id = add_city(client, add_country(client))
+    add_readings(client, city_id, 10, datetime(2020, 1, 1))
+
+    values = []
+    after = None
+    pages = 0
+    while True:
+        results = server.STORAGE.temperatures({}, 4, after)
+        rows = results.open(2)
+        if pages == 0:
+            # În intervalul primei pagini, după primul lot.
+            add_readings(client, city_id, 1, datetime(2020, 1, 1, 2, 30))
+        while rows:
+            values += [float(row[2]) for row in rows]
+            rows = results.fetchmany(2)
+        results.close()
+        pages += 1
+        if results.next_key is None:
+            break
+        after = results.next_key
+
+    assert values == [0, 1, 2, 0, 3] + list(range(4, 10))